@@ -0,0 +1,74 @@
+"""
+Compare the serial and block-parallel compression stages.
+
+    >> python benchmarks/bench_compression.py [--size <MB>] [--codec gzip]
+
+A synthetic SQL dump is compressed once with the serial codec and then with
+the block-parallel compressor for an increasing number of workers. The
+parallel output is checked to decompress back to the original dump.
+"""
+import os, random, sys, time
+from multiprocessing import cpu_count
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from dbbackup import compression, utils
+
+CHUNK_SIZE = 64 * 1024
+
+
+def synthetic_dump(size):
+    """ Return roughly size bytes of pg_dump-like COPY data. """
+    rand = random.Random(size)
+    words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel']
+    lines, total, row = [], 0, 0
+    while total < size:
+        line = '%s\t%s\t%s %s\t2013-%02d-%02d %02d:%02d:%02d\t%.2f\n' % (row,
+            rand.randint(1, 10**6), rand.choice(words), rand.choice(words),
+            rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 23),
+            rand.randint(0, 59), rand.randint(0, 59), rand.random() * 1000)
+        lines.append(line)
+        total += len(line)
+        row += 1
+    return ''.join(lines)
+
+def measure(label, data, chunks_func):
+    """ Run chunks_func over data and print the throughput. """
+    chunks = (data[i:i+CHUNK_SIZE] for i in xrange(0, len(data), CHUNK_SIZE))
+    start = time.time()
+    output = ''.join(chunks_func(chunks))
+    elapsed = time.time() - start
+    print "  %-12s %8.1f MB/s  %5.2fs  ratio %.2f" % (label,
+        len(data) / elapsed / 1048576.0, elapsed, len(data) / float(len(output)))
+    return output, elapsed
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--size", type="int", default=64, help="Dump size in MB")
+    parser.add_option("--codec", default="gzip", help="gzip, bz2 or lzma")
+    parser.add_option("--level", type="int", default=6)
+    parser.add_option("--block-size", type="int", default=1024*1024)
+    options, args = parser.parse_args()
+    data = synthetic_dump(options.size * 1048576)
+    cores = cpu_count()
+    print "Compressing %s of synthetic dump with %s (%s cores)" % (
+        utils.bytes_to_str(len(data)), options.codec, cores)
+    serial_output, serial_time = measure('serial', data,
+        lambda chunks: compression.compress_chunks(chunks, options.codec, options.level))
+    workers = 1
+    while workers <= max(cores, 2):
+        output, elapsed = measure('%s workers' % workers, data,
+            lambda chunks: compression.parallel_compress_chunks(chunks,
+                options.codec, options.level, workers, options.block_size))
+        restored = ''.join(compression.decompress_chunks([output], options.codec))
+        assert restored == data, "Parallel output does not decompress to the input"
+        print "  %-12s %8.2fx" % ('speedup', serial_time / elapsed)
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
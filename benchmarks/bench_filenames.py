@@ -0,0 +1,86 @@
+"""
+Compare the legacy backup filename matching with the compiled parser.
+
+    >> python benchmarks/bench_filenames.py [--count 100000]
+
+A listing of synthetic backup names for several databases is filtered and
+planned for cleanup twice: once the way cleanup_old_backups used to do it
+(a regex rebuilt and strptime called for every path) and once with the
+cached FilenameParser and the single-pass retention planner. The legacy
+regex lets the dot in 'shop.analytics' match 'shop_analytics' backups too,
+so it deletes more files than the parser.
+"""
+import os, random, re, sys, time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from dbbackup import retention
+from dbbackup.dbcommands import DBCommands, DATE_FORMAT
+
+DATABASES = ['shop', 'shop.analytics', 'shop_analytics', 'crm', 'wiki']
+
+
+def database(name):
+    return {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': name,
+        'USER': '', 'PASSWORD': '', 'PORT': ''}
+
+def synthetic_listing(count):
+    """ Return count backup paths spread over DATABASES, one per hour. """
+    rand = random.Random(count)
+    start = datetime(2010, 1, 1)
+    paths = []
+    for index in xrange(count):
+        name = DATABASES[index % len(DATABASES)]
+        timestamp = (start + timedelta(hours=index)).strftime(DATE_FORMAT)
+        extension = rand.choice(['psql', 'psql.gz', 'psql.manifest'])
+        paths.append('django-dbbackups/%s-%s.%s' % (name, timestamp, extension))
+    return sorted(paths)
+
+def legacy_cleanup(dbcommands, filepaths):
+    """ The filtering and retention loop cleanup_old_backups used to run. """
+    regex = dbcommands.filename_match(None, '.*?')
+    filepaths = filter(lambda path: re.search(regex, path), filepaths)
+    deletes = []
+    for filepath in sorted(filepaths[0:-10]):
+        regex = dbcommands.filename_match(None, '(.*?)')
+        datestr = re.findall(regex, filepath)[0]
+        dateTime = datetime.strptime(datestr, DATE_FORMAT)
+        if int(dateTime.strftime("%d")) != 1:
+            deletes.append(filepath)
+    return deletes
+
+def parser_cleanup(dbcommands, filepaths):
+    parser = dbcommands.filename_parser()
+    keep, delete = retention.plan_cleanup(filter(None, map(parser.parse, filepaths)))
+    return [backup.filepath for backup in delete]
+
+def measure(label, func, filepaths):
+    start = time.time()
+    deletes = []
+    for name in DATABASES:
+        deletes.extend(func(DBCommands(database(name)), filepaths))
+    elapsed = time.time() - start
+    print "  %-8s %8.3fs  %9.0f names/s  %s deletes" % (label, elapsed,
+        len(filepaths) * len(DATABASES) / elapsed, len(deletes))
+    return sorted(deletes), elapsed
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--count", type="int", default=100000, help="Number of backup names")
+    options, args = parser.parse_args()
+    filepaths = synthetic_listing(options.count)
+    print "Planning cleanup of %s backup names for %s databases" % (len(filepaths), len(DATABASES))
+    legacy, legacy_time = measure('legacy', legacy_cleanup, filepaths)
+    parsed, parsed_time = measure('parser', parser_cleanup, filepaths)
+    print "  %-8s %8.2fx" % ('speedup', legacy_time / parsed_time)
+    print "  legacy deletes of other databases: %s" % (len(legacy) - len(parsed))
+    assert set(parsed) <= set(legacy), "The parser deletes files the legacy loop kept"
+
+
+if __name__ == '__main__':
+    main()
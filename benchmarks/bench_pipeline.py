@@ -0,0 +1,280 @@
+"""
+Measure the backup and restore pipeline against local storage stand-ins.
+
+    >> python benchmarks/bench_pipeline.py [--sizes 16,64] [--dumps sqlite,pgdump]
+           [--storages filesystem,s3,dropbox] [-z <codec>] [--files 500]
+
+For every dump kind and size a synthetic database is backed up with
+DBCommands into each storage (a temp directory, the S3 stand-in from
+s3server.py running in a child process, and the in-memory Dropbox client
+from fake_dropbox.py), then restored from it. Listing and cleanup are timed
+over --files small backups. Each step reports its throughput, the peak RSS
+it reached and the read/write syscalls and disk bytes of this process from
+/proc/self/io (the dump and restore subprocesses and the S3 stand-in are not
+counted). Peak RSS is reset between steps through /proc/self/clear_refs.
+
+The sqlite dump is a real SQLite database backed up with SQLITE_BACKUP and
+restored with SQLITE_RESTORE; the pgdump dump streams pg_dump-like COPY data
+through a cat subprocess, the way pg_dump output is read.
+"""
+import os, shutil, signal, socket, sqlite3, sys, tempfile, time
+from optparse import OptionParser
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+WORKDIR = tempfile.mkdtemp(prefix='dbbackup-bench-')
+S3_PORT = free_port()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from django.conf import settings
+if not settings.configured:
+    settings.configure(
+        DBBACKUP_FILESYSTEM_DIRECTORY=os.path.join(WORKDIR, 'filesystem'),
+        DBBACKUP_S3_DOMAIN='http://127.0.0.1:%s/' % S3_PORT, DBBACKUP_S3_BUCKET='bench',
+        DBBACKUP_S3_ACCESS_KEY='access', DBBACKUP_S3_SECRET_KEY='secret',
+        DBBACKUP_CATALOG=False, DBBACKUP_SEND_EMAIL=False,
+    )
+
+from bench_compression import synthetic_dump
+from s3server import S3Server
+from dbbackup import utils
+from dbbackup.dbcommands import DBCommands
+
+CHUNK_SIZE = 64 * 1024
+PROC_IO_FIELDS = ('syscr', 'syscw', 'read_bytes', 'write_bytes')
+
+
+##################################
+#  Process Counters
+##################################
+
+def proc_io():
+    """ Return the PROC_IO_FIELDS counters of this process, or None. """
+    try:
+        with open('/proc/self/io') as iofile:
+            counters = dict(line.split(': ') for line in iofile.read().splitlines())
+    except (IOError, ValueError):
+        return None
+    return dict((field, int(counters[field])) for field in PROC_IO_FIELDS)
+
+def reset_peak_rss():
+    """ Reset the peak RSS of this process (Linux 4.0+). """
+    try:
+        with open('/proc/self/clear_refs', 'w') as refsfile:
+            refsfile.write('5')
+    except IOError:
+        pass
+
+def rss(field='VmHWM'):
+    """ Return the peak (VmHWM) or current (VmRSS) RSS of this process in
+        bytes.
+    """
+    try:
+        with open('/proc/self/status') as statusfile:
+            for line in statusfile:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Measure(object):
+    """ Time a step and collect its peak RSS and /proc/self/io deltas. The
+        progress the commands print is silenced meanwhile.
+    """
+
+    def __init__(self, label, size=None, count=None):
+        self.label, self.size, self.count = label, size, count
+
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        reset_peak_rss()
+        self.rss = rss('VmRSS')
+        self.io = proc_io()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = max(time.time() - self.start, 1e-6)
+        self.peak = rss()
+        io = proc_io()
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        if exc_info[0] is None:
+            self.report(dict((field, io[field] - self.io[field]) for field in PROC_IO_FIELDS) if io else None)
+
+    def report(self, io):
+        if self.size is not None:
+            rate = "%8.1f MB/s" % (self.size / self.elapsed / 1048576.0)
+        else:
+            rate = "%8.0f op/s" % (self.count / self.elapsed)
+        counters = "syscr %7d  syscw %7d  disk r/w %s/%s" % (io['syscr'], io['syscw'],
+            utils.bytes_to_str(io['read_bytes']), utils.bytes_to_str(io['write_bytes'])) if io else ''
+        print "    %-16s %s %7.2fs  peak rss %9s (+%9s)  %s" % (self.label, rate, self.elapsed,
+            utils.bytes_to_str(self.peak), utils.bytes_to_str(max(self.peak - self.rss, 0)), counters)
+
+
+##################################
+#  Stand-ins
+##################################
+
+def start_s3_server():
+    """ Fork the S3 stand-in on S3_PORT, so its syscalls are not counted.
+        Returns its pid.
+    """
+    server = S3Server(('127.0.0.1', S3_PORT))
+    pid = os.fork()
+    if not pid:
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    server.server_close()
+    return pid
+
+def make_storage(name):
+    if name == 'filesystem':
+        from dbbackup.storage import filesystem_storage
+        return filesystem_storage.Storage()
+    if name == 's3':
+        from dbbackup.storage import s3_storage
+        return s3_storage.Storage()
+    if name == 'dropbox':
+        import fake_dropbox
+        from dbbackup.storage import dropbox_storage
+        fake_dropbox.install()
+        return dropbox_storage.Storage()
+    raise ValueError("Unknown storage: %s" % name)
+
+
+##################################
+#  Synthetic Databases
+##################################
+
+class PGDUMP_SETTINGS:
+    EXTENSION = 'psql'
+    BACKUP_COMMANDS = [['cat', '{databasename}', '>']]
+    RESTORE_COMMANDS = [['cat', '<']]
+
+def make_database(kind, size):
+    """ Create a kind database of about size bytes and return its settings. """
+    path = os.path.join(WORKDIR, '%s-%s' % (kind, size))
+    data = synthetic_dump(size)
+    if kind == 'sqlite':
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE dump (line TEXT)')
+        connection.executemany('INSERT INTO dump VALUES (?)', ((line,) for line in data.splitlines()))
+        connection.commit()
+        connection.close()
+    else:
+        with open(path, 'wb') as dumpfile:
+            dumpfile.write(data)
+    return {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path, 'USER': '', 'PASSWORD': '', 'PORT': ''}
+
+def make_dbcommands(kind, database, codec):
+    dbcommands = DBCommands(database, codec)
+    if kind == 'pgdump':
+        dbcommands.settings = PGDUMP_SETTINGS
+    return dbcommands
+
+
+##################################
+#  Benchmarked Steps
+##################################
+
+def bench_backup(storage, dbcommands, size):
+    """ Dump, spool and write a backup like dbbackup does. Returns its path. """
+    filename = dbcommands.filename()
+    with Measure('backup', size):
+        backupfile = utils.spool_chunks(dbcommands.stream_backup_commands(), filename)
+        storage.write_file(backupfile)
+        backupfile.close()
+    return os.path.join(storage.backup_dir(), filename)
+
+def bench_backup_stream(storage, dbcommands, size):
+    """ Dump and upload a backup concurrently like dbbackup --stream. """
+    filename = dbcommands.filename(servername='stream')
+    with Measure('backup --stream', size):
+        chunks = utils.buffered_chunks(dbcommands.stream_backup_commands(), 16*1024*1024, CHUNK_SIZE)
+        storage.write_stream(chunks, filename)
+    return os.path.join(storage.backup_dir(), filename)
+
+def bench_restore(storage, dbcommands, filepath, size, codec):
+    """ Download and load a backup like dbrestore does. """
+    with Measure('restore', size):
+        backupfile = storage.read_file(filepath)
+        dbcommands.run_restore_commands(backupfile, codec)
+        backupfile.close()
+
+def bench_restore_stream(storage, dbcommands, filepath, size, codec):
+    """ Load a backup while it downloads like dbrestore --stream. """
+    with Measure('restore --stream', size):
+        chunks = utils.buffered_chunks(storage.read_stream(filepath), 16*1024*1024, CHUNK_SIZE)
+        dbcommands.run_restore_commands(chunks, codec)
+
+def bench_listing_cleanup(storage, count):
+    """ List and delete count small backups. """
+    names = ['bench-%06d.psql' % index for index in xrange(count)]
+    for name in names:
+        storage.write_stream(['--\n'], name)
+    with Measure('listing', count=count):
+        filepaths = [path for path in storage.list_directory() if os.path.basename(path).startswith('bench-')]
+    assert len(filepaths) == count, "Listed %s of %s backups" % (len(filepaths), count)
+    with Measure('cleanup', count=count):
+        storage.delete_files(filepaths)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sizes", default="16,64", help="Comma separated dump sizes in MB")
+    parser.add_option("--dumps", default="sqlite,pgdump", help="sqlite and/or pgdump")
+    parser.add_option("--storages", default="filesystem,s3,dropbox")
+    parser.add_option("-z", "--compress", default=None, help="gzip, bz2 or lzma")
+    parser.add_option("--files", type="int", default=500, help="Backups to list and clean up")
+    options, args = parser.parse_args()
+    os.mkdir(settings.DBBACKUP_FILESYSTEM_DIRECTORY)
+    s3_pid = start_s3_server()
+    try:
+        storages = [(name, make_storage(name)) for name in options.storages.split(',')]
+        for kind in options.dumps.split(','):
+            for size in [int(size) * 1048576 for size in options.sizes.split(',')]:
+                database = make_database(kind, size)
+                dbsize = os.path.getsize(database['NAME'])
+                print "%s dump, %s%s" % (kind, utils.bytes_to_str(dbsize),
+                    ", %s" % options.compress if options.compress else "")
+                for name, storage in storages:
+                    print "  %s" % storage.name
+                    dbcommands = make_dbcommands(kind, database, options.compress)
+                    filepath = bench_backup(storage, dbcommands, dbsize)
+                    streampath = bench_backup_stream(storage, dbcommands, dbsize)
+                    restored = dict(database, NAME=database['NAME'] + '.restored')
+                    restorecommands = make_dbcommands(kind, restored, None)
+                    bench_restore(storage, restorecommands, filepath, dbsize, options.compress)
+                    bench_restore_stream(storage, restorecommands, streampath, dbsize, options.compress)
+                    if kind == 'sqlite':
+                        check = sqlite3.connect(restored['NAME'])
+                        assert check.execute('SELECT count(*) FROM dump').fetchone() == \
+                            sqlite3.connect(database['NAME']).execute('SELECT count(*) FROM dump').fetchone()
+                        check.close()
+                        os.unlink(restored['NAME'])
+                    storage.delete_files([filepath, streampath])
+                os.unlink(database['NAME'])
+        print "Listing and cleanup of %s backups" % options.files
+        for name, storage in storages:
+            print "  %s" % storage.name
+            bench_listing_cleanup(storage, options.files)
+    finally:
+        os.kill(s3_pid, signal.SIGTERM)
+        os.waitpid(s3_pid, 0)
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
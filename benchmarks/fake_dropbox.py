@@ -0,0 +1,164 @@
+"""
+In-memory stand-in for the Dropbox client used by the Dropbox storage.
+
+    >> from fake_dropbox import install
+    >> install()    # Storage() now talks to an in-memory FakeDropboxClient
+
+Only the calls the storage makes are implemented: metadata, get_file,
+put_file, file_delete, chunked upload sessions and ranged downloads. Set
+fail_every to make every Nth upload_chunk call or download drop the
+connection, to exercise resuming.
+"""
+import itertools, socket, threading
+from StringIO import StringIO
+from dropbox.rest import ErrorResponse
+
+
+class FakeResponse(StringIO):
+    """ File-like response with the status of a Dropbox HTTP response. """
+    status = 200
+    reason = ''
+
+    def getheaders(self):
+        return []
+
+
+class DroppedResponse(FakeResponse):
+    """ Response dropping the connection halfway through the body. """
+
+    def read(self, size=-1):
+        if self.tell() >= self.len // 2:
+            raise socket.error("Connection reset by peer")
+        return FakeResponse.read(self, min(size, self.len // 2 - self.tell()) if size >= 0 else self.len // 2)
+
+
+class FakeErrorResponse(ErrorResponse):
+    def __init__(self, status, body):
+        Exception.__init__(self, status, body)
+        self.status, self.body = status, body
+        self.reason, self.error_msg, self.user_error_msg, self.headers = '', '', '', []
+
+    def __str__(self):
+        return "[%s] %r" % (self.status, self.body)
+
+
+class FakeSession(object):
+    root = 'dropbox'
+
+
+class FakeConnection(object):
+    """ HTTP connection serving ranged GETs of the files of client. """
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, body=None, headers=None):
+        self.path = url.split('/files/dropbox', 1)[1]
+        self.headers = headers or {}
+
+    def getresponse(self):
+        return self.client.download(self.path, self.headers.get('Range'))
+
+
+class FakeRestClient(object):
+    def __init__(self, client):
+        self.client = client
+        self.IMPL = self
+        self.http_connect = lambda host, port: FakeConnection(client)
+
+    def POST(self, url, params, headers):
+        # Only used to commit chunked uploads
+        return self.client.commit(url.split('/dropbox', 1)[1], params['upload_id'])
+
+
+class FakeDropboxClient(object):
+    """ Dropbox client keeping files in a dict. """
+
+    def __init__(self, fail_every=0):
+        self.files = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.session = FakeSession()
+        self.rest_client = FakeRestClient(self)
+        self.counter = itertools.count(1)
+        self.fail_every = fail_every
+        self.metadata_calls = 0
+
+    def metadata(self, path):
+        with self.lock:
+            self.metadata_calls += 1
+            if path in self.files:
+                return {'path': path, 'is_dir': False, 'bytes': len(self.files[path])}
+            contents = [{'path': p, 'is_dir': False, 'bytes': len(d)}
+                for p, d in self.files.items() if p.startswith(path.rstrip('/') + '/')]
+        if not contents and not path.endswith('/'):
+            raise FakeErrorResponse(404, {'error': 'Path not found'})
+        return {'path': path, 'is_dir': True, 'contents': contents}
+
+    def get_file(self, path):
+        with self.lock:
+            if path not in self.files:
+                raise FakeErrorResponse(404, {'error': 'File not found'})
+            return FakeResponse(self.files[path])
+
+    def put_file(self, path, filehandle, overwrite=False):
+        with self.lock:
+            self.files[path] = filehandle.read()
+
+    def file_delete(self, path):
+        with self.lock:
+            if self.files.pop(path, None) is None:
+                raise FakeErrorResponse(404, {'error': 'File not found'})
+
+    def upload_chunk(self, filehandle, length, offset=0, upload_id=None):
+        data = filehandle.read(length)
+        with self.lock:
+            call = next(self.counter)
+            if upload_id is None:
+                upload_id = 'session-%s' % call
+                self.sessions[upload_id] = ''
+            received = self.sessions[upload_id]
+            if offset != len(received):
+                raise FakeErrorResponse(400, {'offset': len(received), 'upload_id': upload_id})
+            if self.fail_every and call % self.fail_every == 0:
+                # Store half of the data, then drop the connection
+                self.sessions[upload_id] += data[:len(data) // 2]
+                raise socket.error("Connection reset by peer")
+            self.sessions[upload_id] += data
+            return len(self.sessions[upload_id]), upload_id
+
+    def request(self, target, params=None, method='POST', content_server=False):
+        return 'https://api-content.dropbox.com/1' + target, params, {}
+
+    def download(self, path, range=None):
+        with self.lock:
+            call = next(self.counter)
+            if path not in self.files:
+                response = FakeResponse('{"error": "File not found"}')
+                response.status = 404
+                return response
+            data = self.files[path]
+        if range:
+            data = data[int(range.split('=')[1].rstrip('-')):]
+        response = DroppedResponse(data) if self.fail_every and call % self.fail_every == 0 else FakeResponse(data)
+        response.status = 206 if range else 200
+        return response
+
+    def commit(self, path, upload_id):
+        with self.lock:
+            self.files[path] = self.sessions.pop(upload_id)
+        return {'path': path}
+
+
+def install(client=None):
+    """ Make the Dropbox storage use client (a new FakeDropboxClient by
+        default) and return it.
+    """
+    from dbbackup.storage import dropbox_storage
+    client = client or FakeDropboxClient()
+    storage = dropbox_storage.Storage
+    storage.TOKENS_FILEPATH = storage.TOKENS_FILEPATH or '/dev/null'
+    storage.DBBACKUP_DROPBOX_APP_KEY = storage.DBBACKUP_DROPBOX_APP_KEY or 'key'
+    storage.DBBACKUP_DROPBOX_APP_SECRET = storage.DBBACKUP_DROPBOX_APP_SECRET or 'secret'
+    storage.get_dropbox_client = lambda self: client
+    return client
@@ -0,0 +1,159 @@
+"""
+Minimal in-memory S3 stand-in for exercising the S3 storage locally.
+
+    >> python benchmarks/s3server.py [--port 9000]
+
+Then point the S3 storage at it:
+
+    DBBACKUP_S3_DOMAIN = 'http://127.0.0.1:9000/'
+
+Only what the S3 storage uses is implemented: object PUT/GET (with Range)/
+HEAD/DELETE, bucket listing, multipart uploads and multi-object delete.
+Requests are not authenticated.
+"""
+import re, threading, urllib, urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    """ Serve the S3 REST API from S3Server.objects. """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        """ Return (bucket, key, query) for the request path. """
+        url = urlparse.urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        query = dict(urlparse.parse_qsl(url.query.replace(';', '&'), keep_blank_values=True))
+        return bucket, urllib.unquote(key), query
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def respond(self, code, data='', headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def not_found(self, key):
+        self.respond(404, '<Error><Code>NoSuchKey</Code><Message>%s</Message></Error>' % key)
+
+    def no_such_upload(self, upload_id):
+        self.respond(404, '<Error><Code>NoSuchUpload</Code><Message>%s</Message></Error>' % upload_id)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        server = self.server
+        if not key:
+            prefix, marker = query.get('prefix', ''), query.get('marker', '')
+            with server.lock:
+                keys = sorted(k for k in server.objects if k.startswith(prefix) and k > marker)
+                keys = keys[:int(query.get('max-keys', 1000))]
+                contents = ''.join(('<Contents><Key>%s</Key><LastModified>2013-01-01T00:00:00.000Z'
+                    '</LastModified><ETag>&quot;%s&quot;</ETag><Size>%s</Size><Owner></Owner>'
+                    '</Contents>') % (k, hash(server.objects[k]), len(server.objects[k])) for k in keys)
+            return self.respond(200, '<ListBucketResult>%s</ListBucketResult>' % contents)
+        with server.lock:
+            data = server.objects.get(key)
+        if data is None:
+            return self.not_found(key)
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            return self.respond(206, data[start:end + 1])
+        self.respond(200, data)
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        server = self.server
+        data = self.body()
+        if 'uploadId' in query:
+            with server.lock:
+                if query['uploadId'] not in server.uploads:
+                    return self.no_such_upload(query['uploadId'])
+                server.uploads[query['uploadId']][int(query['partNumber'])] = data
+            return self.respond(200, headers={'ETag': '"%s"' % hash(data)})
+        with server.lock:
+            server.objects[key] = data
+        self.respond(200)
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        server = self.server
+        data = self.body()
+        if 'uploads' in query:
+            with server.lock:
+                server.upload_count += 1
+                upload_id = 'upload-%s' % server.upload_count
+                server.uploads[upload_id] = {}
+            return self.respond(200, '<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                '</InitiateMultipartUploadResult>' % upload_id)
+        if 'uploadId' in query:
+            numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)</PartNumber>', data)]
+            with server.lock:
+                if query['uploadId'] not in server.uploads:
+                    return self.no_such_upload(query['uploadId'])
+                parts = server.uploads.pop(query['uploadId'])
+                server.objects[key] = ''.join(parts[n] for n in numbers)
+            return self.respond(200, '<CompleteMultipartUploadResult></CompleteMultipartUploadResult>')
+        if 'delete' in query:
+            keys = re.findall(r'<Key>(.+?)</Key>', data)
+            with server.lock:
+                for k in keys:
+                    server.objects.pop(k, None)
+            deleted = ''.join('<Deleted><Key>%s</Key></Deleted>' % k for k in keys)
+            return self.respond(200, '<DeleteResult>%s</DeleteResult>' % deleted)
+        self.respond(400)
+
+    def do_DELETE(self):
+        bucket, key, query = self.parse()
+        server = self.server
+        with server.lock:
+            if 'uploadId' in query:
+                server.uploads.pop(query['uploadId'], None)
+            elif server.objects.pop(key, None) is None:
+                return self.not_found(key)
+        self.respond(204)
+
+
+class S3Server(ThreadingMixIn, HTTPServer):
+    """ Threaded HTTP server holding the objects of a single bucket. """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, S3Handler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.upload_count = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self.server_address
+
+    def start(self):
+        """ Serve requests on a background thread. """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--port", type="int", default=9000)
+    options, args = parser.parse_args()
+    server = S3Server(('127.0.0.1', options.port))
+    print "S3 stand-in listening on %s" % server.url
+    server.serve_forever()
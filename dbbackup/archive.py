@@ -0,0 +1,228 @@
+"""
+Continuous archiving of the PostgreSQL WAL segments and MySQL binary logs,
+and point-in-time recovery from a base backup and the archived logs.
+
+Archived logs are stored next to the backups as
+<databasename>-<servername>.<logname>.<extension>[.<codec>], one file per
+log, written once and never modified.
+"""
+import hashlib, os, re, sys
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import CommandError
+from . import compression, utils
+from .dbcommands import COMPRESSION, COMPRESSION_LEVEL, SERVER_NAME
+from .storage.base import StorageError
+
+ARCHIVE_COMPRESSION = getattr(settings, 'DBBACKUP_ARCHIVE_COMPRESSION', COMPRESSION)
+ARCHIVE_FETCH_COMMAND = getattr(settings, 'DBBACKUP_ARCHIVE_FETCH_COMMAND', None)
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+POSITION_HEAD_SIZE = 1024*1024
+
+# The binlog position mysqldump --master-data writes at the top of the dump
+MYSQL_POSITION = re.compile(r"(?:MASTER|SOURCE)_LOG_FILE='([^']+)',\s*(?:MASTER|SOURCE)_LOG_POS=(\d+)")
+
+
+##################################
+#  Settings
+##################################
+
+def supported(dbcommands):
+    return getattr(dbcommands.settings, 'BASE_BACKUP_COMMANDS', None) is not None
+
+def check_supported(dbcommands):
+    if not supported(dbcommands):
+        raise CommandError("Point-in-time recovery is not supported for %s databases" % dbcommands.engine)
+
+def base_settings(engine_settings):
+    """ Return the settings of the base backups of an engine: its backup
+        settings with the BASE_* commands and extension.
+    """
+    class BASE_SETTINGS(engine_settings):
+        EXTENSION = engine_settings.BASE_EXTENSION
+        BACKUP_COMMANDS = engine_settings.BASE_BACKUP_COMMANDS
+        RESTORE_COMMANDS = engine_settings.BASE_RESTORE_COMMANDS
+    return BASE_SETTINGS
+
+def parse_time(value):
+    """ Return the datetime of a --to-time value, in local time. """
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise CommandError("Invalid time '%s', use 'YYYY-MM-DD HH:MM:SS'" % value)
+
+def fetch_command(database_key, servername=None):
+    """ Return the command PostgreSQL runs to fetch an archived segment
+        during recovery (%f and %p are filled in by PostgreSQL).
+    """
+    if ARCHIVE_FETCH_COMMAND:
+        return ARCHIVE_FETCH_COMMAND
+    command = '"%s" "%s" dbarchive -d %s' % (sys.executable, os.path.abspath(sys.argv[0]), database_key)
+    if servername:
+        command += ' -s %s' % servername
+    return command + ' --fetch %f "%p"'
+
+
+##################################
+#  Archived Logs
+##################################
+
+def log_prefix(dbcommands, servername=None):
+    parts = [dbcommands.database['NAME'].replace('/', '_'), servername or SERVER_NAME]
+    return '-'.join(filter(None, parts)) + '.'
+
+def log_filename(dbcommands, logname, servername=None, codec=None):
+    """ Return the stored name of an archived log. """
+    name = '%s%s.%s' % (log_prefix(dbcommands, servername), logname, dbcommands.settings.ARCHIVE_EXTENSION)
+    if codec:
+        name += '.' + compression.extension(codec)
+    return name
+
+def list_logs(storage, dbcommands, servername=None):
+    """ Return the sorted (logname, filepath, codec) of the archived logs. """
+    suffixes = sorted(re.escape(ext) for ext, compressor, decompressor in compression.CODECS.values())
+    regex = re.compile(r'%s(?P<log>.+)\.%s(?:\.(?:%s))?$' % (re.escape(log_prefix(dbcommands, servername)),
+        re.escape(dbcommands.settings.ARCHIVE_EXTENSION), '|'.join(suffixes)))
+    logs = []
+    for filepath in storage.list_directory():
+        match = regex.match(os.path.basename(filepath))
+        if match:
+            logs.append((match.group('log'), filepath, compression.codec_for_filename(filepath)))
+    return sorted(logs)
+
+def find_log(storage, dbcommands, logname, servername=None):
+    """ Return (filepath, codec) of an archived log, or (None, None). The
+        configured codec is tried first, so no listing is needed.
+    """
+    codecs = [ARCHIVE_COMPRESSION, None] + sorted(compression.CODECS)
+    for codec in sorted(set(codecs), key=codecs.index):
+        filepath = os.path.join(storage.backup_dir(), log_filename(dbcommands, logname, servername, codec))
+        try:
+            storage.file_size(filepath)
+        except StorageError:
+            continue
+        return filepath, codec
+    return None, None
+
+def file_digest(chunks):
+    digest = hashlib.sha256()
+    for data in chunks:
+        digest.update(data)
+    return digest.hexdigest()
+
+def archive_log(storage, dbcommands, path, servername=None, codec=ARCHIVE_COMPRESSION):
+    """ Store the log at path unless it is archived already. A log archived
+        with other contents is an error, as PostgreSQL requires of an
+        archive_command. Returns True if the log was stored.
+    """
+    logname = os.path.basename(path)
+    filepath, stored_codec = find_log(storage, dbcommands, logname, servername)
+    if filepath:
+        chunks = storage.read_stream(filepath)
+        if stored_codec:
+            chunks = compression.decompress_chunks(chunks, stored_codec)
+        with open(path, 'rb') as logfile:
+            if file_digest(chunks) != file_digest(utils.iter_chunks(logfile, 1024*1024)):
+                raise CommandError("%s is archived with different contents: %s" % (logname, filepath))
+        print "  Already archived: %s" % logname
+        return False
+    name = log_filename(dbcommands, logname, servername, codec)
+    print "  Archiving: %s to %s" % (path, name)
+    with open(path, 'rb') as logfile:
+        chunks = utils.iter_chunks(logfile, 1024*1024)
+        if codec:
+            chunks = compression.compress_chunks(chunks, codec, COMPRESSION_LEVEL)
+        storage.write_stream(chunks, name)
+    return True
+
+def fetch_log(storage, dbcommands, logname, path, servername=None):
+    """ Download the archived log to path. Returns False if it is not in the
+        archive, which ends a PostgreSQL recovery.
+    """
+    filepath, codec = find_log(storage, dbcommands, logname, servername)
+    if not filepath:
+        print "  Not in the archive: %s" % logname
+        return False
+    chunks = storage.read_stream(filepath)
+    if codec:
+        chunks = compression.decompress_chunks(chunks, codec)
+    # Renamed into place once complete, recovery must not see a partial file
+    partial = path + '.partial'
+    with open(partial, 'wb') as logfile:
+        for data in chunks:
+            logfile.write(data)
+    os.rename(partial, path)
+    print "  Fetched: %s" % logname
+    return True
+
+def closed_logs(index_path):
+    """ Return the paths of the logs listed in a MySQL binlog index, but the
+        last one which the server is still writing.
+    """
+    directory = os.path.dirname(index_path)
+    with open(index_path) as index_file:
+        logs = [line.strip() for line in index_file if line.strip()]
+    return [os.path.normpath(os.path.join(directory, log)) for log in logs[:-1]]
+
+
+##################################
+#  Recovery
+##################################
+
+def find_base_backup(storage, dbcommands, to_time, servername=None):
+    """ Return the filepath of the latest base backup taken before to_time,
+        or None.
+    """
+    parser = dbcommands.filename_parser(servername)
+    backups = [backup for backup in filter(None, map(parser.parse, storage.list_directory()))
+        if backup.datetime and backup.datetime <= to_time]
+    return max(backups, key=lambda backup: backup.datetime).filepath if backups else None
+
+def binlog_position(backupfile, codec=None):
+    """ Return the (binlog, position) recorded at the top of a MySQL base
+        backup.
+    """
+    backupfile.seek(0)
+    chunks = utils.iter_chunks(backupfile, 64*1024)
+    if codec:
+        chunks = compression.decompress_chunks(chunks, codec)
+    head = ''
+    for data in chunks:
+        head += data
+        if len(head) >= POSITION_HEAD_SIZE:
+            break
+    backupfile.seek(0)
+    match = MYSQL_POSITION.search(head)
+    if not match:
+        raise CommandError("No binlog position in the base backup, was it taken with dbbackup --base?")
+    return match.group(1), int(match.group(2))
+
+def replay_logs(storage, dbcommands, position, servername=None):
+    """ Replay the archived binlogs from the (binlog, position) of the base
+        backup: the output of the REPLAY_COMMANDS is loaded with the
+        REPLAY_LOAD_COMMANDS. The binlogs are downloaded to the scratch
+        directory of the commands first.
+    """
+    start_log, start_position = position
+    logs = [log for log in list_logs(storage, dbcommands, servername) if log[0] >= start_log]
+    if not logs or logs[0][0] != start_log:
+        raise CommandError("Binlog %s of the base backup is not in the archive" % start_log)
+    print "  Replaying %s binlogs from %s:%s" % (len(logs), start_log, start_position)
+    logdir = os.path.join(dbcommands.tempdir, 'logs')
+    os.mkdir(logdir)
+    paths = []
+    for logname, filepath, codec in logs:
+        path = os.path.join(logdir, logname)
+        if not fetch_log(storage, dbcommands, logname, path, servername):
+            raise CommandError("Binlog %s is no longer in the archive" % logname)
+        paths.append(path)
+    dbcommands.variables['startposition'] = str(start_position)
+    commands = []
+    for command in dbcommands.settings.REPLAY_COMMANDS:
+        if '{logfiles}' in command:
+            index = command.index('{logfiles}')
+            command = command[:index] + paths + command[index + 1:]
+        commands.append(command)
+    dbcommands.run_restore_commands(dbcommands.stream_commands(commands), commands=dbcommands.settings.REPLAY_LOAD_COMMANDS)
@@ -0,0 +1,211 @@
+"""
+Catalog of the stored backups, kept in an index file next to the backups so
+the latest backup or the retention candidates of a database can be found
+without listing the storage.
+"""
+import json, os, random, threading, time
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from django.conf import settings
+from .dbcommands import SERVER_NAME
+from .dedup import LOCK_POLL, active_locks, storage_lock
+from .storage.base import StorageError
+
+CATALOG = getattr(settings, 'DBBACKUP_CATALOG', True)
+CATALOG_NAME = getattr(settings, 'DBBACKUP_CATALOG_NAME', 'dbbackup-catalog.json')
+CATALOG_REINDEX = getattr(settings, 'DBBACKUP_CATALOG_REINDEX', 24 * 3600)
+CATALOG_LOCK_TIMEOUT = 600
+CATALOG_VERSION = 2
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Catalog(object):
+    """ Sorted index of (database, servername, timestamp, filepath, size,
+        codec, checksum) entries. A (database, servername) pair is indexed
+        from a directory listing the first time it is queried, and again
+        once the listing is older than CATALOG_REINDEX; in between the
+        catalog is kept up to date as backups are added and deleted.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()
+        self.entries = None
+        self.pending = None
+        self.indexed = {}
+        self.added, self.removed = {}, set()
+
+    @property
+    def path(self):
+        return os.path.join(self.storage.backup_dir(), CATALOG_NAME)
+
+    def key(self, database, servername):
+        return (database['NAME'], servername or SERVER_NAME)
+
+    ###################################
+    #  Persistence
+    ###################################
+
+    def read(self):
+        """ Return the stored (entries, indexed), empty if not created yet.
+            indexed maps each (database, servername) to the time of its
+            last listing.
+        """
+        try:
+            data = json.loads(''.join(self.storage.read_stream(self.path)))
+        except (StorageError, ValueError):
+            return [], {}
+        if data.get('version') not in (1, CATALOG_VERSION):
+            return [], {}
+        entries = sorted(tuple(entry) for entry in data['entries'])
+        # Version 1 kept no listing times
+        indexed = dict((tuple(key[:2]), key[2] if len(key) > 2 else 0) for key in data['indexed'])
+        return entries, indexed
+
+    def prefetch(self):
+        """ Start reading the catalog in the background. """
+        with self.lock:
+            if self.entries is None and self.pending is None:
+                self.pending = self.storage.submit(self.read)
+
+    def load(self):
+        with self.lock:
+            if self.entries is None and self.pending is not None:
+                self.entries, self.indexed = self.pending.get()
+            elif self.entries is None:
+                self.entries, self.indexed = self.read()
+            return self.entries
+
+    @contextmanager
+    def locked(self):
+        """ Hold the catalog lock against other processes. Each process
+            writes its lock file before looking for the others, so two
+            processes cannot both find themselves alone; a process that is
+            not alone removes its lock file and tries again a little later.
+        """
+        waiting = False
+        while True:
+            with storage_lock(self.storage, 'catalog') as name:
+                others = [path for path in active_locks(self.storage, 'catalog', CATALOG_LOCK_TIMEOUT)
+                          if os.path.basename(path) != name]
+                if not others:
+                    yield
+                    return
+            if not waiting:
+                print "  Waiting for the catalog lock of another process"
+                waiting = True
+            time.sleep(random.uniform(0, 2 * LOCK_POLL))
+
+    def save(self):
+        """ Write the catalog under the catalog lock, merging in the changes
+            other processes saved since it was loaded.
+        """
+        with self.lock:
+            with self.locked():
+                entries, indexed = self.read()
+                entries = [entry for entry in entries if entry[3] not in self.removed and entry[3] not in self.added]
+                entries = sorted(entries + self.added.values())
+                for key, listed in indexed.items():
+                    self.indexed[key] = max(listed, self.indexed.get(key, 0))
+                self.entries = entries
+                data = {'version': CATALOG_VERSION, 'entries': entries,
+                        'indexed': sorted(key + (listed,) for key, listed in self.indexed.items())}
+                self.storage.write_stream([json.dumps(data, separators=(',', ':'))], CATALOG_NAME)
+
+    ###################################
+    #  Updates
+    ###################################
+
+    def add(self, database, servername, timestamp, filepath, size=None, codec=None, checksum=None):
+        """ Record a new backup and save the catalog. """
+        database, servername = self.key(database, servername)
+        timestamp = timestamp.strftime(TIMESTAMP_FORMAT) if timestamp else ''
+        entry = (database, servername, timestamp, filepath, size, codec, checksum)
+        with self.lock:
+            self.load()
+            self.entries = [e for e in self.entries if e[3] != filepath]
+            insort(self.entries, entry)
+            self.added[filepath] = entry
+            self.removed.discard(filepath)
+            self.save()
+
+    def remove(self, filepaths):
+        """ Forget the deleted filepaths and save the catalog. """
+        if not filepaths:
+            return
+        filepaths = set(filepaths)
+        with self.lock:
+            self.load()
+            self.entries = [entry for entry in self.entries if entry[3] not in filepaths]
+            for filepath in filepaths:
+                self.added.pop(filepath, None)
+            self.removed |= filepaths
+            self.save()
+
+    def index(self, dbcommands, servername=None):
+        """ Sync the backups of a database with a listing, unless it was
+            listed less than CATALOG_REINDEX ago. Backups written or deleted
+            without the catalog (ie: by other tools) are picked up here.
+        """
+        key = self.key(dbcommands.database, servername)
+        with self.lock:
+            self.load()
+            listed = self.indexed.get(key)
+            if listed is not None and (CATALOG_REINDEX is None or time.time() - listed < CATALOG_REINDEX):
+                return
+            print "  Indexing backups of %s in the catalog" % key[0]
+            parser = dbcommands.filename_parser(servername)
+            backups = filter(None, map(parser.parse, self.storage.list_directory()))
+            stored = set(os.path.basename(backup.filepath) for backup in backups)
+            known = set(os.path.basename(entry[3]) for entry in self.entries)
+            for entry in self.backups(dbcommands.database, servername):
+                if os.path.basename(entry[3]) not in stored:
+                    self.entries.remove(entry)
+                    self.added.pop(entry[3], None)
+                    self.removed.add(entry[3])
+            for backup in backups:
+                if os.path.basename(backup.filepath) not in known:
+                    timestamp = backup.datetime.strftime(TIMESTAMP_FORMAT) if backup.datetime else ''
+                    entry = key + (timestamp, backup.filepath, None, backup.codec, None)
+                    insort(self.entries, entry)
+                    self.added[backup.filepath] = entry
+            self.indexed[key] = time.time()
+            self.save()
+
+    ###################################
+    #  Queries
+    ###################################
+
+    def backups(self, database, servername=None):
+        """ Return the entries of a database, oldest first. """
+        database, servername = self.key(database, servername)
+        with self.lock:
+            entries = self.load()
+            start = bisect_left(entries, (database, servername))
+            end = bisect_left(entries, (database, servername + '\0'))
+            return entries[start:end]
+
+    def find(self, filepath):
+        """ Return the entry of filepath, or None. A path written another
+            way (ie: relative) is matched by its filename.
+        """
+        filename = os.path.basename(filepath)
+        with self.lock:
+            entries = self.load()
+            for entry in entries:
+                if entry[3] == filepath:
+                    return entry
+            for entry in entries:
+                if os.path.basename(entry[3]) == filename:
+                    return entry
+        return None
+
+    def latest(self, database, servername=None, parser=None):
+        """ Return the filepath of the latest backup of a database, or None.
+            If parser is given only the backups it matches are considered,
+            so backups in other formats are skipped.
+        """
+        entries = self.backups(database, servername)
+        if parser:
+            entries = [entry for entry in entries if parser.match(entry[3])]
+        return entries[-1][3] if entries else None
@@ -0,0 +1,75 @@
+"""
+Local checkpoint journals, so an interrupted transfer can be resumed with
+--resume instead of starting over.
+"""
+import hashlib, json, os, tempfile, threading
+from django.conf import settings
+
+CHECKPOINT_DIRECTORY = getattr(settings, 'DBBACKUP_CHECKPOINT_DIRECTORY',
+    os.path.join(tempfile.gettempdir(), 'dbbackup-checkpoints'))
+
+
+class Journal(object):
+    """ JSON state of one transfer, saved to CHECKPOINT_DIRECTORY after
+        every completed part. Storages keep their own progress in a
+        section of the journal.
+    """
+
+    def __init__(self, *key):
+        if not os.path.isdir(CHECKPOINT_DIRECTORY):
+            os.makedirs(CHECKPOINT_DIRECTORY)
+        digest = hashlib.sha1('\0'.join(key)).hexdigest()
+        self.path = os.path.join(CHECKPOINT_DIRECTORY, '%s.json' % digest)
+        # Staged files of this transfer live next to the journal
+        self.staging = os.path.join(CHECKPOINT_DIRECTORY, digest)
+        self.lock = threading.RLock()
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal:
+                try:
+                    self.state = json.load(journal)
+                except ValueError:
+                    self.state = {}
+
+    def save(self):
+        """ Replace the journal atomically. """
+        with self.lock:
+            partialpath = self.path + '.partial'
+            with open(partialpath, 'wb') as journal:
+                json.dump(self.state, journal)
+            os.rename(partialpath, self.path)
+
+    def update(self, **values):
+        with self.lock:
+            self.state.update(values)
+            self.save()
+
+    def section(self, name):
+        return JournalSection(self, name)
+
+    def remove(self):
+        """ Forget the transfer once it completed. """
+        for path in (self.path, self.staging):
+            if os.path.exists(path):
+                os.unlink(path)
+        self.state.clear()
+
+
+class JournalSection(object):
+    """ Part of a journal holding the progress of a single storage. """
+
+    def __init__(self, journal, name):
+        self.journal = journal
+        self.lock = journal.lock
+        self.state = journal.state.setdefault(name, {})
+
+    def save(self):
+        self.journal.save()
+
+    def update(self, **values):
+        with self.lock:
+            self.state.update(values)
+            self.save()
+
+    def section(self, name):
+        return JournalSection(self, name)
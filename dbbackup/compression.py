@@ -0,0 +1,129 @@
+"""
+Streaming compression codecs for backup files.
+"""
+import bz2, zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from django.core.management.base import CommandError
+from . import utils
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+##################################
+#  Codecs
+##################################
+
+def gzip_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def lzma_compressor(level):
+    return lzma.LZMACompressor(preset=level)
+
+# Codec name: (filename extension, compressor(level), decompressor())
+CODECS = {
+    'gzip': ('gz', gzip_compressor, gzip_decompressor),
+    'bz2': ('bz2', bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+if lzma:
+    CODECS['lzma'] = ('xz', lzma_compressor, lzma.LZMADecompressor)
+
+
+def check_codec(codec):
+    """ Raise a CommandError if codec is not available. """
+    if codec not in CODECS:
+        raise CommandError("Unknown compression codec '%s', choose from: %s" % (
+            codec, ', '.join(sorted(CODECS))))
+
+def extension(codec):
+    """ Return the filename extension used for codec. """
+    check_codec(codec)
+    return CODECS[codec][0]
+
+def codec_for_filename(filepath):
+    """ Return the codec a backup file was compressed with, or None. """
+    for codec, (ext, compressor, decompressor) in CODECS.iteritems():
+        if filepath.endswith('.' + ext):
+            return codec
+    return None
+
+
+##################################
+#  Streaming (De)Compression
+##################################
+
+def compress_chunks(chunks, codec, level):
+    """ Compress an iterable of chunks, yielding compressed chunks. """
+    check_codec(codec)
+    compressor = CODECS[codec][1](level)
+    for data in chunks:
+        data = compressor.compress(data)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def decompress_chunks(chunks, codec):
+    """ Decompress an iterable of chunks, yielding decompressed chunks.
+        Concatenated compressed streams (ie: multi-member gzip) are supported.
+    """
+    check_codec(codec)
+    new_decompressor = CODECS[codec][2]
+    decompressor = new_decompressor()
+    for data in chunks:
+        while data:
+            try:
+                output = decompressor.decompress(data)
+            except EOFError:
+                # bz2 refuses data past the end of a stream, start a new one
+                decompressor = new_decompressor()
+                continue
+            if output:
+                yield output
+            data = getattr(decompressor, 'unused_data', '')
+            if data:
+                decompressor = new_decompressor()
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+##################################
+#  Block-Parallel Compression
+##################################
+
+def compress_block(block, codec, level):
+    """ Compress block as a complete, independent stream. """
+    compressor = CODECS[codec][1](level)
+    return compressor.compress(block) + compressor.flush()
+
+def parallel_compress_chunks(chunks, codec, level, workers, block_size):
+    """ Compress an iterable of chunks like pigz: the input is split into
+        blocks of block_size bytes which are compressed as independent
+        streams on a pool of threads and yielded in order. Concatenated
+        streams are still a valid gzip, bz2 or xz file. zlib, bz2 and lzma
+        release the GIL while compressing, so this scales with cores.
+    """
+    check_codec(codec)
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for block in utils.regroup_chunks(chunks, block_size):
+            pending.append(pool.apply_async(compress_block, (block, codec, level)))
+            # Keep a couple of blocks per worker in flight to bound memory
+            if len(pending) > workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,19 +1,39 @@
 """
 Process the Backup or Restore commands.
 """
-import copy, os, re, shlex
+import copy, errno, os, re, shlex, tarfile, tempfile
 from datetime import datetime
+from multiprocessing import cpu_count
 from django.conf import settings
 from django.core.management.base import CommandError
-from subprocess import Popen
-from shutil import copyfileobj
+from subprocess import Popen, PIPE
+from shutil import copyfileobj, rmtree
+from . import compression, filenames, metrics, postgresql, serializer, sqlite, throttle, utils
 
 
 READ_FILE = '<READ_FILE>'
 WRITE_FILE = '<WRITE_FILE>'
+READ_DIRECTORY = '<READ_DIRECTORY>'
+WRITE_DIRECTORY = '<WRITE_DIRECTORY>'
+SQLITE_BACKUP = '<SQLITE_BACKUP>'
+SQLITE_RESTORE = '<SQLITE_RESTORE>'
+SQLITE_TABLE_BACKUP = '<SQLITE_TABLE_BACKUP>'
+SQLITE_TABLE_RESTORE = '<SQLITE_TABLE_RESTORE>'
+SERIALIZER_BACKUP = '<SERIALIZER_BACKUP>'
+SERIALIZER_RESTORE = '<SERIALIZER_RESTORE>'
+POSTGRESQL_RECOVERY = '<POSTGRESQL_RECOVERY>'
 DATE_FORMAT = getattr(settings, 'DBBACKUP_DATE_FORMAT', '%Y-%m-%d-%H%M%S')
 SERVER_NAME = getattr(settings, 'DBBACKUP_SERVER_NAME', '')
 FILENAME_TEMPLATE = getattr(settings, 'DBBACKUP_FILENAME_TEMPLATE', '{databasename}-{servername}-{datetime}.{extension}')
+STREAMING = getattr(settings, 'DBBACKUP_STREAMING', False)
+STREAM_CHUNK_SIZE = getattr(settings, 'DBBACKUP_STREAM_CHUNK_SIZE', 64*1024)
+STREAM_BUFFER_SIZE = getattr(settings, 'DBBACKUP_STREAM_BUFFER_SIZE', 16*1024*1024)
+COMPRESSION = getattr(settings, 'DBBACKUP_COMPRESSION', None)
+COMPRESSION_LEVEL = getattr(settings, 'DBBACKUP_COMPRESSION_LEVEL', 6)
+COMPRESSION_WORKERS = getattr(settings, 'DBBACKUP_COMPRESSION_WORKERS', 1)
+COMPRESSION_BLOCK_SIZE = getattr(settings, 'DBBACKUP_COMPRESSION_BLOCK_SIZE', 1024*1024)
+DEDUPLICATE = getattr(settings, 'DBBACKUP_DEDUPLICATE', False)
+SERIALIZE = getattr(settings, 'DBBACKUP_SERIALIZE', False)
 
 
 ##################################
@@ -28,6 +48,32 @@ class MYSQL_SETTINGS:
     RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_RESTORE_COMMANDS', [
         shlex.split('mysql -u{adminuser} -p{password} {databasename} <'),
     ])
+    TABLE_EXTENSION = getattr(settings, 'DBBACKUP_MYSQL_TABLE_EXTENSION', 'mysql')
+    TABLE_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_TABLE_BACKUP_COMMANDS', [
+        shlex.split('mysqldump -u{adminuser} -p{password} {databasename} {tablename} >'),
+    ])
+    TABLE_CLEAR_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_TABLE_CLEAR_COMMANDS', [])
+    TABLE_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_TABLE_RESTORE_COMMANDS', [
+        shlex.split('mysql -u{adminuser} -p{password} {databasename} <'),
+    ])
+    # Point-in-time recovery from a base backup and the archived binlogs
+    BASE_EXTENSION = getattr(settings, 'DBBACKUP_MYSQL_BASE_EXTENSION', 'base.mysql')
+    BASE_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_BASE_BACKUP_COMMANDS', [
+        shlex.split('mysqldump -u{adminuser} -p{password} --single-transaction --flush-logs --master-data=2 {databasename} >'),
+    ])
+    BASE_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_BASE_RESTORE_COMMANDS', RESTORE_COMMANDS)
+    ARCHIVE_EXTENSION = getattr(settings, 'DBBACKUP_MYSQL_ARCHIVE_EXTENSION', 'binlog')
+    ARCHIVE_INDEX = getattr(settings, 'DBBACKUP_MYSQL_BINLOG_INDEX', None)
+    FLUSH_LOGS_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_FLUSH_LOGS_COMMANDS', [
+        shlex.split('mysqladmin -u{adminuser} -p{password} flush-logs'),
+    ])
+    REPLAY_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_REPLAY_COMMANDS', [
+        ['mysqlbinlog', '--database={databasename}', '--start-position={startposition}',
+            '--stop-datetime={totime}', '{logfiles}', '>'],
+    ])
+    REPLAY_LOAD_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_REPLAY_LOAD_COMMANDS', [
+        shlex.split('mysql -u{adminuser} -p{password} {databasename} <'),
+    ])
 
 
 ##################################
@@ -44,6 +90,70 @@ class POSTGRESQL_SETTINGS:
         shlex.split('createdb -p {port} -U {adminuser} {databasename} --owner={username}'),
         shlex.split('psql -p {port} -U {adminuser} -1 {databasename} <'),
     ])
+    TABLE_EXTENSION = getattr(settings, 'DBBACKUP_POSTGRESQL_TABLE_EXTENSION', 'psql')
+    TABLE_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_TABLE_BACKUP_COMMANDS', [
+        shlex.split('pg_dump -p {port} -U {adminuser} --data-only -t \'"{tablename}"\' {databasename} >'),
+    ])
+    TABLE_CLEAR_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_TABLE_CLEAR_COMMANDS', [
+        shlex.split('psql -p {port} -U {adminuser} -c \'DELETE FROM "{tablename}"\' {databasename}'),
+    ])
+    TABLE_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_TABLE_RESTORE_COMMANDS', [
+        shlex.split('psql -p {port} -U {adminuser} -1 {databasename} <'),
+    ])
+    # Point-in-time recovery from a base backup of the cluster and the archived WAL
+    DATA_DIRECTORY = getattr(settings, 'DBBACKUP_POSTGRESQL_DATA_DIRECTORY', None)
+    BASE_EXTENSION = getattr(settings, 'DBBACKUP_POSTGRESQL_BASE_EXTENSION', 'base.tar')
+    BASE_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_BASE_BACKUP_COMMANDS', [
+        shlex.split('pg_basebackup -p {port} -U {adminuser} -D - -F tar -X none >'),
+    ])
+    BASE_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_BASE_RESTORE_COMMANDS', [
+        shlex.split('pg_ctl -D {datadir} stop -m fast'),
+        shlex.split('mv -T {datadir} {datadir}.old'),
+        [WRITE_DIRECTORY, '{datadir}'],
+        shlex.split('chmod 700 {datadir}'),
+        [POSTGRESQL_RECOVERY, '{datadir}', '{totime}', '{fetchcommand}'],
+        shlex.split('pg_ctl -D {datadir} -l {datadir}/recovery.log start -w -t 86400'),
+    ])
+    ARCHIVE_EXTENSION = getattr(settings, 'DBBACKUP_POSTGRESQL_ARCHIVE_EXTENSION', 'wal')
+    ARCHIVE_INDEX = None
+    FLUSH_LOGS_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_FLUSH_LOGS_COMMANDS', [
+        shlex.split('psql -p {port} -U {adminuser} -c \'SELECT pg_switch_wal()\' {databasename}'),
+    ])
+
+
+class POSTGRESQL_DIRECTORY_SETTINGS:
+    """ Parallel pg_dump/pg_restore using the directory format. The dump
+        directory is stored as a single (streamed) tar archive.
+    """
+    EXTENSION = getattr(settings, 'DBBACKUP_POSTGRESQL_DIRECTORY_EXTENSION', 'psql.tar')
+    JOBS = getattr(settings, 'DBBACKUP_POSTGRESQL_JOBS', cpu_count())
+    BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_DIRECTORY_BACKUP_COMMANDS', [
+        shlex.split('pg_dump -p {port} -U {adminuser} -Fd -j {jobs} -f {tempdir}/dump {databasename}'),
+        [READ_DIRECTORY, '{tempdir}/dump'],
+    ])
+    # The dump is extracted and its table of contents read before the
+    # database is dropped, so a corrupt backup leaves the database alone
+    RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_DIRECTORY_RESTORE_COMMANDS', [
+        [WRITE_DIRECTORY, '{tempdir}/dump'],
+        shlex.split('pg_restore -l {tempdir}/dump'),
+        shlex.split('dropdb -p {port} -U {adminuser} {databasename}'),
+        shlex.split('createdb -p {port} -U {adminuser} {databasename} --owner={username}'),
+        shlex.split('pg_restore -p {port} -U {adminuser} -j {jobs} -d {databasename} {tempdir}/dump'),
+    ])
+    # Single tables are dumped in the plain format
+    TABLE_EXTENSION = POSTGRESQL_SETTINGS.TABLE_EXTENSION
+    TABLE_BACKUP_COMMANDS = POSTGRESQL_SETTINGS.TABLE_BACKUP_COMMANDS
+    TABLE_CLEAR_COMMANDS = POSTGRESQL_SETTINGS.TABLE_CLEAR_COMMANDS
+    TABLE_RESTORE_COMMANDS = POSTGRESQL_SETTINGS.TABLE_RESTORE_COMMANDS
+    DATA_DIRECTORY = POSTGRESQL_SETTINGS.DATA_DIRECTORY
+    BASE_EXTENSION = POSTGRESQL_SETTINGS.BASE_EXTENSION
+    BASE_BACKUP_COMMANDS = POSTGRESQL_SETTINGS.BASE_BACKUP_COMMANDS
+    BASE_RESTORE_COMMANDS = POSTGRESQL_SETTINGS.BASE_RESTORE_COMMANDS
+    ARCHIVE_EXTENSION = POSTGRESQL_SETTINGS.ARCHIVE_EXTENSION
+    ARCHIVE_INDEX = POSTGRESQL_SETTINGS.ARCHIVE_INDEX
+    FLUSH_LOGS_COMMANDS = POSTGRESQL_SETTINGS.FLUSH_LOGS_COMMANDS
+
+POSTGRESQL_FORMAT = getattr(settings, 'DBBACKUP_POSTGRESQL_FORMAT', 'plain')
 
 
 ##################################
@@ -53,11 +163,36 @@ class POSTGRESQL_SETTINGS:
 class SQLITE_SETTINGS:
     EXTENSION = getattr(settings, 'DBBACKUP_SQLITE_EXTENSION', 'sqlite')
     BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_COMMANDS', [
-        [READ_FILE, '{databasename}'],
+        [SQLITE_BACKUP, '{databasename}'],
     ])
     RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_RESTORE_COMMANDS', [
-        [WRITE_FILE, '{databasename}'],
+        [SQLITE_RESTORE, '{databasename}'],
     ])
+    TABLE_EXTENSION = getattr(settings, 'DBBACKUP_SQLITE_TABLE_EXTENSION', 'sql')
+    TABLE_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_TABLE_BACKUP_COMMANDS', [
+        [SQLITE_TABLE_BACKUP, '{databasename}', '{tablename}'],
+    ])
+    TABLE_CLEAR_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_TABLE_CLEAR_COMMANDS', [])
+    TABLE_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_TABLE_RESTORE_COMMANDS', [
+        [SQLITE_TABLE_RESTORE, '{databasename}', '{tablename}'],
+    ])
+
+
+##################################
+#  Serializer Settings
+##################################
+
+class SERIALIZER_SETTINGS:
+    """ Rows read and written through the Django ORM, for any engine. The
+        optional argument of the commands is a comma separated list of tables.
+    """
+    EXTENSION = getattr(settings, 'DBBACKUP_SERIALIZER_EXTENSION', 'rows')
+    BACKUP_COMMANDS = [[SERIALIZER_BACKUP]]
+    RESTORE_COMMANDS = [[SERIALIZER_RESTORE]]
+    TABLE_EXTENSION = EXTENSION
+    TABLE_BACKUP_COMMANDS = [[SERIALIZER_BACKUP, '{tablename}']]
+    TABLE_CLEAR_COMMANDS = []
+    TABLE_RESTORE_COMMANDS = [[SERIALIZER_RESTORE, '{tablename}']]
 
 
 ##################################
@@ -65,26 +200,57 @@ class SQLITE_SETTINGS:
 ##################################
 
 class DBCommands:
-    """ Process the Backup or Restore commands. """
+    """ Process the Backup or Restore commands. The table commands run for
+        the {tablename} given as table.
+    """
 
-    def __init__(self, database):
+    def __init__(self, database, compression=COMPRESSION, table=None):
         self.database = database
         self.engine = self.database['ENGINE'].split('.')[-1]
         self.settings = self._get_settings()
+        self.compression = compression
+        self.table = table
+        # Further {name} template variables, ie: {totime} of a recovery
+        self.variables = {}
+        self._tempdir = None
 
     def _get_settings(self):
-        """ Returns the proper settings dictionary. """
-        if self.engine == 'mysql': return MYSQL_SETTINGS
-        elif self.engine in ('postgresql_psycopg2', 'postgis',): return POSTGRESQL_SETTINGS
+        """ Returns the proper settings dictionary. Engines without dump
+            commands, or all of them with DBBACKUP_SERIALIZE, are backed up
+            through the ORM.
+        """
+        if SERIALIZE: return SERIALIZER_SETTINGS
+        elif self.engine == 'mysql': return MYSQL_SETTINGS
+        elif self.engine in ('postgresql_psycopg2', 'postgis',):
+            if POSTGRESQL_FORMAT == 'directory': return POSTGRESQL_DIRECTORY_SETTINGS
+            return POSTGRESQL_SETTINGS
         elif self.engine == 'sqlite3': return SQLITE_SETTINGS
+        return SERIALIZER_SETTINGS
 
-    def filename(self, servername=None, wildcard=None):
-        """ Create a new backup filename. """
+    @property
+    def database_key(self):
+        """ The alias of the database in settings.DATABASES. """
+        for key, database in settings.DATABASES.items():
+            if database is self.database:
+                return key
+        for key, database in settings.DATABASES.items():
+            if database['NAME'] == self.database['NAME'] and database['ENGINE'] == self.database['ENGINE']:
+                return key
+        raise CommandError("Database %s is not in settings.DATABASES" % self.database['NAME'])
+
+    def filename(self, servername=None, wildcard=None, extension=None):
+        """ Create a new backup filename. The engine's extension is followed
+            by the codec's; an extension given is used as is.
+        """
+        compressed = self.compression and not wildcard and extension is None
+        extension = extension or self.settings.EXTENSION
+        if compressed:
+            extension += '.' + compression.extension(self.compression)
         params = {
             'databasename': self.database['NAME'].replace("/", "_"),
             'servername': servername or SERVER_NAME,
             'timestamp': datetime.now(),
-            'extension': self.settings.EXTENSION,
+            'extension': extension,
             'wildcard': wildcard,
         }
         if callable(FILENAME_TEMPLATE):
@@ -103,10 +269,24 @@ class DBCommands:
         """ Return the prefix for backup filenames. """
         return self.filename(servername, wildcard)
 
+    def filename_parser(self, servername=None, extension=None):
+        """ Return the parser matching the backup filenames of this database,
+            or the filenames with extension instead of the engine's.
+        """
+        extension = extension or self.settings.EXTENSION
+        template = self.filename(servername, filenames.DATETIME_TOKEN, extension)
+        return filenames.get_parser(template, DATE_FORMAT, extension,
+            self.database['NAME'], servername or SERVER_NAME)
+
     def filter_filepaths(self, filepaths, servername=None):
         """ Returns a list of backups file paths from the dropbox entries. """
-        regex = self.filename_match(servername, '.*?')
-        return filter(lambda path: re.search(regex, path), filepaths)
+        parser = self.filename_parser(servername)
+        return [path for path in filepaths if parser.match(path)]
+
+    def filename_timestamp(self, filepath, servername=None):
+        """ Return the datetime a backup file was created, or None. """
+        parsed = self.filename_parser(servername).parse(filepath)
+        return parsed.datetime if parsed else None
 
     def translate_command(self, command):
         """ Translate the specified command. """
@@ -117,38 +297,201 @@ class DBCommands:
             command[i] = command[i].replace('{password}', self.database['PASSWORD'])
             command[i] = command[i].replace('{databasename}', self.database['NAME'])
             command[i] = command[i].replace('{port}', str(self.database['PORT']))
+            command[i] = command[i].replace('{jobs}', str(getattr(self.settings, 'JOBS', 1)))
+            if self.table:
+                command[i] = command[i].replace('{tablename}', self.table)
+            for name, value in self.variables.items():
+                command[i] = command[i].replace('{%s}' % name, value)
+            if '{datadir}' in command[i]:
+                if not getattr(self.settings, 'DATA_DIRECTORY', None):
+                    raise CommandError("No data directory set for {datadir} (DBBACKUP_POSTGRESQL_DATA_DIRECTORY)")
+                command[i] = command[i].replace('{datadir}', self.settings.DATA_DIRECTORY)
+            if '{tempdir}' in command[i]:
+                command[i] = command[i].replace('{tempdir}', self.tempdir)
         return command
 
+    @property
+    def tempdir(self):
+        """ Scratch directory for the commands, removed once they finish. """
+        if not self._tempdir:
+            self._tempdir = tempfile.mkdtemp(prefix='dbbackup-')
+        return self._tempdir
+
+    def cleanup_tempdir(self):
+        if self._tempdir:
+            rmtree(self._tempdir, ignore_errors=True)
+            self._tempdir = None
+
     def run_backup_commands(self, stdout):
         """ Translate and run the backup commands. """
         return self.run_commands(self.settings.BACKUP_COMMANDS, stdout=stdout)
 
-    def run_restore_commands(self, stdin):
-        """ Translate and run the backup commands. """
-        stdin.seek(0)
-        return self.run_commands(self.settings.RESTORE_COMMANDS, stdin=stdin)
+    def stream_backup_commands(self, chunk_size=STREAM_CHUNK_SIZE, commands=None):
+        """ Translate and run the backup commands (or the commands given),
+            yielding their (compressed) output in chunks instead of writing
+            it to a file. The dump is read no faster than
+            DBBACKUP_DUMP_RATE_LIMIT.
+        """
+        name = self.database['NAME']
+        commands = self.settings.BACKUP_COMMANDS if commands is None else commands
+        chunks = metrics.timed_chunks(self.stream_commands(commands, chunk_size), 'dump', name)
+        if throttle.DUMP.rate:
+            chunks = metrics.timed_chunks(throttle.throttled_chunks(chunks, throttle.DUMP), 'throttle', name)
+        if self.compression and COMPRESSION_WORKERS > 1:
+            chunks = compression.parallel_compress_chunks(chunks, self.compression,
+                COMPRESSION_LEVEL, COMPRESSION_WORKERS, COMPRESSION_BLOCK_SIZE)
+        elif self.compression:
+            chunks = compression.compress_chunks(chunks, self.compression, COMPRESSION_LEVEL)
+        if self.compression:
+            chunks = metrics.timed_chunks(chunks, 'compress', name)
+        return chunks
+
+    def stream_commands(self, commands, chunk_size=STREAM_CHUNK_SIZE):
+        """ Translate and run the specified commands, yielding their output.
+            The processes run at the DBBACKUP_NICE and DBBACKUP_IONICE priority.
+        """
+        try:
+            for command in commands:
+                command = self.translate_command(command)
+                if (command[0] == READ_FILE):
+                    print "  Reading: %s" % command[1]
+                    with open(command[1], 'rb') as f:
+                        for data in utils.iter_chunks(f, chunk_size):
+                            yield data
+                elif (command[0] == READ_DIRECTORY):
+                    for data in self.stream_directory(command[1], chunk_size):
+                        yield data
+                elif (command[0] == SQLITE_BACKUP):
+                    for data in self.stream_sqlite_backup(command[1], chunk_size):
+                        yield data
+                elif (command[0] == SQLITE_TABLE_BACKUP):
+                    print "  Dumping: %s %s" % (command[1], command[2])
+                    for data in sqlite.dump_table(command[1], command[2], chunk_size):
+                        yield data
+                elif (command[0] == SERIALIZER_BACKUP):
+                    print "  Serializing: %s" % (command[1] if len(command) > 1 else self.database_key)
+                    for data in serializer.dump(self.database_key, self.serializer_tables(command), chunk_size):
+                        yield data
+                elif (command[-1] == '>'):
+                    process = self.run_command(command, stdout=PIPE, background=True)
+                    for data in self.stream_process(process, chunk_size):
+                        yield data
+                else: self.run_command(command, background=True)
+        finally:
+            self.cleanup_tempdir()
+
+    def run_restore_commands(self, stdin, codec=None, commands=None):
+        """ Translate and run the restore commands (or the commands given).
+            stdin is a file or an iterable of chunks. If codec is specified
+            the backup is decompressed while it is fed to the commands.
+        """
+        if hasattr(stdin, 'read'):
+            stdin.seek(0)
+            if codec:
+                stdin = utils.iter_chunks(stdin, STREAM_CHUNK_SIZE)
+        if codec:
+            stdin = metrics.timed_chunks(compression.decompress_chunks(stdin, codec), 'decompress', self.database['NAME'])
+        commands = self.settings.RESTORE_COMMANDS if commands is None else commands
+        with metrics.stage('load', self.database['NAME']):
+            return self.run_commands(commands, stdin=stdin)
 
     def run_commands(self, commands, stdin=None, stdout=None):
         """ Translate and run the specified commands. """
-        for command in commands:
-            command = self.translate_command(command)
-            if (command[0] == READ_FILE): self.read_file(command[1], stdout)
-            elif (command[0] == WRITE_FILE): self.write_file(command[1], stdin)
-            else: self.run_command(command, stdin, stdout)
-
-    def run_command(self, command, stdin=None, stdout=None):
-        """ Run the specified command. """
+        try:
+            for command in commands:
+                command = self.translate_command(command)
+                if (command[0] == READ_FILE): self.read_file(command[1], stdout)
+                elif (command[0] == WRITE_FILE): self.write_file(command[1], stdin)
+                elif (command[0] == READ_DIRECTORY): self.read_directory(command[1], stdout)
+                elif (command[0] == WRITE_DIRECTORY): self.write_directory(command[1], stdin)
+                elif (command[0] == SQLITE_BACKUP): self.sqlite_backup(command[1], stdout)
+                elif (command[0] == SQLITE_RESTORE): self.sqlite_restore(command[1], stdin)
+                elif (command[0] == SQLITE_TABLE_RESTORE): self.sqlite_table_restore(command[1], command[2], stdin)
+                elif (command[0] == SERIALIZER_BACKUP): self.serializer_backup(command, stdout)
+                elif (command[0] == POSTGRESQL_RECOVERY): postgresql.write_recovery(command[1], command[2], command[3])
+                elif (command[0] == SERIALIZER_RESTORE): serializer.load(self.database_key, stdin, self.serializer_tables(command))
+                else: self.run_command(command, stdin, stdout)
+        finally:
+            self.cleanup_tempdir()
+
+    def serializer_backup(self, command, stdout):
+        """ Write the rows of the database through the ORM to stdout. """
+        for data in serializer.dump(self.database_key, self.serializer_tables(command)):
+            stdout.write(data)
+
+    def serializer_tables(self, command):
+        """ Return the tables listed by a serializer command, or None. """
+        if len(command) > 1 and command[1]:
+            return command[1].split(',')
+        return None
+
+    def run_command(self, command, stdin=None, stdout=None, background=False):
+        """ Run the specified command. stdin may be a file or an iterable of
+            chunks, which is fed to the process through a pipe. A background
+            command runs with the lowered DBBACKUP_NICE and DBBACKUP_IONICE
+            priority.
+        """
         devnull = open(os.devnull, 'w')
         pstdin = stdin if command[-1] == '<' else None
         pstdout = stdout if command[-1] == '>' else devnull
+        chunks = None
+        if pstdin is not None and not hasattr(pstdin, 'read'):
+            chunks, pstdin = pstdin, PIPE
         command = filter(lambda arg: arg not in ['<', '>'], command)
+        if background:
+            command = throttle.priority_command(command)
         print "  Running: %s" % ' '.join(command)
         process = Popen(command, stdin=pstdin, stdout=pstdout)
-        process.wait()
         devnull.close()
+        if pstdout == PIPE:
+            process.command = command
+            return process
+        if chunks is not None:
+            self.feed_process(process, chunks)
+        process.wait()
         if process.poll():
             raise CommandError("Error running: %s" % command)
 
+    def stream_process(self, process, chunk_size=STREAM_CHUNK_SIZE):
+        """ Yield the stdout of a process started with stdout=PIPE in chunks.
+            The process is killed if the consumer stops reading early.
+        """
+        try:
+            for data in utils.iter_chunks(process.stdout, chunk_size):
+                yield data
+        except GeneratorExit:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode:
+            raise CommandError("Error running: %s" % process.command)
+
+    def feed_process(self, process, chunks):
+        """ Write chunks to the stdin of a process started with stdin=PIPE.
+            If reading the chunks fails the process is killed before its
+            stdin is closed, so it never sees the EOF of a truncated input.
+        """
+        try:
+            for data in chunks:
+                try:
+                    process.stdin.write(data)
+                except IOError, err:
+                    if err.errno != errno.EPIPE:
+                        raise
+                    # The process exited early, its return code reports the error
+                    break
+        except:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+
     def read_file(self, filepath, stdout):
         """ Read the specified file to stdout. """
         print "  Reading: %s" % filepath
@@ -159,5 +502,79 @@ class DBCommands:
         """ Write the specified file from stdin. """
         print "  Writing: %s" % filepath
         with open(filepath, 'wb') as f:
-            copyfileobj(stdin, f)
+            if hasattr(stdin, 'read'):
+                copyfileobj(stdin, f)
+            else:
+                for data in stdin:
+                    f.write(data)
+
+    def sqlite_backup(self, dbpath, stdout):
+        """ Write a consistent snapshot of the SQLite database to stdout. """
+        for data in self.stream_sqlite_backup(dbpath):
+            stdout.write(data)
+
+    def stream_sqlite_backup(self, dbpath, chunk_size=STREAM_CHUNK_SIZE):
+        """ Yield a consistent snapshot of the SQLite database, taken with
+            the online backup API while other connections keep writing.
+        """
+        print "  Snapshotting: %s" % dbpath
+        snapshotpath = os.path.join(self.tempdir, 'snapshot.sqlite')
+        sqlite.snapshot(dbpath, snapshotpath)
+        for data in sqlite.stream_file(snapshotpath, chunk_size):
+            yield data
+
+    def sqlite_restore(self, dbpath, stdin):
+        """ Replace the SQLite database with the one read from stdin. """
+        print "  Restoring: %s" % dbpath
+        sqlite.restore(stdin, dbpath)
+
+    def sqlite_table_restore(self, dbpath, table, stdin):
+        """ Replace the rows of a SQLite table with those read from stdin. """
+        print "  Loading: %s %s" % (dbpath, table)
+        sqlite.restore_table(stdin, dbpath, table)
+
+    def read_directory(self, dirpath, stdout):
+        """ Write the specified directory to stdout as a tar archive. """
+        for data in self.stream_directory(dirpath):
+            stdout.write(data)
+
+    def stream_directory(self, dirpath, chunk_size=STREAM_CHUNK_SIZE):
+        """ Yield the specified directory as a tar archive. The archive is
+            built member by member so no file is held in memory.
+        """
+        print "  Archiving: %s" % dirpath
+        size = 0
+        for root, dirnames, filenames in os.walk(dirpath):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                info = tarfile.TarInfo(os.path.relpath(path, dirpath))
+                info.size = os.path.getsize(path)
+                info.mtime = os.path.getmtime(path)
+                header = info.tobuf(tarfile.GNU_FORMAT)
+                yield header
+                with open(path, 'rb') as f:
+                    for data in utils.iter_chunks(f, chunk_size):
+                        yield data
+                padding = -info.size % tarfile.BLOCKSIZE
+                yield tarfile.NUL * padding
+                size += len(header) + info.size + padding
+        # End of archive marker, padded to a full record
+        size += 2 * tarfile.BLOCKSIZE
+        yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + (-size % tarfile.RECORDSIZE))
 
+    def write_directory(self, dirpath, stdin):
+        """ Extract the tar archive read from stdin into the specified
+            directory. stdin is a file or an iterable of chunks.
+        """
+        print "  Extracting: %s" % dirpath
+        if not hasattr(stdin, 'read'):
+            stdin = utils.ChunkReader(stdin)
+        archive = tarfile.open(fileobj=stdin, mode='r|')
+        try:
+            for member in archive:
+                if not (member.isfile() or member.isdir()) or member.name.startswith('/') or '..' in member.name.split('/'):
+                    raise CommandError("Unexpected member in backup archive: %s" % member.name)
+                archive.extract(member, dirpath)
+        finally:
+            archive.close()
@@ -0,0 +1,319 @@
+"""
+Deduplicating backup format: the dump is split into content-defined chunks
+which are stored once by their sha256, plus a small manifest per backup.
+"""
+import hashlib, json, os, socket, threading, time, uuid, zlib
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from . import compression, utils
+from .dbcommands import COMPRESSION_LEVEL
+from .filenames import MANIFEST_EXTENSION
+from .storage.base import StorageError
+
+MANIFEST_VERSION = 1
+CHUNK_PREFIX = 'dbbackup-chunk-'
+MIN_CHUNK_SIZE = getattr(settings, 'DBBACKUP_DEDUP_MIN_CHUNK_SIZE', 256*1024)
+MAX_CHUNK_SIZE = getattr(settings, 'DBBACKUP_DEDUP_MAX_CHUNK_SIZE', 4*1024*1024)
+WORKERS = getattr(settings, 'DBBACKUP_DEDUP_WORKERS', 4)
+GC_GRACE = getattr(settings, 'DBBACKUP_DEDUP_GC_GRACE', 24*3600)
+GC_STATE_NAME = 'dbbackup-unreferenced.json'
+LOCK_PREFIX = 'dbbackup-lock-'
+LOCK_POLL = 1
+GC_LOCK_TIMEOUT = 3600
+BACKUP_LOCK_TIMEOUT = 24*3600
+
+# Boundaries are only considered at newlines (the end of a row in a SQL
+# dump, roughly every 256 bytes in binary data) and taken where the hash of
+# the preceding window matches the mask: 1 in 4096 candidates.
+BOUNDARY_WINDOW = 64
+BOUNDARY_MASK = 0xfff
+
+# Garbage collection must not run while a backup of this process is still
+# referencing chunks its manifest has not recorded yet. Backups running in
+# other processes are seen through their lock files (see storage_lock).
+ACTIVE_LOCK = threading.Lock()
+ACTIVE_BACKUPS = [0]
+
+
+##################################
+#  Content-Defined Chunking
+##################################
+
+def find_boundary(data, min_size, max_size):
+    """ Return the length of the first chunk in data, or None if data is
+        shorter than max_size and no boundary was found.
+    """
+    end = min(len(data), max_size)
+    position = data.find('\n', min_size, end)
+    while position != -1:
+        window = data[max(position - BOUNDARY_WINDOW, 0):position + 1]
+        if not zlib.crc32(window) & BOUNDARY_MASK:
+            return position + 1
+        position = data.find('\n', position + 1, end)
+    return max_size if len(data) >= max_size else None
+
+def split_chunks(chunks, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    """ Split an iterable of chunks at content-defined boundaries. An insert
+        or delete in the dump only changes the chunks around it.
+    """
+    pending, pending_size, buffer = [], 0, ''
+    for data in chunks:
+        pending.append(data)
+        pending_size += len(data)
+        if len(buffer) + pending_size < max_size:
+            continue
+        buffer = buffer + ''.join(pending)
+        pending, pending_size = [], 0
+        while True:
+            size = find_boundary(buffer, min_size, max_size)
+            if size is None:
+                break
+            yield buffer[:size]
+            buffer = buffer[size:]
+    buffer = buffer + ''.join(pending)
+    while buffer:
+        size = find_boundary(buffer, min_size, max_size) or len(buffer)
+        yield buffer[:size]
+        buffer = buffer[size:]
+
+
+##################################
+#  Chunk Storage
+##################################
+
+def is_manifest(filepath):
+    return filepath.endswith('.' + MANIFEST_EXTENSION)
+
+def manifest_name(filename):
+    return '%s.%s' % (filename, MANIFEST_EXTENSION)
+
+def chunk_name(digest, codec):
+    """ Return the stored name of a chunk. """
+    name = CHUNK_PREFIX + digest
+    if codec:
+        name += '.' + compression.extension(codec)
+    return name
+
+def chunk_path(manifest_path, name):
+    """ Return the storage path of a chunk stored next to manifest_path. """
+    return os.path.join(os.path.dirname(manifest_path), name)
+
+def store_chunk(storage, data, name, codec):
+    """ Compress and upload a single chunk, returning its stored size. """
+    if codec:
+        data = compression.compress_block(data, codec, COMPRESSION_LEVEL)
+    storage.write_stream([data], name)
+    return len(data)
+
+def fetch_chunk(storage, path, digest, codec):
+    """ Download, decompress and verify a single chunk. """
+    data = ''.join(storage.read_stream(path))
+    if codec:
+        data = ''.join(compression.decompress_chunks([data], codec))
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise StorageError("Chunk %s is corrupt" % path)
+    return data
+
+def stored_chunks(filepaths):
+    """ Return the names of the chunks in a directory listing. """
+    names = (os.path.basename(path) for path in filepaths)
+    return set(name for name in names if name.startswith(CHUNK_PREFIX))
+
+def existing_chunks(storage):
+    """ Return the names of the chunks stored already. When writing to
+        several storages only the chunks every one of them has are
+        returned, so the others are uploaded to the storages missing them.
+    """
+    def listing(storage):
+        try:
+            return stored_chunks(storage.list_directory())
+        except (StorageError, EnvironmentError):
+            return set()
+    storages = getattr(storage, 'storages', None)
+    if not storages:
+        return stored_chunks(storage.list_directory())
+    return set.intersection(*storage.map_concurrently(listing, storages))
+
+
+##################################
+#  Storage Locks
+##################################
+
+# A backup and a garbage collection each write a lock file before looking
+# for the lock of the other, so at least one of them sees the other: the
+# collection then deletes nothing, or the backup waits for it to finish
+# before listing the stored chunks. Locks older than their timeout are left
+# by crashed processes and ignored.
+
+@contextmanager
+def storage_lock(storage, kind):
+    """ Hold a lock file of kind ('backup', 'gc' or 'catalog') in storage
+        and return its name.
+    """
+    name = '%s%s-%d-%s' % (LOCK_PREFIX, kind, time.time(), uuid.uuid4().hex[:8])
+    storage.write_stream(['%s %s\n' % (socket.gethostname(), os.getpid())], name)
+    try:
+        yield name
+    finally:
+        try:
+            storage.delete_file(os.path.join(storage.backup_dir(), name))
+        except StorageError:
+            pass
+
+def active_locks(storage, kind, timeout):
+    """ Return the paths of the lock files of kind younger than timeout. """
+    prefix, now, locks = '%s%s-' % (LOCK_PREFIX, kind), time.time(), []
+    for filepath in storage.list_directory():
+        name = os.path.basename(filepath)
+        if name.startswith(prefix):
+            created = name[len(prefix):].split('-')[0]
+            if created.isdigit() and now - int(created) < timeout:
+                locks.append(filepath)
+    return locks
+
+def wait_for_gc(storage, timeout=GC_LOCK_TIMEOUT):
+    """ Wait until no garbage collection is deleting chunks. """
+    waiting = False
+    while active_locks(storage, 'gc', timeout):
+        if not waiting:
+            print "  Waiting for the chunk cleanup of another process"
+            waiting = True
+        time.sleep(LOCK_POLL)
+
+
+##################################
+#  Backup and Restore
+##################################
+
+def write_backup(storage, chunks, filename, codec=None, workers=WORKERS):
+    """ Store the dump chunks as a deduplicated backup, uploading only the
+        chunks not stored yet. The manifest is written last so an
+        interrupted backup never shows up as restorable. The backup holds a
+        lock in storage until then, so no garbage collection deletes the
+        stored chunks it reuses.
+    """
+    with ACTIVE_LOCK:
+        ACTIVE_BACKUPS[0] += 1
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        with storage_lock(storage, 'backup'):
+            wait_for_gc(storage)
+            existing = existing_chunks(storage)
+            entries, total, uploaded, uploaded_size = [], 0, 0, 0
+            for data in split_chunks(chunks):
+                digest = hashlib.sha256(data).hexdigest()
+                entries.append([digest, len(data)])
+                total += len(data)
+                name = chunk_name(digest, codec)
+                if name in existing:
+                    continue
+                existing.add(name)
+                pending.append(pool.apply_async(store_chunk, (storage, data, name, codec)))
+                # Bound the number of chunks held in memory
+                if len(pending) > workers * 2:
+                    uploaded_size += pending.popleft().get()
+                    uploaded += 1
+            while pending:
+                uploaded_size += pending.popleft().get()
+                uploaded += 1
+            manifest = {'version': MANIFEST_VERSION, 'codec': codec, 'size': total, 'chunks': entries}
+            storage.write_stream([json.dumps(manifest)], manifest_name(filename))
+    finally:
+        pool.terminate()
+        pool.join()
+        with ACTIVE_LOCK:
+            ACTIVE_BACKUPS[0] -= 1
+    print "  Deduplicated: uploaded %s of %s chunks (%s of %s)" % (uploaded, len(entries),
+        utils.bytes_to_str(uploaded_size), utils.bytes_to_str(total))
+    return manifest
+
+def read_manifest(storage, filepath):
+    manifest = json.loads(''.join(storage.read_stream(filepath)))
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise StorageError("Unsupported manifest version in %s" % filepath)
+    return manifest
+
+def read_backup(storage, filepath, workers=WORKERS):
+    """ Yield the dump of a deduplicated backup, fetching up to workers
+        chunks concurrently.
+    """
+    manifest = read_manifest(storage, filepath)
+    codec = manifest['codec']
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for digest, size in manifest['chunks']:
+            path = chunk_path(filepath, chunk_name(digest, codec))
+            pending.append(pool.apply_async(fetch_chunk, (storage, path, digest, codec)))
+            if len(pending) > workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+##################################
+#  Garbage Collection
+##################################
+
+def read_unreferenced(storage, filepaths):
+    """ Return {chunk name: time first seen unreferenced} from the state
+        stored by the previous garbage collection.
+    """
+    for filepath in filepaths:
+        if os.path.basename(filepath) == GC_STATE_NAME:
+            return json.loads(''.join(storage.read_stream(filepath)))
+    return {}
+
+def collect_garbage(storage, filepaths=None, grace=GC_GRACE):
+    """ Delete the chunks not referenced by any manifest. filepaths is the
+        current directory listing, if already known.
+
+        A chunk is only deleted once it was found unreferenced by a garbage
+        collection at least grace seconds earlier, and nothing is deleted
+        while a backup of another process holds its lock: that backup may
+        reuse any stored chunk until its manifest is written.
+    """
+    if filepaths is None:
+        filepaths = storage.list_directory()
+    chunks = stored_chunks(filepaths)
+    with ACTIVE_LOCK:
+        if ACTIVE_BACKUPS[0]:
+            print "  Skipping chunk cleanup while another backup is running"
+            return []
+        referenced = set()
+        for filepath in filter(is_manifest, filepaths):
+            manifest = read_manifest(storage, filepath)
+            referenced.update(chunk_name(digest, manifest['codec']) for digest, size in manifest['chunks'])
+        unreferenced, now = chunks - referenced, time.time()
+        previous = read_unreferenced(storage, filepaths)
+        if grace:
+            expired = set(name for name in unreferenced if now - previous.get(name, now) >= grace)
+        else:
+            expired = unreferenced
+        deletes = delete_chunks(storage, filepaths, expired) if expired else []
+        deleted = set(os.path.basename(path) for path in deletes)
+        pending = dict((name, previous.get(name, now)) for name in unreferenced - deleted)
+        if pending != previous:
+            storage.write_stream([json.dumps(pending, separators=(',', ':'))], GC_STATE_NAME)
+        if pending:
+            print "  Keeping %s unreferenced chunks for now" % len(pending)
+    return deletes
+
+def delete_chunks(storage, filepaths, names):
+    """ Delete the chunks with names, unless a backup of another process is
+        running. Returns the deleted paths.
+    """
+    with storage_lock(storage, 'gc'):
+        if active_locks(storage, 'backup', BACKUP_LOCK_TIMEOUT):
+            print "  Skipping chunk cleanup while a backup of another process is running"
+            return []
+        deletes = [path for path in filepaths if os.path.basename(path) in names]
+        print "  Deleting %s unreferenced chunks" % len(deletes)
+        storage.delete_files(deletes)
+    return deletes
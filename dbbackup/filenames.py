@@ -0,0 +1,113 @@
+"""
+Parse backup filenames with an anchored pattern compiled once from the
+filename template and the date format.
+"""
+import re, threading
+from collections import namedtuple
+from datetime import datetime
+from . import compression
+
+MANIFEST_EXTENSION = 'manifest'
+DATETIME_TOKEN = 'DBBACKUPDATETIME'
+
+# strftime directive: (datetime field, regex). When the format has a prefix
+# of DATE_FIELDS the datetime is built with int() instead of strptime.
+DATE_DIRECTIVES = {
+    'Y': ('year', r'\d{4}'),
+    'm': ('month', r'\d{2}'),
+    'd': ('day', r'\d{2}'),
+    'H': ('hour', r'\d{2}'),
+    'M': ('minute', r'\d{2}'),
+    'S': ('second', r'\d{2}'),
+    'f': ('microsecond', r'\d{6}'),
+    'y': (None, r'\d{2}'),
+    'j': (None, r'\d{3}'),
+}
+
+DATE_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond')
+
+BackupFilename = namedtuple('BackupFilename', 'filepath database server datetime extension codec')
+
+
+def datetime_pattern(date_format):
+    """ Translate a strftime format into a regex. Returns the regex and
+        the named groups to build the datetime from, or None if strptime
+        is needed.
+    """
+    regex, seen, fast, index = [], set(), True, 0
+    while index < len(date_format):
+        char = date_format[index:index+2]
+        if len(char) == 2 and char[0] == '%':
+            index += 2
+            field, pattern = DATE_DIRECTIVES.get(char[1], (None, None))
+            if char == '%%':
+                regex.append('%')
+            elif field and field not in seen:
+                seen.add(field)
+                regex.append('(?P<%s>%s)' % (field, pattern))
+            else:
+                regex.append(pattern or '.+?')
+                fast = False
+        else:
+            regex.append(re.escape(date_format[index]))
+            index += 1
+    fields = DATE_FIELDS[:len(seen)]
+    return ''.join(regex), fields if fast and len(fields) >= 3 and set(fields) == seen else None
+
+
+class FilenameParser(object):
+    """ Match and parse the backup filenames of one database and server.
+        template is the backup filename with DATETIME_TOKEN in place of the
+        date and without the codec extension.
+    """
+
+    def __init__(self, template, date_format, extension, database, server):
+        self.date_format = date_format
+        self.database = database
+        self.server = server
+        date_regex, self.date_fields = datetime_pattern(date_format)
+        before, token, after = template.partition(DATETIME_TOKEN)
+        regex = re.escape(before)
+        if token:
+            regex += '(?P<datetime>%s)' % date_regex
+        regex += re.escape(after)
+        suffixes = sorted(re.escape(ext) for ext, compressor, decompressor in compression.CODECS.values())
+        regex += r'(?P<codec>\.(?:%s))?(?P<manifest>\.%s)?$' % ('|'.join(suffixes), MANIFEST_EXTENSION)
+        self.regex = re.compile(regex)
+        self.codecs = dict(('.' + ext, codec) for codec, (ext, compressor, decompressor) in compression.CODECS.items())
+        self.extension = extension
+
+    def match(self, filepath):
+        return self.regex.match(filepath, filepath.rfind('/') + 1) is not None
+
+    def parse(self, filepath):
+        """ Return the BackupFilename for filepath, or None if it does not match. """
+        match = self.regex.match(filepath, filepath.rfind('/') + 1)
+        if not match:
+            return None
+        codec, manifest = match.group('codec', 'manifest')
+        extension = self.extension + (codec or '') + (manifest or '')
+        codec = self.codecs.get(codec)
+        return BackupFilename(filepath, self.database, self.server, self.parse_datetime(match), extension, codec)
+
+    def parse_datetime(self, match):
+        if 'datetime' not in self.regex.groupindex:
+            return None
+        try:
+            if self.date_fields:
+                return datetime(*[int(value) for value in match.group(*self.date_fields)])
+            return datetime.strptime(match.group('datetime'), self.date_format)
+        except ValueError:
+            return None
+
+
+PARSERS = {}
+PARSERS_LOCK = threading.Lock()
+
+def get_parser(template, date_format, extension, database, server):
+    """ Return the (cached) FilenameParser for these arguments. """
+    key = (template, date_format, extension, database, server)
+    with PARSERS_LOCK:
+        if key not in PARSERS:
+            PARSERS[key] = FilenameParser(template, date_format, extension, database, server)
+        return PARSERS[key]
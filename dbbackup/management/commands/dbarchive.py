@@ -0,0 +1,100 @@
+"""
+Ship the PostgreSQL WAL segments or MySQL binlogs to the storage, and fetch
+them back during a point-in-time recovery.
+"""
+import os, sys, time
+from ... import archive, utils
+from ...dbcommands import DBCommands
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.core.management.base import LabelCommand
+from optparse import make_option
+
+
+class Command(LabelCommand):
+    help = "dbarchive [-d <dbname>] [-s <servername>] [-z <codec>] [--flush] [--watch <seconds>] [<logfile> ...] | --fetch <logname> <path>"
+    args = "[<logfile> ...]"
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--database", help="Database whose logs to archive"),
+        make_option("-s", "--servername", help="Specifiy server name to include in the archived filenames"),
+        make_option("-z", "--compress", help="Compress the logs with gzip, bz2 or lzma", default=archive.ARCHIVE_COMPRESSION),
+        make_option("--flush", help="Switch to a new log first, so the current one is archived", action="store_true", default=False),
+        make_option("--watch", help="Keep archiving the closed logs every N seconds", type="int"),
+        make_option("--fetch", help="Download an archived log to a path (PostgreSQL restore_command)", action="store_true", default=False),
+    )
+
+    def handle(self, *paths, **options):
+        """ Django command handler. """
+        if options.get('fetch'):
+            # PostgreSQL asks for segments past the end of the archive during
+            # every recovery: a miss exits quietly instead of emailing an error
+            if not self.fetch(*paths, **options):
+                sys.exit(1)
+            return
+        self.archive_logs(*paths, **options)
+
+    def setup(self, options):
+        self.servername = options.get('servername')
+        self.compression = options.get('compress')
+        self.storage = BaseStorage.storage_factory()
+        database_key = self._get_database_key(options)
+        self.dbcommands = DBCommands(settings.DATABASES[database_key])
+        archive.check_supported(self.dbcommands)
+
+    @utils.email_uncaught_exception
+    def fetch(self, *paths, **options):
+        """ Download an archived log, returning False if it is not archived. """
+        try:
+            self.setup(options)
+            if len(paths) != 2:
+                raise CommandError("--fetch takes the name of the log and the path to write it to")
+            return archive.fetch_log(self.storage, self.dbcommands, paths[0], paths[1], self.servername)
+        except StorageError, err:
+            raise CommandError(err)
+
+    @utils.email_uncaught_exception
+    def archive_logs(self, *paths, **options):
+        """ Archive the logs given, or the closed logs of the index. """
+        try:
+            self.setup(options)
+            if paths:
+                for path in paths:
+                    archive.archive_log(self.storage, self.dbcommands, path, self.servername, self.compression)
+                return
+            if not self.dbcommands.settings.ARCHIVE_INDEX and options.get('flush'):
+                # The server archives the finished segment with its archive_command
+                return self.dbcommands.run_commands(self.dbcommands.settings.FLUSH_LOGS_COMMANDS)
+            if not self.dbcommands.settings.ARCHIVE_INDEX:
+                raise CommandError("No log index to archive from, give the logs to archive (ie: %p in archive_command)")
+            while True:
+                self.archive_closed_logs(options.get('flush'))
+                if not options.get('watch'):
+                    break
+                time.sleep(options['watch'])
+        except StorageError, err:
+            raise CommandError(err)
+
+    def _get_database_key(self, options):
+        """ Get the database whose logs to archive. """
+        database_key = options.get('database')
+        if not database_key:
+            if len(settings.DATABASES) >= 2:
+                errmsg = "Because this project contains more than one database, you"
+                errmsg += " must specify the --database option."
+                raise CommandError(errmsg)
+            database_key = settings.DATABASES.keys()[0]
+        return database_key
+
+    def archive_closed_logs(self, flush=False):
+        """ Archive the logs of the index the server is no longer writing. """
+        if flush:
+            self.dbcommands.run_commands(self.dbcommands.settings.FLUSH_LOGS_COMMANDS)
+        archived = set(log[0] for log in archive.list_logs(self.storage, self.dbcommands, self.servername))
+        pending = [path for path in archive.closed_logs(self.dbcommands.settings.ARCHIVE_INDEX)
+            if os.path.basename(path) not in archived]
+        print "Archiving %s logs of: %s" % (len(pending), self.dbcommands.database['NAME'])
+        for path in pending:
+            archive.archive_log(self.storage, self.dbcommands, path, self.servername, self.compression)
@@ -1,12 +1,13 @@
 """
 Save backup files to Dropbox.
 """
-import re
-import datetime
-import tempfile
-from ... import utils
+import os
+from multiprocessing.pool import ThreadPool
+from ... import archive, checkpoint, dedup, metrics, registry, retention, tables, utils
+from ...catalog import Catalog, CATALOG
 from ...dbcommands import DBCommands
-from ...dbcommands import DATE_FORMAT
+from ...dbcommands import STREAMING, STREAM_BUFFER_SIZE, STREAM_CHUNK_SIZE
+from ...dbcommands import COMPRESSION, DEDUPLICATE
 from ...storage.base import BaseStorage
 from ...storage.base import StorageError
 from django.conf import settings
@@ -19,52 +20,312 @@ DATABASE_KEYS = getattr(settings, 'DBBACKUP_DATABASES', settings.DATABASES.keys(
 
 
 class Command(LabelCommand):
-    help = "dbbackup [-c] [-d <dbname>] [-s <servername>]"
+    help = "dbbackup [-c] [-d <dbname>] [-s <servername>] [-z <codec>] [--stream] [--dedup] [--parallel <N>] [--dry-run] [--resume] [--stats] [-t <tables>] [-a <apps>] [--base]"
     option_list = BaseCommand.option_list + (
         make_option("-c", "--clean", help="Clean up old backup files", action="store_true", default=False),
         make_option("-d", "--database", help="Database to backup (default: everything)"),
         make_option("-s", "--servername", help="Specifiy server name to include in backup filename"),
+        make_option("-z", "--compress", help="Compress the backup with gzip, bz2 or lzma", default=COMPRESSION),
+        make_option("--stream", help="Upload the backup while it is being dumped", action="store_true", default=STREAMING),
+        make_option("--dedup", help="Only upload the parts of the backup that changed", action="store_true", default=DEDUPLICATE),
+        make_option("--parallel", help="Number of databases to backup concurrently", type="int", default=1),
+        make_option("--dry-run", help="Print the cleanup plan without backing up or deleting anything", action="store_true", default=False),
+        make_option("--resume", help="Continue an interrupted upload instead of starting a new backup", action="store_true", default=False),
+        make_option("--stats", help="Print the time and bytes of every stage as JSON", action="store_true", default=False),
+        make_option("-t", "--table", help="Comma separated tables or app_label.Model names to backup on their own"),
+        make_option("-a", "--app", help="Comma separated app labels whose tables to backup on their own"),
+        make_option("--base", help="Take a base backup for point-in-time recovery from the archived logs", action="store_true", default=False),
     )
 
     @utils.email_uncaught_exception
     def handle(self, **options):
         """ Django command handler. """
+        stats, success = metrics.Stats('dbbackup'), False
         try:
-            self.clean = options.get('clean')
+            self.dry_run = options.get('dry_run')
+            self.clean = options.get('clean') or self.dry_run
             self.database = options.get('database')
             self.servername = options.get('servername')
+            self.streaming = options.get('stream')
+            self.compression = options.get('compress')
+            self.deduplicate = options.get('dedup')
+            self.parallel = options.get('parallel') or 1
+            self.resume = options.get('resume')
+            self.tables = filter(None, (options.get('table') or '').split(','))
+            self.apps = filter(None, (options.get('app') or '').split(','))
+            if (self.tables or self.apps) and (self.deduplicate or self.resume):
+                raise CommandError("--table and --app cannot be combined with --dedup or --resume.")
+            self.base = options.get('base')
+            if self.base and (self.tables or self.apps):
+                raise CommandError("--base cannot be combined with --table or --app.")
             self.storage = BaseStorage.storage_factory()
+            # Base backups are found by listing, so dbrestore never takes one for a full backup
+            self.catalog = Catalog(self.storage) if CATALOG and not self.base else None
+            if self.catalog:
+                # Read while the first dump runs
+                self.catalog.prefetch()
             database_keys = (self.database,) if self.database else DATABASE_KEYS
-            for database_key in database_keys:
-                database = settings.DATABASES[database_key]
-                self.dbcommands = DBCommands(database)
-                self.save_new_backup(database)
-                self.cleanup_old_backups(database)
+            if self.parallel > 1:
+                self.backup_databases_parallel(database_keys)
+            else:
+                for database_key in database_keys:
+                    self.backup_database(database_key)
+            self.check_storage_failures()
+            success = True
         except StorageError, err:
             raise CommandError(err)
+        finally:
+            stats.finish(success, options.get('stats'))
 
-    def save_new_backup(self, database):
+    def check_storage_failures(self):
+        """ Report the result of every storage when writing to several, and
+            fail if some files could not be written to one of them.
+        """
+        if not hasattr(self.storage, 'storages'):
+            return
+        failures = self.storage.failures
+        print "Storage results:"
+        for storage in self.storage.storages:
+            failed = [filename for name, filename, error in failures if name == storage.name]
+            print "  %s: %s" % (storage.name, "FAILED (%s files)" % len(failed) if failed else "OK")
+        if failures:
+            raise CommandError("Writing to some storages failed: %s" % '; '.join(
+                "%s to %s (%s)" % (filename, name, error) for name, filename, error in failures))
+
+    def backup_database(self, database_key):
+        """ Save a new backup and cleanup old backups of a single database. """
+        database = settings.DATABASES[database_key]
+        if self.tables or self.apps:
+            return self.backup_database_tables(database_key, database)
+        # Deduplicated backups compress each chunk instead of the whole dump
+        dbcommands = DBCommands(database, None if self.deduplicate else self.compression)
+        if self.base:
+            archive.check_supported(dbcommands)
+            dbcommands.settings = archive.base_settings(dbcommands.settings)
+        if not self.dry_run and self.resume:
+            self.resume_new_backup(database, dbcommands)
+        elif not self.dry_run:
+            self.save_new_backup(database, dbcommands)
+        self.cleanup_old_backups(database, dbcommands)
+
+    def backup_databases_parallel(self, database_keys):
+        """ Backup the databases on a pool of self.parallel workers. A failing
+            database is reported without aborting the others, and all the
+            failures are raised (and emailed) together at the end.
+        """
+        pool = ThreadPool(min(self.parallel, len(database_keys)))
+        try:
+            results = pool.map(self.try_backup_database, database_keys)
+        finally:
+            pool.close()
+            pool.join()
+        print "Backup results:"
+        for database_key, error in results:
+            print "  %s: %s" % (database_key, "FAILED (%s)" % error if error else "OK")
+        failed = [(database_key, error) for database_key, error in results if error]
+        if failed:
+            raise CommandError("Backup failed for %s of %s databases: %s" % (len(failed), len(results),
+                '; '.join("%s (%s)" % (database_key, error) for database_key, error in failed)))
+
+    def try_backup_database(self, database_key):
+        """ Backup a single database, returning (database_key, error). """
+        try:
+            self.backup_database(database_key)
+        except Exception, err:
+            return database_key, err
+        return database_key, None
+
+    def save_new_backup(self, database, dbcommands):
         """ Save a new backup file. """
         print "Backing Up Database: %s" % database['NAME']
-        backupfile = tempfile.SpooledTemporaryFile(max_size=10*1024*1024)
-        backupfile.name = self.dbcommands.filename(self.servername)
-        self.dbcommands.run_backup_commands(backupfile)
-        print "  Backup tempfile created: %s (%s)" % (backupfile.name, utils.handle_size(backupfile))
-        print "  Writing file to %s: %s" % (self.storage.name, self.storage.backup_dir())
-        self.storage.write_file(backupfile)
-
-    def cleanup_old_backups(self, database):
-        """ Cleanup old backups.  Delete everything but the last 10
-            backups, and any backup that occur on first of the month.
+        filename = dbcommands.filename(self.servername)
+        digest = utils.ChunkDigest(dbcommands.stream_backup_commands())
+        chunks = metrics.timed_chunks(digest, 'checksum', database['NAME'])
+        with metrics.stage('upload', database['NAME'], self.storage.name) as timer:
+            if self.deduplicate:
+                filename = self.dedup_new_backup(database, chunks, filename)
+            elif self.streaming:
+                self.stream_new_backup(database, chunks, filename)
+            else:
+                with metrics.stage('spool', database['NAME']) as spool:
+                    backupfile = utils.spool_chunks(chunks, filename)
+                    spool.size = digest.size
+                print "  Backup tempfile created: %s (%s)" % (backupfile.name, utils.handle_size(backupfile))
+                print "  Writing file to %s: %s" % (self.storage.name, self.storage.backup_dir())
+                with self.storage.upload_slots:
+                    self.storage.write_file(backupfile)
+            timer.size = digest.size
+        self.record_backup(database, dbcommands, filename, digest.size, digest.hexdigest())
+
+    def resume_new_backup(self, database, dbcommands):
+        """ Save a new backup file through a local checkpoint: the dump is
+            staged in DBBACKUP_CHECKPOINT_DIRECTORY and the upload progress
+            journaled, so a rerun with --resume continues an interrupted
+            upload instead of dumping and uploading again.
         """
+        print "Backing Up Database: %s" % database['NAME']
+        journal = checkpoint.Journal('dbbackup', self.storage.name, database['NAME'],
+            self.servername or '', self.compression or '', str(self.deduplicate))
+        state = journal.state
+        if state.get('filename') and os.path.exists(journal.staging) \
+                and os.path.getsize(journal.staging) == state['size']:
+            print "  Resuming interrupted backup: %s" % state['filename']
+        else:
+            journal.remove()
+            filename = dbcommands.filename(self.servername)
+            chunks = utils.ChunkDigest(dbcommands.stream_backup_commands())
+            with metrics.stage('spool', database['NAME']) as spool:
+                with open(journal.staging, 'wb') as stagedfile:
+                    for data in metrics.timed_chunks(chunks, 'checksum', database['NAME']):
+                        stagedfile.write(data)
+                spool.size = chunks.size
+            journal.update(filename=filename, size=chunks.size, checksum=chunks.hexdigest())
+            print "  Backup staged: %s (%s)" % (journal.staging, utils.bytes_to_str(chunks.size))
+        filename = str(state['filename'])
+        with open(journal.staging, 'rb') as stagedfile, \
+                metrics.stage('upload', database['NAME'], self.storage.name) as timer:
+            if self.deduplicate:
+                # Chunks uploaded before the interruption are found in storage
+                filename = self.dedup_new_backup(database, utils.iter_chunks(stagedfile, STREAM_CHUNK_SIZE), filename)
+            else:
+                print "  Writing file to %s: %s" % (self.storage.name, self.storage.backup_dir())
+                with self.storage.upload_slots:
+                    self.storage.write_file_resumable(stagedfile, filename, journal.section(self.storage.name))
+            timer.size = state['size']
+        self.record_backup(database, dbcommands, filename, state['size'], state['checksum'])
+        # Keep the checkpoint while a mirror storage still misses the backup
+        if not any(name == filename for storage, name, error in getattr(self.storage, 'failures', [])):
+            journal.remove()
+
+    def stream_new_backup(self, database, chunks, filename):
+        """ Save a new backup file, uploading it while the dump runs. """
+        chunks = self.buffered_chunks(database, chunks)
+        print "  Streaming %s to %s: %s" % (filename, self.storage.name, self.storage.backup_dir())
+        with self.storage.upload_slots:
+            self.storage.write_stream(chunks, filename)
+
+    def dedup_new_backup(self, database, chunks, filename):
+        """ Save a new deduplicated backup, uploading only new chunks.
+            Returns the filename of its manifest.
+        """
+        chunks = self.buffered_chunks(database, chunks)
+        print "  Deduplicating %s to %s: %s" % (filename, self.storage.name, self.storage.backup_dir())
+        with self.storage.upload_slots:
+            dedup.write_backup(self.storage, chunks, filename, self.compression)
+        return dedup.manifest_name(filename)
+
+    def buffered_chunks(self, database, chunks):
+        """ Read ahead from chunks while they are uploaded. The time the
+            upload waits for the dump is reported as the buffer_wait stage.
+        """
+        chunks = utils.buffered_chunks(chunks, STREAM_BUFFER_SIZE, STREAM_CHUNK_SIZE)
+        return metrics.timed_chunks(chunks, 'buffer_wait', database['NAME'])
+
+    def backup_database_tables(self, database_key, database):
+        """ Save a new backup of the selected tables of a single database and
+            cleanup the old backups of the same tables.
+        """
+        selected = registry.resolve(database_key, self.apps, self.tables)
+        if not selected:
+            print "No selected tables in database: %s" % database['NAME']
+            return
+        dbcommands = DBCommands(database, self.compression)
+        if not self.dry_run:
+            self.save_new_table_backup(database_key, database, dbcommands, selected)
         if self.clean:
-            print "Cleaning Old Backups for: %s" % database['NAME']
+            with metrics.stage('cleanup', database['NAME'], self.storage.name):
+                self.cleanup_table_backups(database, dbcommands, selected)
+
+    def save_new_table_backup(self, database_key, database, dbcommands, selected):
+        """ Save every selected table to its own file, plus the manifest. """
+        print "Backing Up Tables of Database: %s (%s)" % (database['NAME'], ', '.join(selected))
+        filename = dbcommands.filename(self.servername, extension=tables.selection_extension(selected))
+        with metrics.stage('upload', database['NAME'], self.storage.name) as timer:
+            with self.storage.upload_slots:
+                manifest = tables.write_backup(self.storage, database, selected,
+                    registry.dependencies(database_key, selected), filename, self.compression)
+            timer.size = sum(entry['size'] for entry in manifest['tables'].values())
+        print "  Manifest written: %s" % filename
+
+    def record_backup(self, database, dbcommands, filename, size, checksum):
+        """ Add a new backup file to the catalog. """
+        if self.catalog:
+            timestamp = dbcommands.filename_timestamp(filename, self.servername)
+            filepath = os.path.join(self.storage.backup_dir(), filename)
+            self.catalog.add(database, self.servername, timestamp, filepath,
+                size, self.compression, checksum)
+
+    def cleanup_old_backups(self, database, dbcommands):
+        """ Cleanup old backups following DBBACKUP_RETENTION. By default
+            delete everything but the last 10 backups, and any backup that
+            occur on first of the month. Chunks no longer referenced by a
+            manifest are deleted too.
+        """
+        if self.clean:
+            with metrics.stage('cleanup', database['NAME'], self.storage.name):
+                self.cleanup_database_backups(database, dbcommands)
+
+    def cleanup_database_backups(self, database, dbcommands):
+        """ Apply the retention plan to the backups of a database. """
+        print "Cleaning Old Backups for: %s" % database['NAME']
+        sizes = {}
+        if self.catalog:
+            self.catalog.index(dbcommands, self.servername)
+            entries = self.catalog.backups(database, self.servername)
+            filepaths = [entry[3] for entry in entries]
+            sizes = dict((entry[3], entry[4]) for entry in entries)
+        else:
             filepaths = self.storage.list_directory()
-            filepaths = self.dbcommands.filter_filepaths(filepaths)
-            for filepath in sorted(filepaths[0:-10]):
-                regex = self.dbcommands.filename_match(self.servername, '(.*?)')
-                datestr = re.findall(regex, filepath)[0]
-                dateTime = datetime.datetime.strptime(datestr, DATE_FORMAT)
-                if int(dateTime.strftime("%d")) != 1:
-                    print "  Deleting: %s" % filepath
-                    self.storage.delete_file(filepath)
+        parser = dbcommands.filename_parser(self.servername)
+        backups = filter(None, map(parser.parse, filepaths))
+        if retention.caps_size():
+            # Backups the catalog has no size for count with their stored size
+            missing = [backup.filepath for backup in backups if sizes.get(backup.filepath) is None]
+            sizes.update(zip(missing, self.storage.map_concurrently(self.storage.file_size, missing)))
+        plan = retention.plan(backups, sizes=sizes)
+        if self.dry_run:
+            return self.print_plan(plan)
+        deletes = [backup.filepath for backup in plan.delete]
+        for filepath in deletes:
+            print "  Deleting: %s" % filepath
+        self.storage.delete_files(deletes)
+        if self.catalog:
+            self.catalog.remove(deletes)
+        if any(dedup.is_manifest(backup.filepath) for backup in plan.keep + plan.delete):
+            dedup.collect_garbage(self.storage)
+
+    def cleanup_table_backups(self, database, dbcommands, selected):
+        """ Apply the retention plan to the backups of the same tables, so
+            backups of other tables kept on another schedule are left alone.
+        """
+        print "Cleaning Old Table Backups for: %s" % database['NAME']
+        backups = tables.list_backups(self.storage, dbcommands, self.servername, selected)
+        manifests, sizes = {}, {}
+        if retention.caps_size():
+            # The size of a table backup is the total of its table files
+            manifests = self.read_table_manifests([backup.filepath for backup in backups])
+            sizes = dict((filepath, sum(entry['size'] for entry in manifest['tables'].values()))
+                for filepath, manifest in manifests.items())
+        plan = retention.plan(backups, sizes=sizes)
+        if self.dry_run:
+            return self.print_plan(plan)
+        deletes = [backup.filepath for backup in plan.delete]
+        manifests.update(self.read_table_manifests([filepath for filepath in deletes if filepath not in manifests]))
+        for filepath in deletes:
+            print "  Deleting: %s" % filepath
+        # Manifests first, so no backup refers to deleted table files
+        self.storage.delete_files(deletes)
+        self.storage.delete_files([path for filepath in deletes
+            for path in tables.table_paths(filepath, manifests[filepath])])
+
+    def read_table_manifests(self, filepaths):
+        """ Return the manifests of table backups by filepath. """
+        manifests = self.storage.map_concurrently(lambda filepath: tables.read_manifest(self.storage, filepath), filepaths)
+        return dict(zip(filepaths, manifests))
+
+    def print_plan(self, plan):
+        """ Print what a retention plan keeps and deletes. """
+        keep = set(plan.keep)
+        for backup in sorted(plan.keep + plan.delete, key=retention.sort_key):
+            action = "Keeping" if backup in keep else "Would delete"
+            print "  %s: %s (%s)" % (action, backup.filepath, ', '.join(plan.reasons[backup.filepath]))
@@ -2,8 +2,10 @@
 Restore pgdump files from Dropbox.
 See __init__.py for a list of options.
 """
-from ... import utils
-from ...dbcommands import DBCommands
+from ... import archive, checkpoint, compression, dedup, metrics, registry, tables, utils, verify
+from ...catalog import Catalog, CATALOG
+from ...dbcommands import DBCommands, SERIALIZER_RESTORE, SERIALIZER_SETTINGS
+from ...dbcommands import STREAMING, STREAM_BUFFER_SIZE, STREAM_CHUNK_SIZE
 from ...storage.base import BaseStorage
 from ...storage.base import StorageError
 from django.conf import settings
@@ -15,25 +17,52 @@ from optparse import make_option
 
 
 class Command(LabelCommand):
-    help = "dbrestore [-d <dbname>] [-f <filename>] [-s <servername>]"
+    help = "dbrestore [-d <dbname>] [-f <filename>] [-s <servername>] [--stream] [--resume] [--stats] [-t <tables>] [-a <apps>] [-m <models>] [--to-time <time>]"
     option_list = BaseCommand.option_list + (
         make_option("-d", "--database", help="Database to restore"),
         make_option("-f", "--filepath", help="Specific file to backup from"),
         make_option("-s", "--servername", help="Use a different servername backup"),
+        make_option("--stream", help="Restore the backup while it is being downloaded", action="store_true", default=STREAMING),
+        make_option("--resume", help="Continue an interrupted download of the backup", action="store_true", default=False),
+        make_option("--stats", help="Print the time and bytes of every stage as JSON", action="store_true", default=False),
+        make_option("-t", "--table", help="Comma separated tables or app_label.Model names to restore from a table backup"),
+        make_option("-a", "--app", help="Comma separated app labels whose tables to restore from a table backup"),
+        make_option("-m", "--model", help="Comma separated tables or app_label.Model names to restore from a serializer backup"),
+        make_option("--to-time", help="Restore the nearest base backup and replay the archived logs up to this time"),
     )
 
     def handle(self, **options):
         """ Django command handler. """
+        stats, success = metrics.Stats('dbrestore'), False
         try:
             connection.close()
             self.filepath = options.get('filepath')
             self.servername = options.get('servername')
+            self.streaming = options.get('stream')
+            self.resume = options.get('resume')
+            self.tables = filter(None, (options.get('table') or '').split(','))
+            self.apps = filter(None, (options.get('app') or '').split(','))
+            self.models = filter(None, (options.get('model') or '').split(','))
+            self.to_time = archive.parse_time(options['to_time']) if options.get('to_time') else None
             self.database = self._get_database(options)
             self.storage = BaseStorage.storage_factory()
+            self.catalog = Catalog(self.storage) if CATALOG and not self.to_time else None
             self.dbcommands = DBCommands(self.database)
-            self.restore_backup()
+            if self.to_time and (self.tables or self.apps or self.models):
+                raise CommandError("--to-time restores the whole database and cannot be combined with --table, --app or --model")
+            if self.models and (self.tables or self.apps):
+                raise CommandError("--model restores from a full backup and cannot be combined with --table or --app")
+            if self.to_time:
+                self.recovery_settings()
+            if self.tables or self.apps or (self.filepath and tables.is_manifest(self.filepath)):
+                self.restore_tables()
+            else:
+                self.restore_backup()
+            success = True
         except StorageError, err:
             raise CommandError(err)
+        finally:
+            stats.finish(success, options.get('stats'))
 
     def _get_database(self, options):
         """ Get the database to restore. """
@@ -44,21 +73,161 @@ class Command(LabelCommand):
                 errmsg += " must specify the --database option."
                 raise CommandError(errmsg)
             database_key = settings.DATABASES.keys()[0]
+        self.database_key = database_key
         return settings.DATABASES[database_key]
 
+    def recovery_settings(self):
+        """ Restore base backups, up to self.to_time. """
+        archive.check_supported(self.dbcommands)
+        self.dbcommands.settings = archive.base_settings(self.dbcommands.settings)
+        self.dbcommands.variables.update({
+            'totime': self.to_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'fetchcommand': archive.fetch_command(self.database_key, self.servername),
+        })
+
+    def latest_backup(self):
+        """ Return the filepath of the latest backup (the latest base backup
+            before --to-time), or None.
+        """
+        if self.to_time:
+            return archive.find_base_backup(self.storage, self.dbcommands, self.to_time, self.servername)
+        if self.catalog:
+            self.catalog.index(self.dbcommands, self.servername)
+            return self.catalog.latest(self.database, self.servername,
+                self.dbcommands.filename_parser(self.servername))
+        filepaths = self.storage.list_directory()
+        filepaths = self.dbcommands.filter_filepaths(filepaths, self.servername)
+        return filepaths[-1] if filepaths else None
+
+    def expected_checksum(self):
+        """ Return the (size, sha256) the catalog recorded for the backup,
+            or None.
+        """
+        entry = self.catalog.find(self.filepath) if self.catalog else None
+        if not entry or not entry[6]:
+            print "  No checksum recorded, the backup will not be verified"
+            return None
+        return entry[4], entry[6]
+
+    def verified_chunks(self, chunks, expected):
+        """ Check chunks against the expected (size, sha256) while they are
+            read, timing the hashing as the checksum stage.
+        """
+        chunks = verify.verified_chunks(chunks, expected[0], expected[1], self.filepath)
+        return metrics.timed_chunks(chunks, 'checksum', self.database['NAME'])
+
     def restore_backup(self):
         """ Restore the specified database. """
         print "Restoring backup for database: %s" % self.database['NAME']
+        commands = self.restore_commands()
         # Fetch the latest backup if filepath not specified
         if not self.filepath:
             print "  Finding latest backup"
-            filepaths = self.storage.list_directory()
-            filepaths = self.dbcommands.filter_filepaths(filepaths, self.servername)
-            if not filepaths:
+            self.filepath = self.latest_backup()
+            if not self.filepath:
+                if self.to_time:
+                    raise CommandError("No base backup before %s found in: %s" % (self.to_time, self.storage.backup_dir()))
                 raise CommandError("No backup files found in: %s" % self.storage.backup_dir())
-            self.filepath = filepaths[-1]
         # Restore the specified filepath backup
         print "  Restoring: %s" % self.filepath
-        backupfile = self.storage.read_file(self.filepath)
-        print "  Restore tempfile created: %s" % utils.handle_size(backupfile)
-        self.dbcommands.run_restore_commands(backupfile)
+        codec = compression.codec_for_filename(self.filepath)
+        expected = self.expected_checksum()
+        journal = None
+        name = self.database['NAME']
+        if dedup.is_manifest(self.filepath):
+            backupfile, codec = dedup.read_backup(self.storage, self.filepath), None
+            backupfile = metrics.timed_chunks(backupfile, 'download', name, self.storage.name)
+            if expected:
+                backupfile = self.verified_chunks(backupfile, expected)
+            print "  Reassembling deduplicated backup from %s" % self.storage.name
+        elif self.resume:
+            journal = checkpoint.Journal('dbrestore', self.storage.name, self.filepath)
+            journal.update(filepath=self.filepath)
+            with metrics.stage('download', name, self.storage.name) as timer:
+                backupfile = self.storage.read_file_resumable(self.filepath, journal.staging)
+                backupfile.seek(0, 2)
+                timer.size = backupfile.tell()
+            print "  Restore file downloaded: %s (%s)" % (journal.staging, utils.handle_size(backupfile))
+            if expected:
+                # Part of the file may come from an earlier run: hash it locally
+                backupfile.seek(0)
+                try:
+                    for data in self.verified_chunks(utils.iter_chunks(backupfile, 1024*1024), expected):
+                        pass
+                except verify.ChecksumError:
+                    # Download from scratch next time
+                    backupfile.close()
+                    journal.remove()
+                    raise
+                print "  Checksum verified"
+        elif self.streaming:
+            backupfile = self.storage.read_stream(self.filepath)
+            backupfile = metrics.timed_chunks(backupfile, 'download', name, self.storage.name)
+            if expected:
+                # A mismatch fails the restore once the last chunk is read
+                backupfile = self.verified_chunks(backupfile, expected)
+            backupfile = utils.buffered_chunks(backupfile, STREAM_BUFFER_SIZE, STREAM_CHUNK_SIZE)
+            backupfile = metrics.timed_chunks(backupfile, 'buffer_wait', name)
+            print "  Streaming restore from %s" % self.storage.name
+        elif expected:
+            # Hash while downloading, so the database is left alone on a mismatch
+            backupfile = self.storage.read_stream(self.filepath)
+            backupfile = metrics.timed_chunks(backupfile, 'download', name, self.storage.name)
+            backupfile = self.verified_chunks(backupfile, expected)
+            with metrics.stage('spool', name) as timer:
+                backupfile = utils.spool_chunks(backupfile, self.filepath)
+                timer.size = expected[0] or 0
+            print "  Restore tempfile created: %s" % utils.handle_size(backupfile)
+            print "  Checksum verified"
+        else:
+            with metrics.stage('download', name, self.storage.name) as timer:
+                backupfile = self.storage.read_file(self.filepath)
+                backupfile.seek(0, 2)
+                timer.size = backupfile.tell()
+            print "  Restore tempfile created: %s" % utils.handle_size(backupfile)
+        if codec:
+            print "  Decompressing with: %s" % codec
+        position = None
+        if self.to_time and getattr(self.dbcommands.settings, 'REPLAY_COMMANDS', None):
+            # The binlog position is read from the top of the backup first
+            if not hasattr(backupfile, 'read'):
+                backupfile = utils.spool_chunks(backupfile, self.filepath)
+            position = archive.binlog_position(backupfile, codec)
+        self.dbcommands.run_restore_commands(backupfile, codec, commands)
+        if position:
+            archive.replay_logs(self.storage, self.dbcommands, position, self.servername)
+        if journal:
+            backupfile.close()
+            journal.remove()
+
+    def restore_commands(self):
+        """ Return the commands loading the --model tables only from a
+            serializer backup, or None for the engine's restore commands.
+        """
+        if not self.models:
+            return None
+        if self.dbcommands.settings is not SERIALIZER_SETTINGS:
+            raise CommandError("--model requires serializer backups (DBBACKUP_SERIALIZE)")
+        selected = registry.resolve(self.database_key, names=self.models)
+        if not selected:
+            raise CommandError("No selected tables in database: %s" % self.database['NAME'])
+        print "  Restoring tables: %s" % ', '.join(selected)
+        return [[SERIALIZER_RESTORE, ','.join(selected)]]
+
+    def restore_tables(self):
+        """ Restore the selected tables, or all the tables of the table
+            backup given, from the latest table backup holding them.
+        """
+        selected = registry.resolve(self.database_key, self.apps, self.tables) if self.tables or self.apps else []
+        if (self.tables or self.apps) and not selected:
+            raise CommandError("No selected tables in database: %s" % self.database['NAME'])
+        print "Restoring tables for database: %s" % self.database['NAME']
+        if self.filepath:
+            manifest = tables.read_manifest(self.storage, self.filepath)
+        else:
+            print "  Finding latest table backup"
+            self.filepath, manifest = tables.find_backup(self.storage, self.dbcommands, self.servername, selected)
+            if not self.filepath:
+                raise CommandError("No table backup of %s found in: %s" % (', '.join(selected), self.storage.backup_dir()))
+        print "  Restoring: %s (%s)" % (self.filepath, ', '.join(selected or sorted(manifest['tables'])))
+        tables.restore_backup(self.storage, self.database, self.filepath, manifest, selected)
@@ -0,0 +1,75 @@
+"""
+Verify stored backups against their catalog checksums.
+"""
+from datetime import datetime, timedelta
+from ... import utils, verify
+from ...catalog import Catalog, CATALOG, TIMESTAMP_FORMAT
+from ...dbcommands import DBCommands
+from ...storage.base import BaseStorage
+from ...storage.base import StorageError
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.core.management.base import LabelCommand
+from optparse import make_option
+
+DATABASE_KEYS = getattr(settings, 'DBBACKUP_DATABASES', settings.DATABASES.keys())
+
+
+class Command(LabelCommand):
+    help = "dbverify [-d <dbname>] [-s <servername>] [--days <N>] [--quick] [--parallel <N>]"
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--database", help="Database whose backups to verify (default: everything)"),
+        make_option("-s", "--servername", help="Verify the backups of a different servername"),
+        make_option("--days", help="Only verify the backups of the last N days", type="int"),
+        make_option("--quick", help="Only compare the stored sizes instead of reading the backups", action="store_true", default=False),
+        make_option("--parallel", help="Number of backups to verify concurrently", type="int", default=verify.WORKERS),
+    )
+
+    @utils.email_uncaught_exception
+    def handle(self, **options):
+        """ Django command handler. """
+        try:
+            if not CATALOG:
+                raise CommandError("dbverify needs the checksums kept in the catalog (DBBACKUP_CATALOG)")
+            self.servername = options.get('servername')
+            self.quick = options.get('quick')
+            self.parallel = max(1, options.get('parallel') or 1)
+            self.storage = BaseStorage.storage_factory()
+            self.catalog = Catalog(self.storage)
+            database_keys = (options['database'],) if options.get('database') else DATABASE_KEYS
+            entries = []
+            for database_key in database_keys:
+                entries.extend(self.database_backups(settings.DATABASES[database_key]))
+            if options.get('days'):
+                since = (datetime.now() - timedelta(days=options['days'])).strftime(TIMESTAMP_FORMAT)
+                entries = [entry for entry in entries if entry[2] >= since]
+            self.verify_storages(entries)
+        except StorageError, err:
+            raise CommandError(err)
+
+    def database_backups(self, database):
+        """ Return the catalog entries of a database. """
+        self.catalog.index(DBCommands(database), self.servername)
+        return self.catalog.backups(database, self.servername)
+
+    def verify_storages(self, entries):
+        """ Verify the backups on every storage, mirrors included. """
+        failed = 0
+        for storage in getattr(self.storage, 'storages', [self.storage]):
+            if storage is not self.storage:
+                storage_entries = [entry[:3] + (self.storage.translate(storage, entry[3]),) + entry[4:]
+                    for entry in entries]
+            else:
+                storage_entries = entries
+            print "Verifying %s backups on %s%s" % (len(entries), storage.name,
+                " (sizes only)" if self.quick else "")
+            results = verify.verify_backups(storage, storage_entries, self.quick, self.parallel)
+            for entry, status, message in results:
+                print "  %s: %s%s" % (status, entry[3], " (%s)" % message if message else "")
+            counts = dict((status, sum(1 for result in results if result[1] == status))
+                for status in (verify.OK, verify.FAILED, verify.SKIPPED))
+            print "  %(OK)s verified, %(FAILED)s failed, %(SKIPPED)s skipped" % counts
+            failed += counts[verify.FAILED]
+        if failed:
+            raise CommandError("%s backups failed verification" % failed)
@@ -0,0 +1,191 @@
+"""
+Timing and byte counters for every stage of a backup or restore (dump,
+compression, storage calls, cleanup, restore load), sent as a Django signal
+and optionally exported to StatsD or a Prometheus textfile.
+"""
+import json, os, re, socket, threading, time
+from contextlib import contextmanager
+from django.conf import settings
+from django.dispatch import Signal
+
+STATSD_HOST = getattr(settings, 'DBBACKUP_STATSD_HOST', None)
+STATSD_PORT = getattr(settings, 'DBBACKUP_STATSD_PORT', 8125)
+STATSD_PREFIX = getattr(settings, 'DBBACKUP_STATSD_PREFIX', 'dbbackup')
+PROMETHEUS_DIRECTORY = getattr(settings, 'DBBACKUP_PROMETHEUS_DIRECTORY', None)
+
+# Sent once per stage with the seconds spent in the stage itself (time
+# spent in nested stages of the same thread is not counted) and its bytes.
+stage_finished = Signal(providing_args=['stage', 'seconds', 'size', 'database', 'storage'])
+
+_local = threading.local()
+
+
+##################################
+#  Stage Timers
+##################################
+
+class Timer(object):
+    """ Accumulate the time spent in a stage over one or more start/stop
+        intervals. Time spent in timers started while this one runs (on the
+        same thread) is subtracted, so a stage wrapping a chunk generator
+        does not count the time of the stages producing its chunks.
+    """
+
+    def __init__(self, stage, database=None, storage=None):
+        self.stage, self.database, self.storage = stage, database, storage
+        self.seconds, self.size = 0.0, 0
+        self.finished = False
+
+    def start(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        stack.append(self)
+        self._started, self._nested = time.time(), 0.0
+
+    def stop(self):
+        elapsed = time.time() - self._started
+        stack = _local.stack
+        stack.pop()
+        self.seconds += elapsed - self._nested
+        if stack:
+            stack[-1]._nested += elapsed
+
+    def finish(self):
+        """ Send stage_finished, once. """
+        if not self.finished:
+            self.finished = True
+            stage_finished.send(sender=Timer, stage=self.stage, seconds=self.seconds,
+                size=self.size, database=self.database, storage=self.storage)
+
+@contextmanager
+def stage(name, database=None, storage=None):
+    """ Time the enclosed block as a stage. Set size on the yielded timer to
+        report the bytes it processed.
+    """
+    timer = Timer(name, database, storage)
+    timer.start()
+    try:
+        yield timer
+    finally:
+        timer.stop()
+        timer.finish()
+
+def timed_chunks(chunks, name, database=None, storage=None):
+    """ Yield chunks, timing only the production of each chunk as a stage
+        and counting its bytes. The time the consumer spends between two
+        chunks is left to the consumer's own stage.
+    """
+    timer = Timer(name, database, storage)
+    chunks = iter(chunks)
+    try:
+        while True:
+            timer.start()
+            try:
+                data = next(chunks, None)
+            finally:
+                timer.stop()
+            if data is None:
+                break
+            timer.size += len(data)
+            yield data
+    finally:
+        timer.finish()
+
+
+##################################
+#  Run Statistics
+##################################
+
+class Stats(object):
+    """ Collect the stages of a command run, for the --stats summary and
+        the Prometheus textfile.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stages = {}
+        stage_finished.connect(self.record, sender=Timer, weak=False)
+
+    def record(self, sender, stage, seconds, size, database, storage, **kwargs):
+        with self.lock:
+            totals = self.stages.setdefault((stage, database, storage), [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += size
+            totals[2] += 1
+
+    def summary(self, success=True):
+        """ Return the run as a dict of plain values. """
+        stages = []
+        for (stage, database, storage), (seconds, size, calls) in sorted(self.stages.items()):
+            stages.append({'stage': stage, 'database': database, 'storage': storage,
+                'seconds': round(seconds, 3), 'bytes': size, 'calls': calls,
+                'bytes_per_second': int(size / seconds) if seconds and size else None})
+        return {'command': self.command, 'success': success, 'started': int(self.started),
+            'seconds': round(time.time() - self.started, 3), 'stages': stages}
+
+    def finish(self, success=True, show=False):
+        """ Stop collecting, write the Prometheus textfile if configured and
+            print the summary as JSON if show.
+        """
+        stage_finished.disconnect(self.record, sender=Timer)
+        summary = self.summary(success)
+        if PROMETHEUS_DIRECTORY:
+            write_textfile(summary, os.path.join(PROMETHEUS_DIRECTORY, '%s.prom' % self.command))
+        if show:
+            print json.dumps(summary, indent=2, sort_keys=True)
+        return summary
+
+
+##################################
+#  Exporters
+##################################
+
+def statsd_name(*parts):
+    return '.'.join(re.sub(r'[^\w-]+', '_', part).strip('_') for part in parts if part)
+
+def send_statsd(sender, stage, seconds, size, database, storage, **kwargs):
+    """ stage_finished receiver sending a timer and a byte counter. """
+    name = statsd_name(STATSD_PREFIX, database, storage, stage)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto("%s.time:%d|ms\n%s.bytes:%d|c" % (name, seconds * 1000, name, size),
+            (STATSD_HOST, STATSD_PORT))
+    except socket.error:
+        # Metrics must never fail a backup
+        pass
+    finally:
+        sock.close()
+
+if STATSD_HOST:
+    stage_finished.connect(send_statsd, sender=Timer)
+
+def prometheus_labels(**labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items()) if value is not None)
+
+def write_textfile(summary, path):
+    """ Write a run summary for the node_exporter textfile collector. The
+        file is replaced atomically so a scrape never sees half of it.
+    """
+    command = summary['command']
+    lines = []
+    for metric, key in (('dbbackup_stage_seconds', 'seconds'), ('dbbackup_stage_bytes', 'bytes')):
+        lines.append('# TYPE %s gauge' % metric)
+        for row in summary['stages']:
+            labels = prometheus_labels(command=command, stage=row['stage'],
+                database=row['database'], storage=row['storage'])
+            lines.append('%s{%s} %s' % (metric, labels, row[key]))
+    labels = prometheus_labels(command=command)
+    lines += [
+        '# TYPE dbbackup_run_seconds gauge',
+        'dbbackup_run_seconds{%s} %s' % (labels, summary['seconds']),
+        '# TYPE dbbackup_run_success gauge',
+        'dbbackup_run_success{%s} %d' % (labels, summary['success']),
+        '# TYPE dbbackup_run_timestamp_seconds gauge',
+        'dbbackup_run_timestamp_seconds{%s} %d' % (labels, summary['started']),
+    ]
+    partialpath = "%s.%s.partial" % (path, os.getpid())
+    with open(partialpath, 'w') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.rename(partialpath, path)
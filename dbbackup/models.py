@@ -0,0 +1,3 @@
+"""
+No models, this module lets Django find the tests of the app.
+"""
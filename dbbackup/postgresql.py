@@ -0,0 +1,31 @@
+"""
+Recovery settings of a PostgreSQL data directory restored from a base
+backup, so the server replays the archived WAL up to a point in time.
+"""
+import os
+
+
+def server_version(datadir):
+    """ Return the major version of the data directory. """
+    with open(os.path.join(datadir, 'PG_VERSION')) as versionfile:
+        return int(versionfile.read().strip().split('.')[0])
+
+def write_recovery(datadir, to_time, restore_command):
+    """ Configure the data directory to fetch the archived segments with
+        restore_command up to to_time, then promote. PostgreSQL 12 and later
+        read the settings from postgresql.auto.conf and recovery.signal,
+        earlier versions from recovery.conf.
+    """
+    print "  Configuring recovery of %s to: %s" % (datadir, to_time)
+    lines = [
+        "restore_command = '%s'" % restore_command.replace("'", "''"),
+        "recovery_target_time = '%s'" % to_time,
+        "recovery_target_action = 'promote'",
+    ]
+    if server_version(datadir) >= 12:
+        with open(os.path.join(datadir, 'postgresql.auto.conf'), 'a') as conffile:
+            conffile.write('\n'.join(lines) + '\n')
+        open(os.path.join(datadir, 'recovery.signal'), 'w').close()
+    else:
+        with open(os.path.join(datadir, 'recovery.conf'), 'w') as conffile:
+            conffile.write('\n'.join(lines) + '\n')
@@ -0,0 +1,72 @@
+"""
+Resolve the tables of the installed models stored in a database, and order
+them so the tables a table references come first.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+from django.db import models, router
+
+
+def registry_tables(database_key):
+    """ Return {table: model} for the models syncdb creates in the database,
+        including the tables of many-to-many fields.
+    """
+    tables = {}
+    for model in models.get_models(include_auto_created=True):
+        if not model._meta.proxy and router.allow_syncdb(database_key, model):
+            tables[model._meta.db_table] = model
+    return tables
+
+def resolve(database_key, apps=(), names=()):
+    """ Return the sorted tables of the app labels and the table or
+        app_label.Model names given which are stored in the database.
+    """
+    tables = registry_tables(database_key)
+    known = set(model._meta.db_table for model in models.get_models(include_auto_created=True))
+    selected = set()
+    for label in apps:
+        try:
+            models.get_app(label)
+        except ImproperlyConfigured:
+            raise CommandError("Unknown app: %s" % label)
+        selected.update(table for table, model in tables.items() if model._meta.app_label == label)
+    for name in names:
+        if '.' in name:
+            model = models.get_model(*name.split('.', 1))
+            if model is None:
+                raise CommandError("Unknown model: %s" % name)
+            name = model._meta.db_table
+        elif name not in known:
+            raise CommandError("Unknown table: %s" % name)
+        # Tables routed to another database are left to its backup
+        if name in tables:
+            selected.add(name)
+    return sorted(selected)
+
+def dependencies(database_key, selected):
+    """ Return {table: [tables it references]} within selected. """
+    tables = registry_tables(database_key)
+    result = {}
+    for table in selected:
+        parents = set()
+        for field in tables[table]._meta.fields:
+            meta = getattr(getattr(field.rel, 'to', None), '_meta', None)
+            if meta and meta.db_table in selected and meta.db_table != table:
+                parents.add(meta.db_table)
+        result[table] = sorted(parents)
+    return result
+
+def load_order(dependencies):
+    """ Group tables into levels whose tables only reference tables of the
+        levels before. Tables in a reference cycle form the last level.
+    """
+    remaining = dict((table, set(parents) & set(dependencies)) for table, parents in dependencies.items())
+    levels = []
+    while remaining:
+        level = sorted(table for table, parents in remaining.items() if not parents) or sorted(remaining)
+        for table in level:
+            del remaining[table]
+        for parents in remaining.values():
+            parents.difference_update(level)
+        levels.append(level)
+    return levels
@@ -0,0 +1,115 @@
+"""
+Decide which backups cleanup_old_backups keeps and deletes.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import CommandError
+
+KEEP_LAST = 10
+RETENTION = getattr(settings, 'DBBACKUP_RETENTION', None)
+
+# Grandfather-father-son rules: keep the newest backup of each of the N
+# most recent periods that have a backup.
+PERIODS = (
+    ('hourly', lambda d: (d.year, d.month, d.day, d.hour)),
+    ('daily', lambda d: (d.year, d.month, d.day)),
+    ('weekly', lambda d: d.isocalendar()[:2]),
+    ('monthly', lambda d: (d.year, d.month)),
+    ('yearly', lambda d: d.year),
+)
+POLICY_KEYS = set(['last', 'max_age', 'max_size']) | set(name for name, period in PERIODS)
+
+Plan = namedtuple('Plan', 'keep delete reasons')
+
+
+def sort_key(backup):
+    return (backup.datetime or datetime.min, backup.filepath)
+
+def plan_cleanup(backups, keep_last=KEEP_LAST):
+    """ Split parsed backup filenames into (keep, delete) lists in a single
+        pass. Everything but the last keep_last backups is deleted, except
+        the backups made on the first of the month and backups whose date
+        could not be parsed.
+    """
+    backups = sorted(backups, key=sort_key)
+    cutoff = len(backups) - keep_last
+    keep, delete = [], []
+    for index, backup in enumerate(backups):
+        if index < cutoff and backup.datetime and backup.datetime.day != 1:
+            delete.append(backup)
+        else:
+            keep.append(backup)
+    return keep, delete
+
+def check_policy(policy):
+    unknown = set(policy) - POLICY_KEYS
+    if unknown:
+        raise CommandError("Unknown DBBACKUP_RETENTION keys: %s (choose from: %s)" % (
+            ', '.join(sorted(unknown)), ', '.join(sorted(POLICY_KEYS))))
+
+def plan_policy(backups, policy, sizes=None, now=None):
+    """ Apply a retention policy to parsed backup filenames, newest first in
+        a single pass. policy is a dict of the number of backups to keep
+        ('last') and of periods to keep ('hourly', 'daily', 'weekly',
+        'monthly', 'yearly'), capped by 'max_age' (days or a timedelta) and
+        'max_size' (total bytes, using sizes by filepath). The newest backup
+        and backups whose date could not be parsed are always kept.
+    """
+    check_policy(policy)
+    sizes = sizes or {}
+    now = now or datetime.now()
+    max_age = policy.get('max_age')
+    if max_age is not None and not isinstance(max_age, timedelta):
+        max_age = timedelta(days=max_age)
+    max_size = policy.get('max_size')
+    remaining = dict((name, policy.get(name) or 0) for name, period in PERIODS)
+    last_buckets = {}
+    keep, delete, reasons = [], [], {}
+    total_size, full = 0, False
+    for index, backup in enumerate(sorted(backups, key=sort_key, reverse=True)):
+        size = sizes.get(backup.filepath) or 0
+        why, capped = [], None
+        if backup.datetime is None:
+            why.append('undated')
+        else:
+            if index < policy.get('last', 0):
+                why.append('last')
+            for name, period in PERIODS:
+                bucket = period(backup.datetime)
+                if remaining[name] and last_buckets.get(name) != bucket:
+                    last_buckets[name] = bucket
+                    remaining[name] -= 1
+                    why.append(name)
+            if index == 0:
+                why = why or ['newest']
+            elif max_age is not None and backup.datetime < now - max_age:
+                capped = 'max_age'
+            elif why and max_size is not None and (full or total_size + size > max_size):
+                capped, full = 'max_size', True
+        if why and not capped:
+            keep.append(backup)
+            total_size += size
+            reasons[backup.filepath] = why
+        else:
+            delete.append(backup)
+            reasons[backup.filepath] = [capped or 'expired']
+    return Plan(keep, delete, reasons)
+
+def caps_size(policy=RETENTION):
+    """ Return True if the policy needs the size of the backups. """
+    return bool(policy) and policy.get('max_size') is not None
+
+def plan(backups, policy=RETENTION, sizes=None, now=None):
+    """ Return the cleanup Plan for parsed backup filenames: the policy if
+        DBBACKUP_RETENTION is set, the last 10 and the first of every month
+        otherwise.
+    """
+    if policy:
+        return plan_policy(backups, policy, sizes, now)
+    keep, delete = plan_cleanup(backups)
+    reasons = dict((backup.filepath, ['expired']) for backup in delete)
+    for backup in keep[:-KEEP_LAST]:
+        reasons[backup.filepath] = ['first of month' if backup.datetime else 'undated']
+    reasons.update((backup.filepath, ['last']) for backup in keep[-KEEP_LAST:])
+    return Plan(keep, delete, reasons)
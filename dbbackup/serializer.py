@@ -0,0 +1,186 @@
+"""
+Engine agnostic backups through the Django ORM: the rows of every model are
+read in primary key order, a page at a time, and written in a compact binary
+format; restores insert them back in large batches. Memory use only depends
+on the page size, not on the size of the tables.
+
+The format is the MAGIC header followed by records of a type byte, a 4 byte
+big-endian length and a marshalled payload: a TABLE record (model label,
+table and field names) followed by the ROWS records of the table.
+"""
+import marshal, struct
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from . import registry, utils
+
+BATCH_SIZE = getattr(settings, 'DBBACKUP_SERIALIZER_BATCH_SIZE', 2000)
+MAGIC = 'DBBROWS1'
+TABLE, ROWS = 'T', 'R'
+HEADER = struct.Struct('>cI')
+MARSHAL_VERSION = 2
+
+# Written as text and converted back by the field on insert
+TEXT_FIELDS = ('DateTimeField', 'DateField', 'TimeField', 'DecimalField')
+
+
+##################################
+#  Records
+##################################
+
+def record(kind, payload):
+    data = marshal.dumps(payload, MARSHAL_VERSION)
+    return HEADER.pack(kind, len(data)) + data
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise CommandError("The backup is truncated")
+    return data
+
+def iter_records(stream, skip=None):
+    """ Yield the (kind, payload) records of stream after the header. The
+        payload of the ROWS records following a TABLE record for which
+        skip(payload) is true is not decoded, and None is yielded instead.
+    """
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise CommandError("The backup is not in the serializer format")
+    skipping = False
+    while True:
+        header = stream.read(HEADER.size)
+        if not header:
+            break
+        if len(header) != HEADER.size:
+            raise CommandError("The backup is truncated")
+        kind, size = HEADER.unpack(header)
+        data = read_exactly(stream, size)
+        if kind == TABLE:
+            payload = marshal.loads(data)
+            skipping = skip is not None and skip(payload)
+            yield kind, payload
+        elif kind == ROWS:
+            yield kind, None if skipping else marshal.loads(data)
+        else:
+            raise CommandError("Unknown record in the backup: %r" % kind)
+
+
+##################################
+#  Backup
+##################################
+
+def ordered_models(database_key, tables=None):
+    """ Return the models stored in the database (with tables in tables
+        only, if given), parents before the models referencing them.
+    """
+    models = registry.registry_tables(database_key)
+    selected = sorted(set(tables) & set(models)) if tables else sorted(models)
+    levels = registry.load_order(registry.dependencies(database_key, selected))
+    return [models[table] for level in levels for table in level]
+
+def text_columns(fields):
+    return [index for index, field in enumerate(fields) if field.get_internal_type() in TEXT_FIELDS]
+
+def dump_model(database_key, model, batch_size=BATCH_SIZE):
+    """ Yield the records of a model, its rows read a page at a time with
+        primary key ranges rather than offsets.
+    """
+    fields = model._meta.local_fields
+    names = [field.name for field in fields]
+    yield record(TABLE, ('%s.%s' % (model._meta.app_label, model._meta.object_name),
+        model._meta.db_table, names))
+    queryset = model._base_manager.using(database_key).order_by('pk').values_list(*names)
+    pk_index = fields.index(model._meta.pk)
+    texts = text_columns(fields)
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = list(page[:batch_size])
+        if not rows:
+            break
+        last = rows[-1][pk_index]
+        if texts:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for index in texts:
+                    if row[index] is not None:
+                        row[index] = unicode(row[index])
+        try:
+            yield record(ROWS, rows)
+        except ValueError, err:
+            raise CommandError("Cannot serialize the rows of %s: %s" % (model._meta.db_table, err))
+        if len(rows) < batch_size:
+            break
+
+def dump(database_key, tables=None, chunk_size=64*1024):
+    """ Yield the backup of the database, or of the tables given. """
+    yield MAGIC
+    for model in ordered_models(database_key, tables):
+        for data in utils.regroup_chunks(dump_model(database_key, model), chunk_size):
+            yield data
+
+
+##################################
+#  Restore
+##################################
+
+def insert_rows(database_key, model, fields, rows, batch_size=BATCH_SIZE):
+    """ Insert rows the way bulk_create does, in raw mode: values are saved
+        as stored (auto_now fields keep their value) and the tables of
+        inherited models are written too.
+    """
+    connection = connections[database_key]
+    attnames = [field.attname for field in fields]
+    objs = []
+    for row in rows:
+        obj = model.__new__(model)
+        obj.__dict__.update(zip(attnames, row))
+        objs.append(obj)
+    batch_size = min(batch_size, max(connection.ops.bulk_batch_size(fields, objs), 1))
+    for start in xrange(0, len(objs), batch_size):
+        model._base_manager._insert(objs[start:start + batch_size], fields=fields, using=database_key, raw=True)
+
+def load(database_key, stdin, tables=None, batch_size=BATCH_SIZE):
+    """ Replace the rows of the models in the backup read from stdin (a file
+        or an iterable of chunks), or of those with tables in tables only,
+        in a single transaction. Constraints are checked once all rows are
+        loaded.
+    """
+    if not hasattr(stdin, 'read'):
+        stdin = utils.ChunkReader(stdin)
+    connection = connections[database_key]
+    quote_name = connection.ops.quote_name
+    stored = registry.registry_tables(database_key)
+    skip = lambda payload: tables is not None and payload[1] not in tables
+    loaded = []
+    with transaction.commit_on_success(using=database_key):
+        # Raw queries do not mark the transaction, a failure must roll it back
+        transaction.set_dirty(using=database_key)
+        disabled = connection.disable_constraint_checking()
+        try:
+            cursor = connection.cursor()
+            for kind, payload in iter_records(stdin, skip):
+                if kind == TABLE:
+                    label, table, names = payload
+                    model = stored.get(table)
+                    if skip(payload):
+                        model = None
+                    elif model is None:
+                        raise CommandError("The backup holds %s, which is not a model of this database" % label)
+                    else:
+                        print "  Loading: %s" % table
+                        fields = [model._meta.get_field(name) for name in names]
+                        cursor.execute('DELETE FROM %s' % quote_name(table))
+                        loaded.append(model)
+                elif model is not None:
+                    insert_rows(database_key, model, fields, payload, batch_size)
+        finally:
+            if disabled:
+                connection.enable_constraint_checking()
+        connection.check_constraints(table_names=[model._meta.db_table for model in loaded])
+        for sql in connection.ops.sequence_reset_sql(no_style(), loaded):
+            cursor.execute(sql)
+    if tables:
+        missing = set(tables) - set(model._meta.db_table for model in loaded)
+        if missing:
+            raise CommandError("Tables not in the backup: %s" % ', '.join(sorted(missing)))
@@ -0,0 +1,254 @@
+"""
+Consistent SQLite snapshots taken with the online backup API, and restores
+that replace the pages of the live database in a single transaction. Single
+tables are dumped and loaded as INSERT statements.
+"""
+import ctypes, ctypes.util, mmap, os, sqlite3, sys, tempfile, time
+from django.conf import settings
+from shutil import copyfileobj
+from django.core.management.base import CommandError
+
+PAGES_PER_STEP = getattr(settings, 'DBBACKUP_SQLITE_PAGES_PER_STEP', 1024)
+STEP_SLEEP = getattr(settings, 'DBBACKUP_SQLITE_STEP_SLEEP', 0.01)
+BUSY_TIMEOUT = 5000
+MAX_RESTARTS = 3
+
+SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED, SQLITE_DONE = 0, 5, 6, 101
+SQLITE_OPEN_READONLY, SQLITE_OPEN_READWRITE, SQLITE_OPEN_CREATE = 1, 2, 4
+
+
+##################################
+#  Online Backup API
+##################################
+
+def load_library():
+    """ Return the libsqlite3 the sqlite3 module uses, for Pythons whose
+        sqlite3 module has no Connection.backup() (before 3.7).
+    """
+    try:
+        import _sqlite3
+        paths = [_sqlite3.__file__, ctypes.util.find_library('sqlite3')]
+    except ImportError:
+        return None
+    for path in filter(None, paths):
+        try:
+            library = ctypes.CDLL(path)
+        except OSError:
+            continue
+        if hasattr(library, 'sqlite3_backup_init'):
+            library.sqlite3_backup_init.restype = ctypes.c_void_p
+            library.sqlite3_backup_init.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_char_p]
+            library.sqlite3_backup_step.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            library.sqlite3_backup_finish.argtypes = [ctypes.c_void_p]
+            library.sqlite3_backup_remaining.argtypes = [ctypes.c_void_p]
+            library.sqlite3_errmsg.restype = ctypes.c_char_p
+            library.sqlite3_errmsg.argtypes = [ctypes.c_void_p]
+            library.sqlite3_close.argtypes = [ctypes.c_void_p]
+            library.sqlite3_busy_timeout.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            return library
+    return None
+
+LIBSQLITE = None if hasattr(sqlite3.Connection, 'backup') else load_library()
+
+
+def has_backup_api():
+    return hasattr(sqlite3.Connection, 'backup') or LIBSQLITE is not None
+
+def open_handle(path, flags):
+    """ Open a raw sqlite3 handle with libsqlite3. """
+    handle = ctypes.c_void_p()
+    result = LIBSQLITE.sqlite3_open_v2(path, ctypes.byref(handle), flags, None)
+    if result != SQLITE_OK:
+        message = LIBSQLITE.sqlite3_errmsg(handle) if handle else result
+        LIBSQLITE.sqlite3_close(handle)
+        raise CommandError("Error opening %s: %s" % (path, message))
+    LIBSQLITE.sqlite3_busy_timeout(handle, BUSY_TIMEOUT)
+    return handle
+
+def backup(source, target, pages=PAGES_PER_STEP, sleep=STEP_SLEEP):
+    """ Copy the database at source into target with the online backup
+        API, pages at a time with a sleep in between, so writers are only
+        locked out for one step at a time. SQLite restarts the copy when
+        another connection writes to the source, so after MAX_RESTARTS the
+        rest is copied in a single step instead. With pages -1 the whole
+        database is copied in a single transaction.
+    """
+    if hasattr(sqlite3.Connection, 'backup'):
+        source_db, target_db = sqlite3.connect(source), sqlite3.connect(target)
+        try:
+            source_db.backup(target_db, pages=pages, sleep=sleep)
+        except sqlite3.Error, err:
+            raise CommandError("Error backing up %s: %s" % (source, err))
+        finally:
+            target_db.close()
+            source_db.close()
+        return
+    source_db = open_handle(source, SQLITE_OPEN_READONLY)
+    try:
+        target_db = open_handle(target, SQLITE_OPEN_READWRITE | SQLITE_OPEN_CREATE)
+        try:
+            copy = LIBSQLITE.sqlite3_backup_init(target_db, 'main', source_db, 'main')
+            if not copy:
+                raise CommandError("Error backing up %s: %s" % (source, LIBSQLITE.sqlite3_errmsg(target_db)))
+            result, restarts, remaining = SQLITE_OK, 0, None
+            while result in (SQLITE_OK, SQLITE_BUSY, SQLITE_LOCKED):
+                result = LIBSQLITE.sqlite3_backup_step(copy, pages if restarts < MAX_RESTARTS else -1)
+                if remaining is not None and LIBSQLITE.sqlite3_backup_remaining(copy) > remaining:
+                    restarts += 1
+                remaining = LIBSQLITE.sqlite3_backup_remaining(copy)
+                if result != SQLITE_DONE and sleep:
+                    time.sleep(sleep)
+            finish = LIBSQLITE.sqlite3_backup_finish(copy)
+            if result != SQLITE_DONE or finish != SQLITE_OK:
+                raise CommandError("Error backing up %s: %s" % (source, LIBSQLITE.sqlite3_errmsg(target_db)))
+        finally:
+            LIBSQLITE.sqlite3_close(target_db)
+    finally:
+        LIBSQLITE.sqlite3_close(source_db)
+
+
+##################################
+#  Snapshot and Restore
+##################################
+
+def snapshot(dbpath, snapshotpath):
+    """ Write a consistent copy of the database at dbpath to snapshotpath,
+        with the online backup API or else VACUUM INTO (SQLite 3.27+).
+    """
+    if has_backup_api():
+        return backup(dbpath, snapshotpath)
+    connection = sqlite3.connect(dbpath)
+    try:
+        connection.execute('VACUUM INTO ?', (snapshotpath,))
+    except sqlite3.Error, err:
+        raise CommandError("Error snapshotting %s: %s" % (dbpath, err))
+    finally:
+        connection.close()
+
+def stream_file(filepath, chunk_size):
+    """ Yield the contents of filepath from a read-only memory map, so the
+        chunks are sliced from the page cache without read() calls.
+    """
+    with open(filepath, 'rb') as snapshotfile:
+        size = os.fstat(snapshotfile.fileno()).st_size
+        if not size:
+            return
+        mapped = mmap.mmap(snapshotfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in xrange(0, size, chunk_size):
+                yield mapped[start:start + chunk_size]
+        finally:
+            mapped.close()
+
+def restore(stdin, dbpath):
+    """ Restore the database at dbpath from stdin (a file or an iterable of
+        chunks). The backup is written next to the database and checked
+        first; its pages then replace those of the live database in a
+        single transaction, or the file is renamed over the database when
+        the backup API is not available.
+    """
+    dirpath, filename = os.path.split(os.path.abspath(dbpath))
+    fd, restorepath = tempfile.mkstemp(prefix=filename + '.restore-', dir=dirpath)
+    try:
+        with os.fdopen(fd, 'wb') as restorefile:
+            if hasattr(stdin, 'read'):
+                copyfileobj(stdin, restorefile)
+            else:
+                for data in stdin:
+                    restorefile.write(data)
+        connection = sqlite3.connect(restorepath)
+        try:
+            result = connection.execute('PRAGMA quick_check').fetchone()[0]
+        except sqlite3.Error, err:
+            result = str(err)
+        finally:
+            connection.close()
+        if result != 'ok':
+            raise CommandError("The backup is not a valid SQLite database: %s" % result)
+        if has_backup_api():
+            backup(restorepath, dbpath, pages=-1, sleep=0)
+        else:
+            os.rename(restorepath, dbpath)
+    finally:
+        if os.path.exists(restorepath):
+            os.unlink(restorepath)
+
+
+##################################
+#  Single Tables
+##################################
+
+def quote_name(name):
+    return '"%s"' % name.replace('"', '""')
+
+def dump_table(dbpath, table, chunk_size):
+    """ Yield the rows of table as INSERT statements, selected in a single
+        read transaction.
+    """
+    connection = sqlite3.connect(dbpath, timeout=BUSY_TIMEOUT / 1000.0)
+    try:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(%s)' % quote_name(table))]
+        if not columns:
+            raise CommandError("No such table: %s" % table)
+        values = " || ',' || ".join('quote(%s)' % quote_name(column) for column in columns)
+        select = "SELECT 'INSERT INTO %s VALUES(' || %s || ');' FROM %s" % (
+            quote_name(table).replace("'", "''"), values, quote_name(table))
+        pending, size = [], 0
+        for (statement,) in connection.execute(select):
+            statement = statement.encode('utf-8') + '\n'
+            pending.append(statement)
+            size += len(statement)
+            if size >= chunk_size:
+                yield ''.join(pending)
+                pending, size = [], 0
+        if pending:
+            yield ''.join(pending)
+    finally:
+        connection.close()
+
+def iter_lines(chunks):
+    """ Yield the lines of an iterable of chunks, with their newline. """
+    pending = ''
+    for data in chunks:
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def restore_table(stdin, dbpath, table):
+    """ Replace the rows of table with the INSERT statements read from
+        stdin (a file or an iterable of chunks), in a single transaction.
+        Statements for another table are refused.
+    """
+    if hasattr(stdin, 'read'):
+        source = stdin
+        stdin = iter(lambda: source.read(64*1024), '')
+    prefix = 'INSERT INTO %s VALUES(' % quote_name(table)
+    connection = sqlite3.connect(dbpath, timeout=BUSY_TIMEOUT / 1000.0, isolation_level=None)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute('DELETE FROM %s' % quote_name(table))
+        statement = ''
+        for line in iter_lines(stdin):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                if not statement.startswith(prefix):
+                    raise CommandError("Unexpected statement in the backup of %s: %s" % (table, statement[:80]))
+                connection.execute(statement.decode('utf-8'))
+                statement = ''
+        if statement.strip():
+            raise CommandError("The backup of %s is truncated" % table)
+        connection.execute('COMMIT')
+    except:
+        error = sys.exc_info()
+        try:
+            connection.execute('ROLLBACK')
+        except sqlite3.Error:
+            pass
+        if isinstance(error[1], sqlite3.Error):
+            raise CommandError("Error restoring %s: %s" % (table, error[1]))
+        raise error[0], error[1], error[2]
+    finally:
+        connection.close()
@@ -1,13 +1,52 @@
 """
 Abstract Storage class.
 """
+import os, threading
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
 from django.utils.importlib import import_module
+from .. import throttle, utils
 
 class StorageError(Exception):
     pass
 
 
+class CompletedResult(object):
+    """ AsyncResult of a call that already ran. """
+
+    def __init__(self, func, args):
+        try:
+            self.value, self.error = func(*args), None
+        except Exception, err:
+            self.value, self.error = None, err
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self.error is None
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def gather(results):
+    """ Wait for every AsyncResult, then return their values, raising the
+        error of the first one that failed.
+    """
+    results = list(results)
+    for result in results:
+        result.wait()
+    return [result.get() for result in results]
+
+_worker = threading.local()
+_pool_lock = threading.Lock()
+
+
 ###################################
 #  Abstract Storage Class
 ###################################
@@ -15,19 +54,32 @@ class StorageError(Exception):
 class BaseStorage:
     """ Abstract storage class. """
     BACKUP_STORAGE = getattr(settings, 'DBBACKUP_STORAGE', None)
+    MAX_CONCURRENT_UPLOADS = getattr(settings, 'DBBACKUP_MAX_CONCURRENT_UPLOADS', 2)
+    IO_THREADS = getattr(settings, 'DBBACKUP_IO_THREADS', getattr(settings, 'DBBACKUP_DELETE_THREADS', 16))
 
     def __init__(self, server_name=None):
         if not self.name:
             raise Exception("Programming Error: storage.name not defined.")
+        self.upload_slots = threading.BoundedSemaphore(self.MAX_CONCURRENT_UPLOADS)
+        self.upload_bucket = throttle.TokenBucket(throttle.storage_rate(throttle.UPLOAD_RATE_LIMIT, self.name))
+        self.download_bucket = throttle.TokenBucket(throttle.storage_rate(throttle.DOWNLOAD_RATE_LIMIT, self.name))
 
     def __str__(self):
         return self.name
 
     @classmethod
     def storage_factory(cls):
-        """ Return the correct storage object based on the specified Django settings. """
+        """ Return the correct storage object based on the specified Django settings.
+            A list of storages returns a storage writing to all of them.
+        """
         if not cls.BACKUP_STORAGE:
             raise StorageError('You must specify a storage class using DBBACKUP_STORAGE.')
+        if isinstance(cls.BACKUP_STORAGE, (list, tuple)):
+            storages = [import_module(path).Storage() for path in cls.BACKUP_STORAGE]
+            if len(storages) == 1:
+                return storages[0]
+            from .multi_storage import Storage as MultiStorage
+            return MultiStorage(storages)
         storage_module = import_module(cls.BACKUP_STORAGE)
         return storage_module.Storage()
 
@@ -45,11 +97,121 @@ class BaseStorage:
     def delete_file(self, filepath):
         raise StorageError("Programming Error: delete_file() not defined.")
 
+    def delete_files(self, filepaths):
+        """ Delete several filepaths, IO_THREADS at a time. Storages with a
+            batch delete API override this to save a round trip per file.
+        """
+        self.map_concurrently(self.delete_file, filepaths)
+
+    def map_concurrently(self, func, items):
+        """ Return [func(item) for item in items], calling func on the I/O
+            pool of the storage.
+        """
+        items = list(items)
+        if len(items) < 2:
+            return map(func, items)
+        return gather(self.submit(func, item) for item in items)
+
+    def file_size(self, filepath):
+        """ Return the stored size of filepath. Storages that keep sizes in
+            their metadata override this to avoid reading the file.
+        """
+        return sum(len(data) for data in self.read_stream(filepath))
+
     def list_backups(self, database):
         raise StorageError("Programming Error: list_backups() not defined.")
 
     def write_file(self, filehandle):
         raise StorageError("Programming Error: write_file() not defined.")
 
+    def write_stream(self, chunks, name):
+        """ Write an iterable of chunks to the specified name. Storages that
+            cannot upload a stream directly fall back to spooling it first.
+        """
+        filehandle = utils.spool_chunks(chunks, name)
+        try:
+            self.write_file(filehandle)
+        finally:
+            filehandle.close()
+
+    ###################################
+    #  Asynchronous Access Methods
+    ###################################
+
+    def io_pool(self):
+        """ Return the pool of IO_THREADS threads running the asynchronous
+            calls of this storage, however many are pending.
+        """
+        with _pool_lock:
+            if not hasattr(self, '_io_pool'):
+                self._io_pool = ThreadPool(self.IO_THREADS, initializer=self.init_worker)
+            return self._io_pool
+
+    def init_worker(self):
+        _worker.storage = self
+
+    def submit(self, func, *args):
+        """ Call func(*args) on the I/O pool and return its AsyncResult.
+            Calls made from the pool itself run immediately, as waiting on
+            the pool from one of its threads could deadlock.
+        """
+        if getattr(_worker, 'storage', None) is self:
+            return CompletedResult(func, args)
+        return self.io_pool().apply_async(func, args)
+
+    def delete_file_async(self, filepath):
+        return self.submit(self.delete_file, filepath)
+
+    def delete_files_async(self, filepaths):
+        return self.submit(self.delete_files, list(filepaths))
+
+    def file_size_async(self, filepath):
+        return self.submit(self.file_size, filepath)
+
+    def list_directory_async(self):
+        return self.submit(self.list_directory)
+
+    def read_file_async(self, filepath):
+        return self.submit(self.read_file, filepath)
+
+    def write_file_async(self, filehandle):
+        return self.submit(self.write_file, filehandle)
+
+    def write_stream_async(self, chunks, name):
+        return self.submit(self.write_stream, chunks, name)
+
+    def write_file_resumable(self, filehandle, name, journal):
+        """ Write filehandle as name, skipping the parts journal records as
+            uploaded by an interrupted write. Storages without resumable
+            uploads start over.
+        """
+        filehandle.seek(0)
+        self.write_stream(utils.iter_chunks(filehandle, 1024*1024), name)
+
     def read_file(self, filepath):
         raise StorageError("Programming Error: read_file() not defined.")
+
+    def read_file_resumable(self, filepath, localpath):
+        """ Download filepath to localpath, continuing after the data an
+            interrupted download left there. Returns the open localpath.
+        """
+        offset = os.path.getsize(localpath) if os.path.exists(localpath) else 0
+        if offset:
+            print "  Resuming download of %s at %s" % (filepath, utils.bytes_to_str(offset))
+        with open(localpath, 'ab') as localfile:
+            for data in self.read_stream(filepath, offset):
+                localfile.write(data)
+        return open(localpath, 'rb')
+
+    def read_stream(self, filepath, offset=0):
+        """ Yield the contents of filepath in chunks, starting at offset.
+            Storages that cannot download a stream directly fall back to
+            read_file().
+        """
+        filehandle = self.read_file(filepath)
+        try:
+            filehandle.seek(offset)
+            for data in utils.iter_chunks(filehandle, 64*1024):
+                yield data
+        finally:
+            filehandle.close()
@@ -3,18 +3,124 @@ Dropbox API Storage object.
 """
 import pickle
 import os
+import socket
+import sys
 import tempfile
-from shutil import copyfileobj
+import threading
+import urlparse
+from Queue import Queue
+from StringIO import StringIO
 from .base import BaseStorage, StorageError
-from dropbox.rest import ErrorResponse
+from .. import utils
+from dropbox.rest import ErrorResponse, ProperHTTPSConnection
 from django.conf import settings
-from dropbox.client import DropboxClient
+from dropbox.client import DropboxClient, format_path
 from dropbox import session
 
 DEFAULT_ACCESS_TYPE = 'app_folder'
 
 MAX_SPOOLED_SIZE = 10 * 1024 * 1024
 FILE_SIZE_LIMIT = 145 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+READ_AHEAD_SIZE = 8 * 1024 * 1024
+
+
+################################
+#  Chunked Upload Session
+################################
+
+class ChunkedUpload(threading.Thread):
+    """ Upload one numbered file through a Dropbox chunked upload session.
+        Blocks are fed through a small queue as they are read from the
+        backup stream, so nothing is spooled. After a network drop the
+        upload resumes from the offset Dropbox has received. The session
+        and offset are saved to checkpoint, if given, after every block.
+    """
+
+    def __init__(self, storage, path, slots, checkpoint=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.storage = storage
+        self.path = path
+        self.slots = slots
+        self.blocks = Queue(2)
+        self.size = 0
+        self.offset = 0
+        self.upload_id = None
+        self.error = None
+        self.closed = False
+        self.aborted = False
+        self.committed = False
+        self.checkpoint = checkpoint
+        if checkpoint:
+            self.offset = checkpoint.state.get('offset', 0)
+            self.upload_id = checkpoint.state.get('upload_id')
+            self.upload_id = self.upload_id and str(self.upload_id)
+
+    def put(self, block):
+        self.size += len(block)
+        self.blocks.put(block)
+
+    def close(self, abort=False):
+        """ End the upload, committing it unless abort is set. """
+        if not self.closed:
+            self.closed = True
+            self.aborted = abort
+            self.blocks.put(None)
+
+    def run(self):
+        try:
+            for block in iter(self.blocks.get, None):
+                # After an error keep draining so the producer never blocks
+                if not self.error:
+                    self.upload_block(block)
+            if not self.error and not self.aborted:
+                self.commit()
+        finally:
+            self.slots.release()
+
+    def upload_block(self, block):
+        self.storage.upload_bucket.consume(len(block))
+        try:
+            utils.retry_call(self.upload_data, (block,), self.storage.DROPBOX_RETRIES,
+                (ErrorResponse, socket.error))
+            if self.checkpoint:
+                self.checkpoint.update(offset=self.offset, upload_id=self.upload_id)
+        except (ErrorResponse, socket.error), err:
+            if self.checkpoint and getattr(err, 'status', None) == 404:
+                # The session expired: the next resume starts this file over
+                self.checkpoint.update(offset=0, upload_id=None)
+            self.error = StorageError("ERROR uploading %s: %s" % (self.path, err))
+        except:
+            self.error = sys.exc_info()[1]
+
+    def upload_data(self, block):
+        """ Upload the part of block Dropbox doesn't have yet. """
+        start = self.offset
+        while self.offset - start < len(block):
+            data = block[self.offset - start:]
+            try:
+                self.offset, self.upload_id = self.storage.dropbox.upload_chunk(
+                    StringIO(data), len(data), self.offset, self.upload_id)
+            except ErrorResponse, err:
+                # Dropbox reports the offset it expects when we are behind
+                offset = err.body.get('offset') if isinstance(err.body, dict) else None
+                if offset is None or offset <= self.offset:
+                    raise
+                self.offset = offset
+
+    def commit(self):
+        try:
+            if self.upload_id:
+                self.storage.commit_chunked_upload(self.path, self.upload_id)
+            else:
+                self.storage.run_dropbox_action(self.storage.dropbox.put_file, self.path, StringIO(''))
+            self.committed = True
+            if self.checkpoint:
+                self.checkpoint.update(committed=True)
+        except Exception, err:
+            self.error = err
 
 ################################
 #  Dropbox Storage Object
@@ -29,6 +135,8 @@ class Storage(BaseStorage):
     DBBACKUP_DROPBOX_APP_KEY = getattr(settings, 'DBBACKUP_DROPBOX_APP_KEY', None)
     DBBACKUP_DROPBOX_APP_SECRET = getattr(settings, 'DBBACKUP_DROPBOX_APP_SECRET', None)
     DBBACKUP_DROPBOX_ACCESS_TYPE = getattr(settings, 'DBBACKUP_DROPBOX_ACCESS_TYPE', DEFAULT_ACCESS_TYPE)
+    DROPBOX_TRANSFER_THREADS = getattr(settings, 'DBBACKUP_DROPBOX_TRANSFER_THREADS', 4)
+    DROPBOX_RETRIES = getattr(settings, 'DBBACKUP_DROPBOX_RETRIES', 3)
     _request_token = None
     _access_token = None
 
@@ -54,12 +162,25 @@ class Storage(BaseStorage):
         return self.DROPBOX_DIRECTORY
 
     def delete_file(self, filepath):
-        """ Delete the specified filepath. """
-        files = self.list_directory(raw=True)
-        to_be_deleted = [x for x in files if os.path.splitext(x)[0] == filepath]
+        """ Delete the numbered files of the specified filepath. """
+        files = [path for path, size in self.get_numbered_files(filepath)]
+        self.map_concurrently(lambda name: self.run_dropbox_action(self.dropbox.file_delete, name), files)
 
-        for name in to_be_deleted:
-            self.run_dropbox_action(self.dropbox.file_delete, name)
+    def delete_files(self, filepaths):
+        """ Delete the numbered files of several filepaths, listing the
+            directory only once and deleting IO_THREADS files at a time.
+        """
+        filepaths = set(filepaths)
+        files = self.list_directory(raw=True) if filepaths else []
+        to_be_deleted = [x for x in files if os.path.splitext(x)[0] in filepaths]
+        self.map_concurrently(lambda name: self.run_dropbox_action(self.dropbox.file_delete, name), to_be_deleted)
+
+    def file_size(self, filepath):
+        """ Return the total size of the numbered files of filepath. """
+        files = self.get_numbered_files(filepath)
+        if not files:
+            raise StorageError("File not found: %s" % filepath)
+        return sum(size for path, size in files)
 
     def list_directory(self, raw=False):
         """ List all stored backups for the specified. """
@@ -74,64 +195,202 @@ class Storage(BaseStorage):
     def get_numbered_path(self, path, number):
         return "{}.{}".format(path, number)
 
-    @staticmethod
-    def chunked_file(filehandle, chunk_size=FILE_SIZE_LIMIT):
-        eof = False
-        while not eof:
-            with tempfile.SpooledTemporaryFile(max_size=MAX_SPOOLED_SIZE) as t:
-                chunk_space = chunk_size
-                while chunk_space > 0:
-                    data = filehandle.read(min(16384, chunk_space))
-                    if not data:
-                        eof = True
-                        break
-
-                    chunk_space -= len(data)
-                    t.write(data)
-
-                if t.tell() > 0:
-                    t.seek(0)
-                    yield t
+    def get_numbered_files(self, filepath):
+        """ Return the (path, size) of the numbered files of filepath in order.
+            Each numbered file is looked up on its own, so the cost does not
+            grow with the number of files in the backup directory.
+        """
+        numbered = []
+        while True:
+            path = self.get_numbered_path(filepath, len(numbered))
+            metadata = self.run_dropbox_action(self.dropbox.metadata, path, ignore_404=True)
+            if not metadata or metadata.get('is_dir') or metadata.get('is_deleted'):
+                return numbered
+            numbered.append((metadata['path'], metadata['bytes']))
 
     def write_file(self, filehandle):
         """ Write the specified file. """
         filehandle.seek(0)
-        total_files = 0
-        path = os.path.join(
-            self.DROPBOX_DIRECTORY, 
-            filehandle.name,
-        )
-        for chunk in self.chunked_file(filehandle):
-            self.run_dropbox_action(
-                self.dropbox.put_file, 
-                self.get_numbered_path(path, total_files), 
-                chunk,
-            )
-            total_files += 1
+        self.write_stream(utils.iter_chunks(filehandle, UPLOAD_CHUNK_SIZE), filehandle.name)
+
+    def write_stream(self, chunks, name):
+        """ Write the specified chunks as numbered files of at most
+            FILE_SIZE_LIMIT, each through its own chunked upload session.
+            Up to DROPBOX_TRANSFER_THREADS numbered files upload at once.
+        """
+        path = os.path.join(self.DROPBOX_DIRECTORY, name)
+        slots = threading.BoundedSemaphore(self.DROPBOX_TRANSFER_THREADS)
+        uploads, upload = [], None
+        try:
+            for block in utils.regroup_chunks(chunks, UPLOAD_CHUNK_SIZE):
+                if not upload or upload.size + len(block) > FILE_SIZE_LIMIT:
+                    if upload:
+                        upload.close()
+                    slots.acquire()
+                    upload = ChunkedUpload(self, self.get_numbered_path(path, len(uploads)), slots)
+                    uploads.append(upload)
+                    upload.start()
+                for failed in uploads:
+                    if failed.error:
+                        raise failed.error
+                upload.put(block)
+        except:
+            self.abort_uploads(uploads)
+            raise
+        if upload:
+            upload.close()
+        for upload in uploads:
+            upload.join()
+        for upload in uploads:
+            if upload.error:
+                self.abort_uploads(uploads)
+                raise upload.error
+
+    def abort_uploads(self, uploads):
+        """ Stop the uploads of a failed write without committing them and
+            delete the numbered files already committed, so no truncated
+            backup is left behind.
+        """
+        for upload in uploads:
+            upload.close(abort=True)
+        for upload in uploads:
+            upload.join()
+        committed = [upload.path for upload in uploads if upload.committed]
+        try:
+            self.map_concurrently(lambda path: self.run_dropbox_action(self.dropbox.file_delete, path), committed)
+        except StorageError:
+            pass
+
+    def write_file_resumable(self, filehandle, name, journal):
+        """ Write the specified file as numbered files whose upload sessions
+            and offsets are kept in journal. Committed numbered files are
+            skipped and an interrupted session continues from its offset.
+        """
+        path = os.path.join(self.DROPBOX_DIRECTORY, name)
+        file_size = FILE_SIZE_LIMIT // UPLOAD_CHUNK_SIZE * UPLOAD_CHUNK_SIZE
+        filehandle.seek(0, 2)
+        size = filehandle.tell()
+        slots = threading.BoundedSemaphore(self.DROPBOX_TRANSFER_THREADS)
+        uploads = []
+        try:
+            for number in xrange(max(1, (size + file_size - 1) // file_size)):
+                checkpoint = journal.section(str(number))
+                if checkpoint.state.get('committed'):
+                    continue
+                slots.acquire()
+                upload = ChunkedUpload(self, self.get_numbered_path(path, number), slots, checkpoint)
+                uploads.append(upload)
+                upload.start()
+                position = number * file_size + upload.offset
+                end = min((number + 1) * file_size, size)
+                filehandle.seek(position)
+                try:
+                    while position < end:
+                        block = filehandle.read(min(UPLOAD_CHUNK_SIZE, end - position))
+                        position += len(block)
+                        upload.put(block)
+                except:
+                    # Keep the session open, the next run resumes it
+                    upload.close(abort=True)
+                    raise
+                upload.close()
+                for failed in uploads:
+                    if failed.error:
+                        raise failed.error
+        finally:
+            for upload in uploads:
+                upload.join()
+        for upload in uploads:
+            if upload.error:
+                raise upload.error
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
-        total_files = 0
         filehandle = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOLED_SIZE)
         try:
-            while True:
-                response = self.run_dropbox_action(
-                    self.dropbox.get_file, 
-                    self.get_numbered_path(filepath, total_files),
-                    ignore_404=(total_files > 0),
-                )
-                if not response:
-                    break
-
-                copyfileobj(response, filehandle)
-                total_files += 1
-
+            for data in self.read_stream(filepath):
+                filehandle.write(data)
         except:
             filehandle.close()
             raise
-
+        filehandle.seek(0)
         return filehandle
 
+    def read_stream(self, filepath, offset=0):
+        """ Yield the specified file in order from offset, streaming one
+            numbered file at a time with up to READ_AHEAD_SIZE bytes read
+            ahead. Numbered files before offset are skipped.
+        """
+        files = self.get_numbered_files(filepath)
+        if not files:
+            raise StorageError("File not found: %s" % filepath)
+        for data in utils.buffered_chunks(self.stream_files(files, offset), READ_AHEAD_SIZE, DOWNLOAD_CHUNK_SIZE):
+            yield data
+
+    def stream_files(self, files, offset=0):
+        """ Yield the numbered files in order from offset. """
+        for path, size in files:
+            if offset >= size:
+                offset -= size
+                continue
+            for data in self.stream_file(path, offset):
+                yield data
+            offset = 0
+
+    def stream_file(self, path, offset=0):
+        """ Yield a single numbered file from offset. After a network drop
+            the download resumes from the last byte received.
+        """
+        retries = self.DROPBOX_RETRIES
+        while True:
+            response = utils.retry_call(self.open_file, (path, offset), self.DROPBOX_RETRIES,
+                exceptions=(StorageError,))
+            try:
+                for data in utils.iter_chunks(response, DOWNLOAD_CHUNK_SIZE):
+                    self.download_bucket.consume(len(data))
+                    offset += len(data)
+                    yield data
+                return
+            except socket.error, err:
+                if not retries:
+                    raise StorageError("ERROR downloading %s: %s" % (path, err))
+                retries -= 1
+            finally:
+                response.close()
+
+    def open_file(self, path, offset=0):
+        """ Open a streamed download of path from offset. The SDK rejects
+            the 206 response of a ranged request, so it is sent here.
+        """
+        target = "/files/%s%s" % (self.dropbox.session.root, format_path(path))
+        url, params, headers = self.dropbox.request(target, {}, method='GET', content_server=True)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        http_connect = self.dropbox.rest_client.IMPL.http_connect or ProperHTTPSConnection
+        try:
+            conn = http_connect(urlparse.urlparse(url).hostname, 443)
+            conn.request('GET', url, None, headers)
+            response = conn.getresponse()
+            if response.status not in (200, 206):
+                raise StorageError("ERROR %s" % (ErrorResponse(response),))
+            if offset and response.status == 200:
+                # The range was ignored, skip to offset
+                while offset:
+                    data = response.read(min(offset, DOWNLOAD_CHUNK_SIZE))
+                    if not data:
+                        break
+                    offset -= len(data)
+        except socket.error, err:
+            raise StorageError("ERROR downloading %s: %s" % (path, err))
+        return response
+
+    def commit_chunked_upload(self, path, upload_id):
+        """ Commit the data of a chunked upload session to path. """
+        target = "/commit_chunked_upload/%s%s" % (self.dropbox.session.root, format_path(path))
+        params = dict(overwrite=True, upload_id=upload_id)
+        url, params, headers = self.dropbox.request(target, params, content_server=True)
+        return self.run_dropbox_action(self.dropbox.rest_client.POST, url, params, headers)
+
     def run_dropbox_action(self, method, *args, **kwargs):
         """ Check we have a valid 200 response from Dropbox. """
         ignore_404 = kwargs.pop("ignore_404", False)
@@ -1,10 +1,221 @@
 """
 Filesystem Storage object.
 """
-import os, tempfile
+import ctypes, ctypes.util, errno, fcntl, mmap, os, stat, tempfile
+from contextlib import contextmanager
 from .base import BaseStorage, StorageError
+from .. import utils
 from django.conf import settings
 
+# Direct I/O needs block aligned offsets, sizes and memory (mmap is page aligned)
+ALIGNMENT = 4096
+MAX_KERNEL_COPY = 1024*1024*1024
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+
+################################
+#  Kernel Copy Helpers
+################################
+
+# Python 2 has no os.sendfile(), os.copy_file_range() or os.posix_fadvise(),
+# so they are called from libc when os does not provide them.
+try:
+    LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    LIBC = None
+
+def libc_function(name, restype, *argtypes):
+    function = getattr(LIBC, name, None)
+    if function:
+        function.restype, function.argtypes = restype, argtypes
+    return function
+
+libc_copy_file_range = libc_function('copy_file_range', ctypes.c_ssize_t, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint)
+libc_sendfile = libc_function('sendfile', ctypes.c_ssize_t, ctypes.c_int, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_long), ctypes.c_size_t)
+libc_posix_fadvise = libc_function('posix_fadvise', ctypes.c_int, ctypes.c_int,
+    ctypes.c_long, ctypes.c_long, ctypes.c_int)
+
+def libc_result(result, name):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, "%s: %s" % (name, os.strerror(code)))
+    return result
+
+def copy_file_range(in_fd, out_fd, offset, count):
+    """ Copy count bytes from offset of in_fd to the position of out_fd. On
+        copy-on-write filesystems the blocks are shared instead of copied.
+    """
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(in_fd, out_fd, count, offset)
+    if not libc_copy_file_range:
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    offset = ctypes.c_int64(offset)
+    return libc_result(libc_copy_file_range(in_fd, ctypes.byref(offset), out_fd, None, count, 0), 'copy_file_range')
+
+def sendfile(in_fd, out_fd, offset, count):
+    """ Copy count bytes from offset of in_fd to the position of out_fd. """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(out_fd, in_fd, offset, count)
+    if not libc_sendfile:
+        raise OSError(errno.ENOSYS, "sendfile not available")
+    offset = ctypes.c_long(offset)
+    return libc_result(libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count), 'sendfile')
+
+def kernel_copy(in_fd, out_fd, offset, count):
+    """ Copy count bytes from offset of in_fd to the position of out_fd
+        without going through user space. Returns the number of bytes
+        copied, which falls short when the platform or filesystem supports
+        neither copy_file_range() nor sendfile(); the caller copies the rest.
+    """
+    copied = 0
+    for copy in (copy_file_range, sendfile):
+        while copied < count:
+            try:
+                sent = copy(in_fd, out_fd, offset + copied, min(count - copied, MAX_KERNEL_COPY))
+            except OSError, err:
+                if err.errno in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP):
+                    break
+                raise
+            if not sent:
+                break
+            copied += sent
+    return copied
+
+def fadvise(fd, advice):
+    """ posix_fadvise() the whole file, where supported. """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, advice)
+    elif libc_posix_fadvise:
+        libc_posix_fadvise(fd, 0, 0, advice)
+
+def disk_fileno(filehandle):
+    """ Return the descriptor of filehandle if it is a regular file on disk,
+        or None (ie: an in-memory SpooledTemporaryFile, which fileno()
+        would roll over to disk).
+    """
+    if getattr(filehandle, '_rolled', True) is False:
+        return None
+    try:
+        fd = filehandle.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    return fd if stat.S_ISREG(os.fstat(fd).st_mode) else None
+
+def fsync_directory(dirpath):
+    """ Make a rename in dirpath durable. """
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+################################
+#  Backup File Writer
+################################
+
+class BackupWriter(object):
+    """ Write a file through a large page aligned buffer, starting at offset.
+        With direct set the file is opened with O_DIRECT so the backup does
+        not go through (and evict the database from) the page cache;
+        otherwise the written pages are dropped once synced if drop_cache
+        is set. Direct I/O resumes at the block boundary before offset.
+        Writes are paced by bucket, a throttle.TokenBucket, if given.
+    """
+
+    def __init__(self, path, offset=0, buffer_size=4*1024*1024, direct=False, fsync=True, drop_cache=True,
+            bucket=None):
+        self.direct = direct and hasattr(os, 'O_DIRECT')
+        self.bucket = bucket
+        self.fsync = fsync
+        self.drop_cache = drop_cache
+        flags = os.O_WRONLY | os.O_CREAT
+        if self.direct:
+            offset -= offset % ALIGNMENT
+            try:
+                self.fd = os.open(path, flags | os.O_DIRECT, 0666)
+            except OSError, err:
+                # Some filesystems (ie: tmpfs) do not support direct I/O
+                if err.errno != errno.EINVAL:
+                    raise
+                self.direct = False
+        if not self.direct:
+            self.fd = os.open(path, flags, 0666)
+        os.ftruncate(self.fd, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        self.offset = offset
+        buffer_size += -buffer_size % ALIGNMENT
+        self.buffer = mmap.mmap(-1, buffer_size)
+        self.used = 0
+
+    def write(self, data):
+        position, size = 0, len(self.buffer)
+        while position < len(data):
+            count = min(len(data) - position, size - self.used)
+            chunk = data if count == len(data) else data[position:position + count]
+            self.buffer[self.used:self.used + count] = chunk
+            self.used += count
+            position += count
+            if self.used == size:
+                self.flush()
+
+    def flush(self):
+        """ Write the buffer to the file. """
+        if self.bucket:
+            self.bucket.consume(self.used)
+        position = 0
+        while position < self.used:
+            position += os.write(self.fd, buffer(self.buffer, position, self.used - position))
+        self.used = 0
+
+    def copy_from(self, filehandle):
+        """ Write the rest of filehandle, copying in the kernel when it is a
+            file on disk. A rate limited copy goes a buffer at a time.
+        """
+        fd = disk_fileno(filehandle)
+        if fd is not None and not self.direct:
+            self.flush()
+            start = filehandle.tell()
+            count = os.fstat(fd).st_size - start
+            step = len(self.buffer) if self.bucket and self.bucket.limited() else count
+            copied = 0
+            while copied < count:
+                size = min(step, count - copied)
+                sent = kernel_copy(fd, self.fd, start + copied, size)
+                if self.bucket:
+                    self.bucket.consume(sent)
+                copied += sent
+                if sent < size:
+                    break
+            filehandle.seek(start + copied)
+        for data in utils.iter_chunks(filehandle, len(self.buffer)):
+            self.write(data)
+
+    def close(self):
+        """ Write the rest of the buffer and sync the file to disk. """
+        try:
+            if self.direct and self.used % ALIGNMENT:
+                # The unaligned tail cannot be written with O_DIRECT
+                flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+                fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            self.flush()
+            if self.fsync:
+                os.fsync(self.fd)
+            if self.drop_cache and not self.direct:
+                fadvise(self.fd, POSIX_FADV_DONTNEED)
+        finally:
+            self.abort()
+
+    def abort(self):
+        """ Close the file without syncing it. """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.buffer.close()
+            self.fd = None
+
 
 ################################
 #  Filesystem Storage Object
@@ -12,8 +223,13 @@ from django.conf import settings
 
 class Storage(BaseStorage):
     """ Filesystem API Storage. """
+    PARTIAL_EXTENSION = '.partial'
     BACKUP_DIRECTORY = getattr(settings, 'DBBACKUP_FILESYSTEM_DIRECTORY', None)
     BACKUP_DIRECTORY = '/%s/' % BACKUP_DIRECTORY.strip('/')
+    BUFFER_SIZE = getattr(settings, 'DBBACKUP_FILESYSTEM_BUFFER_SIZE', 4*1024*1024)
+    FSYNC = getattr(settings, 'DBBACKUP_FILESYSTEM_FSYNC', True)
+    DIRECT_IO = getattr(settings, 'DBBACKUP_FILESYSTEM_DIRECT_IO', False)
+    DROP_CACHE = getattr(settings, 'DBBACKUP_FILESYSTEM_DROP_CACHE', True)
 
     def __init__(self, server_name=None):
         self._check_filesystem_errors()
@@ -25,6 +241,29 @@ class Storage(BaseStorage):
         if not self.BACKUP_DIRECTORY:
             raise StorageError('Filesystem storage requires DBBACKUP_FILESYSTEM_DIRECTORY to be defined in settings.')
 
+    @contextmanager
+    def partial_file(self, name, offset=None):
+        """ Yield a BackupWriter on the partial file of name, which is synced
+            and renamed into place once written, so readers never see a
+            partial backup. A new partial file (offset None) is deleted if
+            writing fails; a resumed one is kept to resume again.
+        """
+        backuppath = os.path.join(self.BACKUP_DIRECTORY, name)
+        partialpath = backuppath + self.PARTIAL_EXTENSION
+        writer = BackupWriter(partialpath, offset or 0, self.BUFFER_SIZE, self.DIRECT_IO,
+            self.FSYNC, self.DROP_CACHE, self.upload_bucket)
+        try:
+            yield writer
+            writer.close()
+        except:
+            writer.abort()
+            if offset is None:
+                os.unlink(partialpath)
+            raise
+        os.rename(partialpath, backuppath)
+        if self.FSYNC:
+            fsync_directory(os.path.dirname(backuppath))
+
     ###################################
     #  DBBackup Storage Methods
     ###################################
@@ -36,23 +275,61 @@ class Storage(BaseStorage):
         """ Delete the specified filepath. """
         os.unlink(filepath)
 
+    def file_size(self, filepath):
+        """ Return the size of the specified file. """
+        if not os.path.isfile(filepath):
+            raise StorageError("File not found: %s" % filepath)
+        return os.path.getsize(filepath)
+
     def list_directory(self):
         """ List all stored backups for the specified. """
         filepaths = os.listdir(self.BACKUP_DIRECTORY)
-        filepaths = [os.path.join(self.BACKUP_DIRECTORY, path) for path in filepaths]
+        filepaths = [os.path.join(self.BACKUP_DIRECTORY, path) for path in filepaths
+            if not path.endswith(self.PARTIAL_EXTENSION)]
         return sorted(filter(os.path.isfile, filepaths))
 
     def write_file(self, filehandle):
-        """ Write the specified file. """
+        """ Write the specified file, copying in the kernel when it is a
+            file on disk.
+        """
         filehandle.seek(0)
-        backuppath = os.path.join(self.BACKUP_DIRECTORY, filehandle.name)
-        backupfile = open(backuppath, 'w')
-        data = filehandle.read(1024)
-        while data:
-            backupfile.write(data)
-            data = filehandle.read(1024)
-        backupfile.close()
+        with self.partial_file(filehandle.name) as writer:
+            writer.copy_from(filehandle)
+
+    def write_stream(self, chunks, name):
+        """ Write the specified chunks as they arrive. """
+        with self.partial_file(name) as writer:
+            for data in chunks:
+                writer.write(data)
+
+    def write_file_resumable(self, filehandle, name, journal):
+        """ Write the specified file, continuing after the data an
+            interrupted write left in the partial file.
+        """
+        partialpath = os.path.join(self.BACKUP_DIRECTORY, name) + self.PARTIAL_EXTENSION
+        offset = os.path.getsize(partialpath) if os.path.exists(partialpath) else 0
+        filehandle.seek(0, 2)
+        if offset > filehandle.tell():
+            offset = 0
+        with self.partial_file(name, offset) as writer:
+            filehandle.seek(writer.offset)
+            writer.copy_from(filehandle)
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
-        return open(filepath, 'r')
+        return open(filepath, 'rb')
+
+    def read_stream(self, filepath, offset=0):
+        """ Yield the specified file in chunks, starting at offset. The
+            pages read are dropped from the page cache afterwards.
+        """
+        if not os.path.isfile(filepath):
+            raise StorageError("File not found: %s" % filepath)
+        with open(filepath, 'rb') as backupfile:
+            fadvise(backupfile.fileno(), POSIX_FADV_SEQUENTIAL)
+            backupfile.seek(offset)
+            for data in utils.iter_chunks(backupfile, self.BUFFER_SIZE):
+                self.download_bucket.consume(len(data))
+                yield data
+            if self.DROP_CACHE:
+                fadvise(backupfile.fileno(), POSIX_FADV_DONTNEED)
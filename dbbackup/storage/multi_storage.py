@@ -0,0 +1,215 @@
+"""
+Mirror backups to several storages at once.
+"""
+import os, sys, threading
+from Queue import Queue, Empty, Full
+from .base import BaseStorage, StorageError
+from .. import utils
+from django.conf import settings
+
+END = object()
+
+
+################################
+#  Tee Destination
+################################
+
+class Destination(threading.Thread):
+    """ Write a stream of chunks to one storage, fed through a bounded
+        queue. A destination whose queue stays full for TEE_TIMEOUT seconds
+        is aborted so it cannot stall the others indefinitely.
+    """
+
+    def __init__(self, storage, name, buffer_chunks):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.storage = storage
+        self.name = name
+        self.chunks = Queue(buffer_chunks)
+        self.error = None
+        self.aborted = False
+
+    def put(self, data, timeout):
+        """ Queue data, aborting the destination if it does not keep up. """
+        if self.error or self.aborted:
+            return
+        try:
+            self.chunks.put(data, timeout=timeout)
+        except Full:
+            self.abort(StorageError("%s did not keep up for %ss" % (self.storage.name, timeout)))
+
+    def abort(self, error):
+        self.error = self.error or error
+        self.aborted = True
+        try:
+            self.chunks.put_nowait(END)
+        except Full:
+            pass
+
+    def iter_chunks(self):
+        while True:
+            data = self.chunks.get()
+            # Raise rather than return so a truncated file is never committed
+            if self.aborted:
+                raise self.error
+            if data is END:
+                return
+            yield data
+
+    def run(self):
+        try:
+            self.storage.write_stream(self.iter_chunks(), self.name)
+        except:
+            self.error = self.error or sys.exc_info()[1]
+        # Free a put blocked on the queue, which nothing reads any more
+        while True:
+            try:
+                self.chunks.get_nowait()
+            except Empty:
+                break
+
+
+################################
+#  Multiple Storage Object
+################################
+
+class Storage(BaseStorage):
+    """ Write to several storages concurrently. Listing and reading use the
+        first storage, falling back to the others when it fails.
+    """
+    TEE_BUFFER_SIZE = getattr(settings, 'DBBACKUP_TEE_BUFFER_SIZE', 16*1024*1024)
+    TEE_TIMEOUT = getattr(settings, 'DBBACKUP_TEE_TIMEOUT', 300)
+    TEE_CHUNK_SIZE = 64*1024
+
+    def __init__(self, storages):
+        self.storages = storages
+        self.name = ', '.join(storage.name for storage in storages)
+        self.failures = []
+        BaseStorage.__init__(self)
+
+    def translate(self, storage, filepath):
+        """ Return the path of filepath (from the first storage) in storage. """
+        return os.path.join(storage.backup_dir(), os.path.basename(filepath))
+
+    ###################################
+    #  DBBackup Storage Methods
+    ###################################
+
+    def backup_dir(self):
+        return self.storages[0].backup_dir()
+
+    def delete_file(self, filepath):
+        self.delete_files([filepath])
+
+    def delete_files(self, filepaths):
+        """ Delete filepaths from every storage concurrently. """
+        filepaths = list(filepaths)
+        def delete(storage):
+            try:
+                storage.delete_files([self.translate(storage, path) for path in filepaths])
+            except Exception, err:
+                return "%s: %s" % (storage.name, err)
+        errors = filter(None, self.map_concurrently(delete, self.storages))
+        if errors:
+            raise StorageError("Error deleting from %s" % '; '.join(errors))
+
+    def file_size(self, filepath):
+        storage = self.storages[0]
+        return storage.file_size(self.translate(storage, filepath))
+
+    def list_directory(self):
+        return self.storages[0].list_directory()
+
+    def write_file(self, filehandle):
+        """ Write the specified file to every storage. """
+        filehandle.seek(0)
+        self.write_stream(utils.iter_chunks(filehandle, self.TEE_CHUNK_SIZE), filehandle.name)
+
+    def write_stream(self, chunks, name):
+        """ Tee the chunks to every storage concurrently through bounded
+            queues. Each storage reports its own result; StorageError is
+            raised only if every storage failed, otherwise the failures are
+            recorded in self.failures.
+        """
+        buffer_chunks = max(1, self.TEE_BUFFER_SIZE // self.TEE_CHUNK_SIZE)
+        destinations = [Destination(storage, name, buffer_chunks) for storage in self.storages]
+        for destination in destinations:
+            destination.start()
+        try:
+            for data in utils.regroup_chunks(chunks, self.TEE_CHUNK_SIZE):
+                for destination in destinations:
+                    if not destination.is_alive() and not destination.error:
+                        destination.abort(StorageError("%s stopped reading" % destination.storage.name))
+                    destination.put(data, self.TEE_TIMEOUT)
+                if all(destination.error for destination in destinations):
+                    break
+            for destination in destinations:
+                destination.put(END, self.TEE_TIMEOUT)
+        except:
+            for destination in destinations:
+                destination.abort(sys.exc_info()[1])
+            raise
+        finally:
+            for destination in destinations:
+                destination.join()
+        failed = [destination for destination in destinations if destination.error]
+        for destination in failed:
+            print "  Writing %s to %s FAILED (%s)" % (name, destination.storage.name, destination.error)
+        if len(failed) == len(destinations):
+            raise StorageError("Writing %s failed on every storage: %s" % (name,
+                '; '.join('%s: %s' % (d.storage.name, d.error) for d in failed)))
+        self.failures.extend((d.storage.name, name, d.error) for d in failed)
+
+    def write_file_resumable(self, filehandle, name, journal):
+        """ Resume writing the specified file to every storage concurrently,
+            each with its own section of journal. Storages that completed
+            before the interruption are skipped. Failures are handled as in
+            write_stream().
+        """
+        def write(storage):
+            checkpoint = journal.section(storage.name)
+            if checkpoint.state.get('done'):
+                return
+            try:
+                with open(filehandle.name, 'rb') as storagefile:
+                    storage.write_file_resumable(storagefile, name, checkpoint)
+                checkpoint.update(done=True)
+            except Exception, err:
+                return err
+        errors = self.map_concurrently(write, self.storages)
+        failed = [(storage, error) for storage, error in zip(self.storages, errors) if error]
+        for storage, error in failed:
+            print "  Writing %s to %s FAILED (%s)" % (name, storage.name, error)
+        if len(failed) == len(self.storages):
+            raise StorageError("Writing %s failed on every storage: %s" % (name,
+                '; '.join('%s: %s' % (storage.name, error) for storage, error in failed)))
+        self.failures.extend((storage.name, name, error) for storage, error in failed)
+
+    def read_file(self, filepath):
+        """ Read the specified file from the first storage that has it. """
+        errors = []
+        for storage in self.storages:
+            try:
+                return storage.read_file(self.translate(storage, filepath))
+            except (StorageError, EnvironmentError), err:
+                errors.append("%s: %s" % (storage.name, err))
+        raise StorageError("Error reading %s from %s" % (filepath, '; '.join(errors)))
+
+    def read_stream(self, filepath, offset=0):
+        """ Yield the specified file from offset, from the first storage
+            that can start sending it.
+        """
+        errors = []
+        for storage in self.storages:
+            chunks = storage.read_stream(self.translate(storage, filepath), offset)
+            try:
+                data = next(chunks, None)
+            except (StorageError, EnvironmentError), err:
+                errors.append("%s: %s" % (storage.name, err))
+                continue
+            if data is not None:
+                yield data
+                for data in chunks:
+                    yield data
+            return
+        raise StorageError("Error reading %s from %s" % (filepath, '; '.join(errors)))
@@ -1,12 +1,186 @@
 """
 S3 Storage object.
 """
-import os, tempfile, sys
-from shutil import copyfileobj
+import httplib, itertools, os, re, socket, tempfile, sys, threading, time, urllib2
+# simples3 parses dates with strptime, whose lazy import of _strptime fails
+# when it first happens on several threads at once
+import _strptime
+from collections import deque
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from StringIO import StringIO
+from xml.sax.saxutils import escape
 from .base import BaseStorage, StorageError
+from .. import utils
 from django.conf import settings
-from simples3.streaming import StreamingS3Bucket
-from simples3.utils import aws_urlquote
+from simples3.bucket import AnyMethodRequest, S3Bucket, S3Error
+from simples3.utils import aws_md5, aws_urlquote, rfc822_fmt
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_DELETE_KEYS = 1000
+MAX_LIST_KEYS = 1000
+EAGER_READ_SIZE = 1024 * 1024
+
+
+################################
+#  Keep-Alive Connection Pool
+################################
+
+class ConnectionPool(object):
+    """ Bounded pool of persistent HTTP(S) connections shared by every
+        request of a storage, so operations don't pay a TCP and TLS
+        handshake each.
+    """
+
+    def __init__(self, size):
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = Queue()
+
+    def acquire(self, connection_class, host, timeout=None):
+        """ Return an idle connection to host, or a new one. Blocks while
+            all connections are in use.
+        """
+        self.slots.acquire()
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except Empty:
+                return connection_class(host, timeout=timeout)
+            if isinstance(connection, connection_class) and connection.host_key == host:
+                return connection
+            connection.close()
+
+    def release(self, connection, reuse=True):
+        """ Return a connection to the pool. """
+        if reuse:
+            self.idle.put(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+
+class PooledResponse(object):
+    """ Body of a response streamed from a pooled connection. The connection
+        goes back to the pool once the body is read to the end, and is
+        dropped if the response is closed before that.
+    """
+
+    def __init__(self, pool, connection, response):
+        self.pool, self.connection, self.response = pool, connection, response
+
+    def read(self, size=-1):
+        if self.connection is None:
+            return ''
+        try:
+            data = self.response.read() if size < 0 else self.response.read(size)
+        except:
+            self.release(reuse=False)
+            raise
+        if self.response.isclosed():
+            self.release(reuse=not self.response.will_close)
+        return data
+
+    def readline(self, size=-1):
+        line = []
+        while size < 0 or len(line) < size:
+            line.append(self.read(1))
+            if line[-1] in ('', '\n'):
+                break
+        return ''.join(line)
+
+    def release(self, reuse):
+        if self.connection is not None:
+            self.pool.release(self.connection, reuse)
+            self.connection = None
+
+    def close(self):
+        self.release(reuse=False)
+        self.response.close()
+
+    __del__ = close
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """ urllib2 handler sending requests over pooled keep-alive connections.
+        Errors and bodies of up to EAGER_READ_SIZE (ie: XML replies) are read
+        eagerly so the connection can be reused straight away; larger bodies
+        are streamed and release the connection once read to the end.
+    """
+
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, request):
+        return self.do_pooled_open(httplib.HTTPConnection, request)
+
+    def https_open(self, request):
+        return self.do_pooled_open(httplib.HTTPSConnection, request)
+
+    def do_pooled_open(self, connection_class, request):
+        host = request.get_host()
+        headers = dict(request.unredirected_hdrs)
+        headers.update(request.headers)
+        headers['Connection'] = 'keep-alive'
+        for attempt in (0, 1):
+            connection = self.pool.acquire(connection_class, host, request.timeout)
+            connection.host_key = host
+            try:
+                connection.request(request.get_method(), request.get_selector(), request.data, headers)
+                response = connection.getresponse()
+                eager = response.status >= 300 or (response.length is not None and response.length <= EAGER_READ_SIZE)
+                body = StringIO(response.read()) if eager else PooledResponse(self.pool, connection, response)
+            except (socket.error, httplib.HTTPException), err:
+                # An idle connection may have been closed by the server
+                self.pool.release(connection, reuse=False)
+                if attempt:
+                    raise urllib2.URLError(err)
+                continue
+            if eager:
+                self.pool.release(connection, reuse=not response.will_close)
+            result = urllib2.addinfourl(body, response.msg, request.get_full_url())
+            result.code = response.status
+            result.msg = response.reason
+            return result
+
+
+class PooledS3Bucket(S3Bucket):
+    """ simples3 bucket sending its requests through a ConnectionPool. """
+
+    def __init__(self, *args, **kwargs):
+        self.pool = ConnectionPool(kwargs.pop('pool_size'))
+        S3Bucket.__init__(self, *args, **kwargs)
+
+    def build_opener(self):
+        return urllib2.build_opener(KeepAliveHandler(self.pool))
+
+    def make_url(self, key, args=None, arg_sep='&'):
+        return S3Bucket.make_url(self, key, args, arg_sep)
+
+
+class DeleteResult(object):
+    """ AsyncResult of a delete coalesced into a multi-object delete. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+    def ready(self):
+        return self.done.is_set()
+
+    def successful(self):
+        return self.error is None
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+
+    def get(self, timeout=None):
+        self.done.wait(timeout)
+        if not self.done.is_set():
+            raise TimeoutError()
+        if self.error is not None:
+            raise self.error
 
 
 ################################
@@ -21,11 +195,19 @@ class Storage(BaseStorage):
     S3_DOMAIN = getattr(settings, 'DBBACKUP_S3_DOMAIN', 'https://s3.amazonaws.com/')
     S3_DIRECTORY =  getattr(settings, 'DBBACKUP_S3_DIRECTORY', "django-dbbackups/")
     S3_DIRECTORY = '%s/' % S3_DIRECTORY.strip('/')
+    S3_PART_SIZE = max(getattr(settings, 'DBBACKUP_S3_PART_SIZE', 8*1024*1024), MIN_PART_SIZE)
+    S3_TRANSFER_THREADS = getattr(settings, 'DBBACKUP_S3_TRANSFER_THREADS', 4)
+    S3_RETRIES = getattr(settings, 'DBBACKUP_S3_RETRIES', 3)
+    S3_CONNECTION_POOL_SIZE = getattr(settings, 'DBBACKUP_S3_CONNECTION_POOL_SIZE', 10)
 
     def __init__(self, server_name=None):
         self._check_filesystem_errors()
         self.name = 'AmazonS3'
         self.baseurl = self.S3_DOMAIN + aws_urlquote(self.S3_BUCKET)
+        self._bucket = None
+        self._bucket_lock = threading.Lock()
+        self._deletes, self._deleting = [], False
+        self._deletes_lock = threading.Lock()
         BaseStorage.__init__(self)
 
     def _check_filesystem_errors(self):
@@ -43,8 +225,13 @@ class Storage(BaseStorage):
 
     @property
     def bucket(self):
-        return StreamingS3Bucket(self.S3_BUCKET, self.S3_ACCESS_KEY,
-            self.S3_SECRET_KEY, base_url=self.baseurl)
+        """ The bucket (and its connection pool) shared by all operations. """
+        with self._bucket_lock:
+            if not self._bucket:
+                self._bucket = PooledS3Bucket(self.S3_BUCKET, self.S3_ACCESS_KEY,
+                    self.S3_SECRET_KEY, base_url=self.baseurl,
+                    pool_size=self.S3_CONNECTION_POOL_SIZE)
+            return self._bucket
 
     def backup_dir(self):
         return self.S3_DIRECTORY
@@ -53,18 +240,273 @@ class Storage(BaseStorage):
         """ Delete the specified filepath. """
         del self.bucket[filepath]
 
+    def delete_files(self, filepaths):
+        """ Delete the specified filepaths with multi-object deletes of up
+            to MAX_DELETE_KEYS keys, sending several batches concurrently.
+        """
+        filepaths = list(filepaths)
+        batches = [filepaths[start:start + MAX_DELETE_KEYS]
+            for start in xrange(0, len(filepaths), MAX_DELETE_KEYS)]
+        errors = sum(self.map_concurrently(self.delete_batch, batches), [])
+        if errors:
+            raise StorageError("Error deleting: %s" % ', '.join(errors))
+
+    def delete_batch(self, filepaths):
+        """ Delete filepaths with one request, returning the failed keys. """
+        body = ''.join('<Object><Key>%s</Key></Object>' % escape(path) for path in filepaths)
+        body = '<Delete><Quiet>true</Quiet>%s</Delete>' % body
+        response = self.make_request('POST', None, 'delete', data=body)
+        return re.findall(r'<Error><Key>(.+?)</Key>', response.read())
+
+    def delete_file_async(self, filepath):
+        """ Queue filepath for deletion. Deletes queued while a batch is in
+            flight are sent together in the next multi-object delete, so
+            hundreds of concurrent deletes take a handful of requests.
+        """
+        result = DeleteResult()
+        with self._deletes_lock:
+            self._deletes.append((filepath, result))
+            flush, self._deleting = not self._deleting, True
+        if flush:
+            self.submit(self.flush_deletes)
+        return result
+
+    def flush_deletes(self):
+        """ Send the queued deletes, MAX_DELETE_KEYS at a time. """
+        while True:
+            with self._deletes_lock:
+                batch = self._deletes[:MAX_DELETE_KEYS]
+                del self._deletes[:MAX_DELETE_KEYS]
+                if not batch:
+                    self._deleting = False
+                    return
+            try:
+                failed, error = set(self.delete_batch([filepath for filepath, result in batch])), None
+            except Exception, err:
+                failed, error = None, err
+            for filepath, result in batch:
+                if failed is None:
+                    result.error = error
+                elif filepath in failed:
+                    result.error = StorageError("Error deleting: %s" % filepath)
+                result.done.set()
+
+    def file_size(self, filepath):
+        """ Return the size of the specified file from a HEAD request. """
+        try:
+            return self.bucket.info(filepath)['size']
+        except KeyError:
+            raise StorageError("File not found: %s" % filepath)
+        except S3Error, err:
+            raise StorageError("ERROR %s" % err)
+
     def list_directory(self):
         """ List all stored backups for the specified. """
-        return [x[0] for x in self.bucket.listdir(self.S3_DIRECTORY)]
+        filepaths, marker = [], None
+        while True:
+            keys = [x[0] for x in self.bucket.listdir(self.S3_DIRECTORY, marker=marker, limit=MAX_LIST_KEYS)]
+            filepaths.extend(keys)
+            if len(keys) < MAX_LIST_KEYS:
+                return filepaths
+            marker = keys[-1]
 
     def write_file(self, filehandle):
         """ Write the specified file. """
-        filepath = os.path.join(self.S3_DIRECTORY, filehandle.name)
-        self.bucket.put_file(filepath, filehandle)
+        filehandle.seek(0)
+        self.write_stream(utils.iter_chunks(filehandle, self.S3_PART_SIZE), filehandle.name)
+
+    def write_stream(self, chunks, name):
+        """ Write the specified chunks using a multipart upload, uploading
+            up to S3_TRANSFER_THREADS parts concurrently.
+        """
+        filepath = os.path.join(self.S3_DIRECTORY, name)
+        chunks = utils.regroup_chunks(chunks, self.S3_PART_SIZE)
+        first, second = next(chunks), next(chunks, None)
+        if second is None:
+            # Small objects take a single PUT instead of three requests
+            return self.put_object(filepath, first)
+        chunks = itertools.chain([first, second], chunks)
+        upload_id = self.initiate_multipart_upload(filepath)
+        pool = ThreadPool(self.S3_TRANSFER_THREADS)
+        pending, parts = deque(), []
+        try:
+            for number, data in enumerate(chunks, 1):
+                pending.append((number, pool.apply_async(self.upload_part, (filepath, upload_id, number, data))))
+                while len(pending) > self.S3_TRANSFER_THREADS:
+                    number, result = pending.popleft()
+                    parts.append((number, result.get()))
+            while pending:
+                number, result = pending.popleft()
+                parts.append((number, result.get()))
+            self.complete_multipart_upload(filepath, upload_id, parts)
+        except:
+            self.abort_multipart_upload(filepath, upload_id)
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def write_file_resumable(self, filehandle, name, journal):
+        """ Write the specified file with a multipart upload whose id and
+            completed parts are kept in journal, so resuming an interrupted
+            upload only sends the missing parts.
+        """
+        filepath = os.path.join(self.S3_DIRECTORY, name)
+        filehandle.seek(0, 2)
+        size = filehandle.tell()
+        if size <= self.S3_PART_SIZE:
+            filehandle.seek(0)
+            return self.put_object(filepath, filehandle.read())
+        state = journal.state
+        resumed = bool(state.get('upload_id')) and state.get('part_size') == self.S3_PART_SIZE
+        if resumed:
+            print "  Resuming upload of %s: %s parts already uploaded" % (name, len(state['parts']))
+        else:
+            journal.update(upload_id=self.initiate_multipart_upload(filepath),
+                part_size=self.S3_PART_SIZE, parts={})
+        # JSON gives unicode back, which httplib cannot join with the data
+        upload_id, parts = str(state['upload_id']), state['parts']
+        read_lock = threading.Lock()
+        def upload(number):
+            with read_lock:
+                filehandle.seek((number - 1) * self.S3_PART_SIZE)
+                data = filehandle.read(self.S3_PART_SIZE)
+            etag = self.upload_part(filepath, upload_id, number, data)
+            with journal.lock:
+                parts[str(number)] = etag
+                journal.save()
+        count = (size + self.S3_PART_SIZE - 1) // self.S3_PART_SIZE
+        missing = [number for number in xrange(1, count + 1) if str(number) not in parts]
+        pool = ThreadPool(self.S3_TRANSFER_THREADS)
+        try:
+            pool.map(upload, missing, chunksize=1)
+            self.complete_multipart_upload(filepath, upload_id,
+                sorted((int(number), str(etag)) for number, etag in parts.items()))
+        except StorageError, err:
+            # S3 answers 404 (NoSuchUpload) once an upload was aborted or expired
+            if not resumed or 'code=404' not in str(err):
+                raise
+            print "  Upload of %s expired, starting over" % name
+            journal.update(upload_id=None)
+            return self.write_file_resumable(filehandle, name, journal)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def put_object(self, filepath, data):
+        """ Upload data as filepath with a single PUT. """
+        self.upload_bucket.consume(len(data))
+        def put():
+            try:
+                self.bucket.put(filepath, data)
+            except S3Error, err:
+                raise StorageError("ERROR %s" % err)
+        utils.retry_call(put, retries=self.S3_RETRIES, exceptions=(StorageError,))
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
-        response = self.bucket.get(filepath)
         filehandle = tempfile.SpooledTemporaryFile(max_size=10*1024*1024)
-        copyfileobj(response, filehandle)
+        for data in self.read_stream(filepath):
+            filehandle.write(data)
+        filehandle.seek(0)
         return filehandle
+
+    def read_stream(self, filepath, offset=0):
+        """ Yield the specified file in order from offset, downloading up
+            to S3_TRANSFER_THREADS ranges of S3_PART_SIZE concurrently.
+        """
+        try:
+            size = self.bucket.info(filepath)['size']
+        except KeyError:
+            raise StorageError("File not found: %s" % filepath)
+        except S3Error, err:
+            raise StorageError("ERROR %s" % err)
+        pool = ThreadPool(self.S3_TRANSFER_THREADS)
+        pending = deque()
+        try:
+            for start in xrange(offset, size, self.S3_PART_SIZE):
+                end = min(start + self.S3_PART_SIZE, size) - 1
+                pending.append(pool.apply_async(self.read_range, (filepath, start, end)))
+                if len(pending) > self.S3_TRANSFER_THREADS:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def read_range(self, filepath, start, end):
+        """ Return the bytes start to end (inclusive) of filepath. """
+        def get_range():
+            headers = {'Range': 'bytes=%s-%s' % (start, end)}
+            try:
+                response = self.bucket.make_request('GET', key=filepath, headers=headers)
+            except S3Error, err:
+                raise StorageError("ERROR %s" % err)
+            try:
+                data = response.read()
+            except (socket.error, httplib.HTTPException), err:
+                raise StorageError("ERROR reading %s bytes %s-%s: %s" % (filepath, start, end, err))
+            finally:
+                response.close()
+            if len(data) != end - start + 1:
+                raise StorageError("Short read of %s bytes %s-%s" % (filepath, start, end))
+            return data
+        data = utils.retry_call(get_range, retries=self.S3_RETRIES, exceptions=(StorageError,))
+        self.download_bucket.consume(len(data))
+        return data
+
+    ###################################
+    #  S3 Multipart Upload Methods
+    ###################################
+
+    def initiate_multipart_upload(self, filepath):
+        """ Start a multipart upload and return its upload id. """
+        response = self.make_request('POST', filepath, 'uploads', data='')
+        return re.search(r'<UploadId>(.+?)</UploadId>', response.read()).group(1)
+
+    def upload_part(self, filepath, upload_id, number, data):
+        """ Upload a single part and return its ETag. A failing part is
+            retried on its own, without restarting the whole upload.
+        """
+        self.upload_bucket.consume(len(data))
+        def put_part():
+            subresource = 'partNumber=%s&uploadId=%s' % (number, upload_id)
+            response = self.make_request('PUT', filepath, subresource, data=data)
+            response.close()
+            return response.info().getheader('ETag')
+        return utils.retry_call(put_part, retries=self.S3_RETRIES, exceptions=(StorageError,))
+
+    def complete_multipart_upload(self, filepath, upload_id, parts):
+        """ Assemble the uploaded parts into the final object. """
+        body = ''.join('<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % part for part in parts)
+        body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % body
+        response = self.make_request('POST', filepath, 'uploadId=%s' % upload_id, data=body)
+        data = response.read()
+        if '<Error>' in data:
+            raise StorageError("Error completing upload of %s: %s" % (filepath, data))
+
+    def abort_multipart_upload(self, filepath, upload_id):
+        """ Discard the parts of an unfinished multipart upload. """
+        try:
+            self.make_request('DELETE', filepath, 'uploadId=%s' % upload_id).close()
+        except StorageError:
+            pass
+
+    def make_request(self, method, key, subresource, data=None, headers=None):
+        """ Make a signed request against an S3 subresource (which simples3
+            does not sign for us).
+        """
+        bucket = self.bucket
+        headers = dict(headers or {})
+        headers['Date'] = time.strftime(rfc822_fmt, time.gmtime())
+        if data is not None:
+            headers['Content-Length'] = str(len(data))
+            headers['Content-MD5'] = aws_md5(data)
+        signature = bucket.get_request_signature(method, key=key, headers=headers, subresource=subresource)
+        headers['Authorization'] = "AWS %s:%s" % (bucket.access_key, signature)
+        url = '%s?%s' % (bucket.make_url(key), subresource)
+        try:
+            return bucket.open_request(AnyMethodRequest(method, url, data=data, headers=headers))
+        except (urllib2.HTTPError, urllib2.URLError), err:
+            raise StorageError("ERROR %s" % S3Error.from_urllib(err, key=key))
@@ -0,0 +1,168 @@
+"""
+Selective backups of single tables: each table is dumped by its own worker
+into a separate file, and a manifest ties the files of a backup together
+with the foreign keys between them, so a restore loads the tables
+concurrently while parents are loaded before their children.
+"""
+import hashlib, json, os
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.management.base import CommandError
+from . import compression, metrics, registry, retention, utils, verify
+from .dbcommands import DBCommands
+from .storage.base import StorageError
+
+MANIFEST_VERSION = 1
+TABLES_EXTENSION = 'tables'
+WORKERS = getattr(settings, 'DBBACKUP_TABLE_WORKERS', 4)
+
+
+##################################
+#  Backup
+##################################
+
+def is_manifest(filepath):
+    return filepath.endswith('.' + TABLES_EXTENSION)
+
+def selection_extension(selected):
+    """ Return the manifest extension of a selection of tables. A hash of
+        the selection keeps backups of other tables taken at the same time
+        apart, and lets retention apply to each selection on its own.
+    """
+    label = hashlib.sha1(','.join(sorted(selected))).hexdigest()[:8]
+    return '%s.%s' % (label, TABLES_EXTENSION)
+
+def table_filename(filename, table, dbcommands):
+    """ Return the stored name of a table of the backup whose manifest is
+        named filename.
+    """
+    name = '%s.%s.%s' % (filename, table, dbcommands.settings.TABLE_EXTENSION)
+    if dbcommands.compression:
+        name += '.' + compression.extension(dbcommands.compression)
+    return name
+
+def write_backup(storage, database, selected, dependencies, filename, codec=None, workers=WORKERS):
+    """ Dump the selected tables, each by its own worker into a separate
+        file, then write the manifest as filename. The files of a failed
+        backup are deleted. Returns the manifest.
+    """
+    def backup_table(table):
+        dbcommands = DBCommands(database, codec, table)
+        name = table_filename(filename, table, dbcommands)
+        print "  Dumping table %s to %s" % (table, name)
+        chunks = utils.ChunkDigest(dbcommands.stream_backup_commands(commands=dbcommands.settings.TABLE_BACKUP_COMMANDS))
+        storage.write_stream(chunks, name)
+        return table, {'filename': name, 'size': chunks.size, 'checksum': chunks.hexdigest(),
+            'dependencies': dependencies[table]}
+    pool = ThreadPool(min(workers, len(selected)))
+    try:
+        results = [pool.apply_async(backup_table, (table,)) for table in selected]
+        for result in results:
+            result.wait()
+    finally:
+        pool.close()
+        pool.join()
+    failed = [result for result in results if not result.successful()]
+    if failed:
+        storage.delete_files([os.path.join(storage.backup_dir(), result.get()[1]['filename'])
+            for result in results if result.successful()])
+        failed[0].get()
+    manifest = {'version': MANIFEST_VERSION, 'database': database['NAME'], 'codec': codec,
+        'tables': dict(result.get() for result in results)}
+    storage.write_stream([json.dumps(manifest)], filename)
+    return manifest
+
+def read_manifest(storage, filepath):
+    manifest = json.loads(''.join(storage.read_stream(filepath)))
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise StorageError("Unsupported manifest version in %s" % filepath)
+    return manifest
+
+def list_backups(storage, dbcommands, servername=None, selected=None):
+    """ Return the parsed manifest filenames of the table backups of a
+        database (of the selected tables only if given), newest first.
+    """
+    filepaths = filter(is_manifest, storage.list_directory())
+    if selected is not None:
+        extensions = [selection_extension(selected)]
+    else:
+        extensions = set(filepath.rsplit('.', 2)[-2] + '.' + TABLES_EXTENSION for filepath in filepaths)
+    backups = []
+    for extension in extensions:
+        parser = dbcommands.filename_parser(servername, extension)
+        backups += filter(None, map(parser.parse, filepaths))
+    return sorted(backups, key=retention.sort_key, reverse=True)
+
+def find_backup(storage, dbcommands, servername=None, selected=()):
+    """ Return (filepath, manifest) of the latest table backup holding all
+        the selected tables, or (None, None).
+    """
+    for backup in list_backups(storage, dbcommands, servername):
+        manifest = read_manifest(storage, backup.filepath)
+        if set(selected) <= set(manifest['tables']):
+            return backup.filepath, manifest
+    return None, None
+
+def table_paths(filepath, manifest):
+    """ Return the storage paths of the table files of a manifest. """
+    return [os.path.join(os.path.dirname(filepath), entry['filename']) for entry in manifest['tables'].values()]
+
+
+##################################
+#  Restore
+##################################
+
+def run_levels(pool, func, levels):
+    """ Call func on the tables of each level concurrently (one at a time
+        without a pool), a level after the other.
+    """
+    for level in levels:
+        if pool:
+            pool.map(func, level)
+        else:
+            map(func, level)
+
+def restore_backup(storage, database, filepath, manifest, selected=(), workers=WORKERS):
+    """ Restore the selected tables (all by default) of a table backup. The
+        table files are downloaded and verified first; the tables are then
+        emptied children first and loaded parents first, concurrently within
+        each level of the foreign key order. SQLite allows a single writer,
+        so its tables are loaded one at a time.
+    """
+    selected = selected or sorted(manifest['tables'])
+    missing = set(selected) - set(manifest['tables'])
+    if missing:
+        raise CommandError("Tables not in %s: %s" % (filepath, ', '.join(sorted(missing))))
+    levels = registry.load_order(dict((table, manifest['tables'][table]['dependencies']) for table in selected))
+    codec = manifest['codec']
+    name = database['NAME']
+    backupfiles = {}
+
+    def download(table):
+        entry = manifest['tables'][table]
+        path = os.path.join(os.path.dirname(filepath), entry['filename'])
+        chunks = metrics.timed_chunks(storage.read_stream(path), 'download', name, storage.name)
+        chunks = verify.verified_chunks(chunks, entry['size'], entry['checksum'], path)
+        backupfiles[table] = utils.spool_chunks(chunks, path)
+
+    def clear(table):
+        dbcommands = DBCommands(database, table=table)
+        dbcommands.run_commands(dbcommands.settings.TABLE_CLEAR_COMMANDS)
+
+    def load(table):
+        dbcommands = DBCommands(database, table=table)
+        dbcommands.run_restore_commands(backupfiles[table], codec, dbcommands.settings.TABLE_RESTORE_COMMANDS)
+
+    pool = ThreadPool(min(workers, len(selected)))
+    writers = None if DBCommands(database).engine == 'sqlite3' else pool
+    try:
+        print "  Downloading %s tables" % len(selected)
+        pool.map(download, selected)
+        if DBCommands(database).settings.TABLE_CLEAR_COMMANDS:
+            run_levels(writers, clear, reversed(levels))
+        run_levels(writers, load, levels)
+    finally:
+        pool.close()
+        pool.join()
+        for backupfile in backupfiles.values():
+            backupfile.close()
@@ -0,0 +1,669 @@
+"""
+Tests of the dbbackup app, run with: ./manage.py test dbbackup
+"""
+import bz2, gzip, imp, json, os, random, shutil, tempfile, threading, time
+from datetime import datetime, timedelta
+from StringIO import StringIO
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db import IntegrityError
+from django.test import TransactionTestCase
+from django.utils import unittest
+from . import catalog, checkpoint, compression, dedup, filenames, retention, serializer, utils
+from .dbcommands import DBCommands
+from .management.commands import dbbackup
+from .storage import filesystem_storage, multi_storage
+from .storage.base import StorageError
+try:
+    from .storage import s3_storage
+except ImportError:
+    s3_storage = None
+
+BENCHMARKS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+
+
+def filesystem(directory):
+    """ Return a filesystem storage writing to directory. """
+    storage = filesystem_storage.Storage()
+    storage.BACKUP_DIRECTORY = directory + '/'
+    return storage
+
+
+class ChunkHelpersTest(unittest.TestCase):
+
+    def test_regroup_chunks(self):
+        chunks = ['a' * 10, '', 'b' * 1000, 'c' * 3]
+        regrouped = list(utils.regroup_chunks(chunks, 64))
+        self.assertEqual(''.join(regrouped), ''.join(chunks))
+        self.assertEqual([len(data) for data in regrouped], [64] * 15 + [53])
+        self.assertEqual(list(utils.regroup_chunks([], 64)), [''])
+
+    def test_chunk_reader(self):
+        reader = utils.ChunkReader(['abc', '', 'defgh', 'i' * 100])
+        self.assertEqual(reader.read(2), 'ab')
+        self.assertEqual(reader.read(4), 'cdef')
+        self.assertEqual(reader.read(0), '')
+        self.assertEqual(reader.read(3), 'ghi')
+        self.assertEqual(reader.read(), 'i' * 99)
+        self.assertEqual(reader.read(1), '')
+
+
+class DedupMultiStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.first, self.second = [filesystem(directory) for directory in self.directories]
+        self.storage = multi_storage.Storage([self.first, self.second])
+        self.dump = ''.join('INSERT INTO t VALUES (%s, %s);\n' % (i, i * 7) for i in xrange(200000))
+
+    def tearDown(self):
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def chunks(self, storage):
+        return dedup.stored_chunks(storage.list_directory())
+
+    def test_chunks_reach_every_storage(self):
+        # Only the first storage holds the chunks of an earlier backup
+        dedup.write_backup(self.first, [self.dump], 'first-backup')
+        self.assertTrue(self.chunks(self.first))
+        self.assertFalse(self.chunks(self.second))
+        dedup.write_backup(self.storage, [self.dump], 'second-backup')
+        self.assertEqual(self.chunks(self.first), self.chunks(self.second))
+        manifest = os.path.join(self.second.backup_dir(), dedup.manifest_name('second-backup'))
+        self.assertEqual(''.join(dedup.read_backup(self.second, manifest)), self.dump)
+
+
+class DedupGarbageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = filesystem(self.directory)
+        dump = ''.join('INSERT INTO t VALUES (%s);\n' % i for i in xrange(100000))
+        dedup.write_backup(self.storage, [dump], 'backup')
+        self.chunks = dedup.stored_chunks(self.storage.list_directory())
+        self.storage.delete_file(os.path.join(self.storage.backup_dir(), dedup.manifest_name('backup')))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unreferenced_chunks_kept_for_grace(self):
+        self.assertEqual(dedup.collect_garbage(self.storage, grace=3600), [])
+        self.assertEqual(dedup.stored_chunks(self.storage.list_directory()), self.chunks)
+        self.assertEqual(dedup.collect_garbage(self.storage, grace=3600), [])
+        # Two hours later
+        self.backdate_state(7200)
+        self.assertEqual(len(dedup.collect_garbage(self.storage, grace=3600)), len(self.chunks))
+        self.assertFalse(dedup.stored_chunks(self.storage.list_directory()))
+
+    def test_no_grace(self):
+        self.assertEqual(len(dedup.collect_garbage(self.storage, grace=0)), len(self.chunks))
+
+    def backdate_state(self, seconds):
+        statepath = os.path.join(self.directory, dedup.GC_STATE_NAME)
+        state = json.load(open(statepath))
+        json.dump(dict((name, seen - seconds) for name, seen in state.items()), open(statepath, 'w'))
+
+    def test_chunks_reused_by_running_backup_kept(self):
+        dedup.collect_garbage(self.storage, grace=3600)
+        self.backdate_state(7200)
+        dump = ''.join('INSERT INTO t VALUES (%s);\n' % i for i in xrange(100000))
+        def chunks():
+            # The chunks past grace are listed as stored, now another
+            # process collects garbage before the manifest is written
+            active, dedup.ACTIVE_BACKUPS[0] = dedup.ACTIVE_BACKUPS[0], 0
+            try:
+                self.assertEqual(dedup.collect_garbage(self.storage, grace=3600), [])
+            finally:
+                dedup.ACTIVE_BACKUPS[0] = active
+            yield dump
+        dedup.write_backup(self.storage, chunks(), 'reused')
+        manifest = os.path.join(self.storage.backup_dir(), dedup.manifest_name('reused'))
+        self.assertEqual(''.join(dedup.read_backup(self.storage, manifest)), dump)
+        self.assertEqual(dedup.collect_garbage(self.storage, grace=3600), [])
+        self.assertEqual(dedup.stored_chunks(self.storage.list_directory()), self.chunks)
+
+    def test_backup_waits_for_running_gc(self):
+        events = []
+        def collect():
+            with dedup.storage_lock(self.storage, 'gc'):
+                events.append('gc started')
+                time.sleep(1.5)
+                events.append('gc done')
+        thread = threading.Thread(target=collect)
+        thread.start()
+        while not events:
+            time.sleep(0.01)
+        dedup.write_backup(self.storage, ['INSERT 1;\n'], 'waiting')
+        events.append('backup done')
+        thread.join()
+        self.assertEqual(events, ['gc started', 'gc done', 'backup done'])
+        self.assertFalse([path for path in self.storage.list_directory() if dedup.LOCK_PREFIX in path])
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = filesystem(self.directory)
+        self.poll, catalog.LOCK_POLL = catalog.LOCK_POLL, 0.05
+
+    def tearDown(self):
+        catalog.LOCK_POLL = self.poll
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_saves_keep_every_entry(self):
+        catalogs = [catalog.Catalog(self.storage) for i in range(3)]
+        def add(number, instance):
+            for i in range(5):
+                instance.add({'NAME': 'db'}, 'server', None, 'backup-%s-%s' % (number, i))
+        threads = [threading.Thread(target=add, args=item) for item in enumerate(catalogs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        entries = catalog.Catalog(self.storage).backups({'NAME': 'db'}, 'server')
+        self.assertEqual(len(entries), 15)
+        self.assertFalse([path for path in self.storage.list_directory() if dedup.LOCK_PREFIX in path])
+
+    def test_reindex_finds_backups_written_without_catalog(self):
+        dbcommands = DBCommands(settings.DATABASES['default'])
+        database = dbcommands.database
+        self.storage.write_stream(['dump'], dbcommands.filename('server'))
+        instance = catalog.Catalog(self.storage)
+        instance.index(dbcommands, 'server')
+        self.assertEqual(len(instance.backups(database, 'server')), 1)
+        # Another tool deletes the backup and writes a newer one
+        filepath = instance.backups(database, 'server')[0][3]
+        self.storage.delete_file(filepath)
+        time.sleep(1)
+        self.storage.write_stream(['dump'], dbcommands.filename('server'))
+        instance = catalog.Catalog(self.storage)
+        instance.index(dbcommands, 'server')
+        self.assertEqual([entry[3] for entry in instance.backups(database, 'server')], [filepath])
+        instance.indexed[instance.key(database, 'server')] -= catalog.CATALOG_REINDEX
+        instance.index(dbcommands, 'server')
+        entries = catalog.Catalog(self.storage).backups(database, 'server')
+        self.assertEqual(len(entries), 1)
+        self.assertNotEqual(entries[0][3], filepath)
+
+
+@unittest.skipIf(s3_storage is None, "simples3 is not installed")
+class S3StorageTest(unittest.TestCase):
+    """ S3 storage against the stand-in of benchmarks/s3server.py. """
+
+    def setUp(self):
+        s3server = imp.load_source('s3server', os.path.join(BENCHMARKS_DIR, 's3server.py'))
+        self.server = s3server.S3Server().start()
+        url = self.server.url
+        class Storage(s3_storage.Storage):
+            S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY = 'bucket', 'key', 'secret'
+            S3_DOMAIN = url
+            S3_PART_SIZE = s3_storage.MIN_PART_SIZE
+            S3_CONNECTION_POOL_SIZE = 4
+            S3_RETRIES = 0
+        self.storage = Storage()
+        self.data = os.urandom(2 * s3_storage.MIN_PART_SIZE + 12345)
+        self.key = self.storage.S3_DIRECTORY + 'backup'
+
+    def tearDown(self):
+        # Close the kept-alive connections so the server threads finish
+        idle = self.storage.bucket.pool.idle
+        while not idle.empty():
+            idle.get().close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def assertConnectionsReleased(self):
+        slots = self.storage.bucket.pool.slots
+        acquired = [slots.acquire(False) for i in range(self.storage.S3_CONNECTION_POOL_SIZE)]
+        for i in filter(None, acquired):
+            slots.release()
+        self.assertTrue(all(acquired))
+
+    def test_multipart_upload(self):
+        self.storage.write_stream(utils.iter_chunks(StringIO(self.data), 64 * 1024), 'backup')
+        self.assertEqual(self.server.upload_count, 1)
+        self.assertEqual(self.server.objects[self.key], self.data)
+        self.assertFalse(self.server.uploads)
+        self.storage.write_stream(['small'], 'small')
+        self.assertEqual(self.server.upload_count, 1)
+        self.assertEqual(self.server.objects[self.storage.S3_DIRECTORY + 'small'], 'small')
+        self.assertConnectionsReleased()
+
+    def test_upload_aborted_on_error(self):
+        upload_part = self.storage.upload_part
+        def failing_part(filepath, upload_id, number, data):
+            if number == 2:
+                raise StorageError("part %s failed" % number)
+            return upload_part(filepath, upload_id, number, data)
+        self.storage.upload_part = failing_part
+        self.assertRaises(StorageError, self.storage.write_stream, [self.data], 'backup')
+        self.assertEqual(self.server.upload_count, 1)
+        self.assertFalse(self.server.uploads)
+        self.assertFalse(self.key in self.server.objects)
+        self.assertConnectionsReleased()
+
+    def test_ranged_read(self):
+        self.server.objects[self.key] = self.data
+        for offset in (0, 1, s3_storage.MIN_PART_SIZE, len(self.data) - 1):
+            self.assertEqual(''.join(self.storage.read_stream(self.key, offset)), self.data[offset:])
+        self.assertEqual(self.storage.file_size(self.key), len(self.data))
+        self.assertRaises(StorageError, list, self.storage.read_stream(self.key + '-missing'))
+        self.assertConnectionsReleased()
+        # Streamed bodies hand their connection back for the next requests
+        self.assertTrue(self.storage.bucket.pool.idle.qsize())
+        # A large body is not read before it is asked for
+        response = self.storage.bucket.get(self.key)
+        self.assertTrue(isinstance(response.fp, s3_storage.PooledResponse))
+        self.assertEqual(response.read(10), self.data[:10])
+        response.close()
+        self.assertConnectionsReleased()
+
+    def test_multi_delete(self):
+        keys = [self.storage.S3_DIRECTORY + 'backup-%s' % i for i in range(5)]
+        for key in keys:
+            self.server.objects[key] = 'data'
+        self.storage.delete_files(keys[:3])
+        self.assertEqual(sorted(self.server.objects), keys[3:])
+        results = [self.storage.delete_file_async(key) for key in keys[3:]]
+        for result in results:
+            result.get(10)
+        self.assertFalse(self.server.objects)
+        self.assertConnectionsReleased()
+
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime(2013, 3, 15, 12)
+        # Daily at 01:00 since January 1st, and twice more on the last day
+        days = [datetime(2013, 1, 1, 1) + timedelta(days=day) for day in range(74)]
+        self.backups = [self.backup(when) for when in days + [datetime(2013, 3, 15, 5), datetime(2013, 3, 15, 9)]]
+
+    def backup(self, when):
+        name = 'db-%s.dump' % (when.strftime('%Y-%m-%d-%H%M%S') if when else 'undated')
+        return filenames.BackupFilename(name, 'db', 'server', when, 'dump', None)
+
+    def plan(self, policy, backups=None, sizes=None):
+        plan = retention.plan_policy(backups or self.backups, policy, sizes, self.now)
+        self.assertEqual(len(plan.keep) + len(plan.delete), len(backups or self.backups))
+        return plan
+
+    def kept(self, plan):
+        return sorted(backup.datetime for backup in plan.keep)
+
+    def test_gfs_buckets(self):
+        plan = self.plan({'hourly': 2, 'daily': 3, 'weekly': 2, 'monthly': 2})
+        self.assertEqual(self.kept(plan), [datetime(2013, 2, 28, 1), datetime(2013, 3, 10, 1),
+            datetime(2013, 3, 13, 1), datetime(2013, 3, 14, 1), datetime(2013, 3, 15, 5), datetime(2013, 3, 15, 9)])
+        self.assertEqual(plan.reasons[plan.keep[0].filepath], ['hourly', 'daily', 'weekly', 'monthly'])
+        self.assertEqual(plan.reasons[plan.keep[1].filepath], ['hourly'])
+        self.assertEqual(plan.reasons[self.backup(datetime(2013, 3, 10, 1)).filepath], ['weekly'])
+        self.assertEqual(plan.reasons[self.backup(datetime(2013, 3, 15, 1)).filepath], ['expired'])
+        # Periods without a backup do not use up a bucket
+        plan = self.plan({'monthly': 2}, self.backups[:31] + self.backups[-1:])
+        self.assertEqual(self.kept(plan), [datetime(2013, 1, 31, 1), datetime(2013, 3, 15, 9)])
+
+    def test_last(self):
+        plan = self.plan({'last': 3})
+        self.assertEqual(self.kept(plan), [datetime(2013, 3, 15, 1), datetime(2013, 3, 15, 5), datetime(2013, 3, 15, 9)])
+
+    def test_max_age(self):
+        plan = self.plan({'daily': 30, 'max_age': 5})
+        self.assertEqual(self.kept(plan), [datetime(2013, 3, day, 1) for day in range(11, 15)] + [datetime(2013, 3, 15, 9)])
+        self.assertEqual(plan.reasons[self.backup(datetime(2013, 3, 10, 1)).filepath], ['max_age'])
+        self.assertEqual(self.kept(self.plan({'daily': 30, 'max_age': timedelta(days=5)})), self.kept(plan))
+
+    def test_max_size(self):
+        sizes = dict((backup.filepath, 100) for backup in self.backups)
+        plan = self.plan({'last': 10, 'max_size': 250}, sizes=sizes)
+        self.assertEqual(self.kept(plan), [datetime(2013, 3, 15, 5), datetime(2013, 3, 15, 9)])
+        self.assertEqual(plan.reasons[self.backup(datetime(2013, 3, 15, 1)).filepath], ['max_size'])
+        # Once full, smaller backups are not squeezed in
+        sizes[self.backup(datetime(2013, 3, 14, 1)).filepath] = 10
+        self.assertEqual(len(self.plan({'last': 10, 'max_size': 250}, sizes=sizes).keep), 2)
+
+    def test_newest_always_kept(self):
+        sizes = dict((backup.filepath, 1000) for backup in self.backups)
+        self.now = datetime(2014, 1, 1)
+        for policy in ({}, {'max_age': 1}, {'last': 5, 'max_size': 10}):
+            plan = self.plan(policy, sizes=sizes)
+            self.assertEqual(self.kept(plan), [datetime(2013, 3, 15, 9)])
+        self.assertEqual(plan.reasons[plan.keep[0].filepath], ['last'])
+        self.assertEqual(self.plan({}).reasons[plan.keep[0].filepath], ['newest'])
+
+    def test_undated_kept(self):
+        undated = self.backup(None)
+        plan = self.plan({'last': 1, 'max_age': 1, 'max_size': 1}, self.backups + [undated])
+        self.assertTrue(undated in plan.keep)
+        self.assertEqual(plan.reasons[undated.filepath], ['undated'])
+        keep, delete = retention.plan_cleanup(self.backups + [undated], keep_last=2)
+        self.assertTrue(undated in keep)
+
+    def test_plan_cleanup(self):
+        keep, delete = retention.plan_cleanup(self.backups, keep_last=3)
+        self.assertEqual(sorted(backup.datetime for backup in keep), [datetime(2013, 1, 1, 1), datetime(2013, 2, 1, 1),
+            datetime(2013, 3, 1, 1), datetime(2013, 3, 15, 1), datetime(2013, 3, 15, 5), datetime(2013, 3, 15, 9)])
+        self.assertEqual(len(delete), len(self.backups) - 6)
+
+    def test_unknown_policy_key(self):
+        self.assertRaises(CommandError, self.plan, {'weekly': 4, 'montly': 6})
+
+
+class FilenameParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = filenames.FilenameParser('db-web.1+[x]-%s.dump' % filenames.DATETIME_TOKEN,
+            '%Y-%m-%d-%H%M%S', 'dump', 'db', 'web.1+[x]')
+        self.when = datetime(2013, 3, 15, 9, 30, 5)
+
+    def test_plain(self):
+        backup = self.parser.parse('/backups/db-web.1+[x]-2013-03-15-093005.dump')
+        self.assertEqual(backup, filenames.BackupFilename('/backups/db-web.1+[x]-2013-03-15-093005.dump',
+            'db', 'web.1+[x]', self.when, 'dump', None))
+
+    def test_codec_suffixes(self):
+        for codec, (ext, compressor, decompressor) in compression.CODECS.items():
+            backup = self.parser.parse('db-web.1+[x]-2013-03-15-093005.dump.' + ext)
+            self.assertEqual((backup.codec, backup.extension, backup.datetime), (codec, 'dump.' + ext, self.when))
+
+    def test_manifest_suffixes(self):
+        backup = self.parser.parse('db-web.1+[x]-2013-03-15-093005.dump.manifest')
+        self.assertEqual((backup.codec, backup.extension), (None, 'dump.manifest'))
+        backup = self.parser.parse('db-web.1+[x]-2013-03-15-093005.dump.gz.manifest')
+        self.assertEqual((backup.codec, backup.extension), ('gzip', 'dump.gz.manifest'))
+
+    def test_non_matching(self):
+        for filepath in (
+                'db-web.1+[x]-2013-03-15-093005.dump.gz.bak',
+                'db-web.1+[x]-2013-03-15-093005.dump.zip',
+                'db-web.1+[x]-2013-03-15-093005.dump.manifest.gz',
+                'db-web.1+[x]-2013-03-15-093005.sql',
+                'db-web.1+[x]-2013-03-15-0930.dump',
+                'db-web.1+[x]-latest.dump',
+                # Regex metacharacters of the servername are matched literally
+                'db-webX1+[x]-2013-03-15-093005.dump',
+                'db-web.11[x]-2013-03-15-093005.dump',
+                'db-web.1+x-2013-03-15-093005.dump',
+                # Another database or server whose name ends the same
+                'otherdb-web.1+[x]-2013-03-15-093005.dump',
+                'db-web.1+[x]-2013-03-15-093005.dump/',
+                '/db-web.1+[x]-2013-03-15-093005.dump/other',
+                dedup.GC_STATE_NAME, catalog.CATALOG_NAME):
+            self.assertFalse(self.parser.match(filepath), filepath)
+            self.assertEqual(self.parser.parse(filepath), None)
+
+    def test_invalid_date(self):
+        backup = self.parser.parse('db-web.1+[x]-2013-13-45-093005.dump')
+        self.assertEqual((backup.datetime, backup.extension), (None, 'dump'))
+
+    def test_strptime_formats(self):
+        parser = filenames.FilenameParser('db-%s.dump' % filenames.DATETIME_TOKEN, '%d%b%Y-%H', 'dump', 'db', '')
+        self.assertEqual(parser.date_fields, None)
+        self.assertEqual(parser.parse('db-15Mar2013-09.dump').datetime, datetime(2013, 3, 15, 9))
+        self.assertEqual(parser.parse('db-15Xyz2013-09.dump').datetime, None)
+
+    def test_template_without_date(self):
+        parser = filenames.FilenameParser('db.dump', '%Y', 'dump', 'db', '')
+        self.assertEqual(parser.parse('db.dump.gz').datetime, None)
+        self.assertFalse(parser.match('db-2013.dump'))
+
+    def test_parsers_cached(self):
+        args = ('db-%s.dump' % filenames.DATETIME_TOKEN, '%Y-%m-%d', 'dump', 'db', '')
+        self.assertTrue(filenames.get_parser(*args) is filenames.get_parser(*args))
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = ''.join('INSERT INTO t VALUES (%s, %r);\n' % (i, os.urandom(i % 7)) for i in xrange(20000))
+
+    def split(self, data, size):
+        return [data[start:start + size] for start in xrange(0, len(data), size)]
+
+    def gzip_members(self, *parts):
+        output = StringIO()
+        for part in parts:
+            member = gzip.GzipFile(fileobj=output, mode='wb')
+            member.write(part)
+            member.close()
+        return output.getvalue()
+
+    def test_round_trip(self):
+        for codec in compression.CODECS:
+            compressed = ''.join(compression.compress_chunks(self.split(self.data, 1000), codec, 6))
+            for size in (1, 4096, len(compressed)):
+                self.assertEqual(''.join(compression.decompress_chunks(self.split(compressed, size), codec)), self.data)
+
+    def test_multi_member_gzip(self):
+        half = len(self.data) // 2
+        compressed = self.gzip_members(self.data[:half], '', self.data[half:])
+        for size in (7, 4096, len(compressed)):
+            self.assertEqual(''.join(compression.decompress_chunks(self.split(compressed, size), 'gzip')), self.data)
+
+    def test_multi_stream_bz2(self):
+        half = len(self.data) // 2
+        compressed = bz2.compress(self.data[:half]) + bz2.compress(self.data[half:])
+        for size in (7, 4096, len(compressed)):
+            self.assertEqual(''.join(compression.decompress_chunks(self.split(compressed, size), 'bz2')), self.data)
+
+    def test_parallel_block_order(self):
+        compress_block = compression.compress_block
+        def slow_compress_block(block, codec, level):
+            # Finish the blocks out of order
+            time.sleep(random.random() * 0.02)
+            return compress_block(block, codec, level)
+        compression.compress_block = slow_compress_block
+        try:
+            for codec in compression.CODECS:
+                blocks = list(compression.parallel_compress_chunks(self.split(self.data, 3000), codec, 6, 4, 16 * 1024))
+                self.assertEqual(len(blocks), (len(self.data) + 16 * 1024 - 1) // (16 * 1024))
+                self.assertEqual(''.join(compression.decompress_chunks(blocks, codec)), self.data)
+        finally:
+            compression.compress_block = compress_block
+        # The concatenated blocks are still read by the standard tools
+        compressed = ''.join(compression.parallel_compress_chunks([self.data], 'gzip', 6, 4, 16 * 1024))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), self.data)
+
+
+class MultiStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directories = [tempfile.mkdtemp() for i in range(3)]
+        self.storages = [filesystem(directory) for directory in self.directories]
+        for number, storage in enumerate(self.storages):
+            storage.name = 'storage-%s' % number
+        self.storage = multi_storage.Storage(self.storages)
+        self.storage.TEE_BUFFER_SIZE = 4 * self.storage.TEE_CHUNK_SIZE
+        self.data = os.urandom(64 * self.storage.TEE_CHUNK_SIZE + 123)
+
+    def tearDown(self):
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def chunks(self):
+        return utils.iter_chunks(StringIO(self.data), 10000)
+
+    def stored(self, storage):
+        path = os.path.join(storage.backup_dir(), 'backup')
+        return open(path, 'rb').read() if os.path.exists(path) else None
+
+    def test_tee(self):
+        self.storage.write_stream(self.chunks(), 'backup')
+        self.assertEqual([self.stored(storage) for storage in self.storages], [self.data] * 3)
+        self.assertEqual(self.storage.failures, [])
+
+    def test_failing_destination(self):
+        def write_stream(chunks, name):
+            next(chunks)
+            raise StorageError("disk full")
+        self.storages[1].write_stream = write_stream
+        self.storage.write_stream(self.chunks(), 'backup')
+        self.assertEqual([self.stored(storage) for storage in self.storages], [self.data, None, self.data])
+        self.assertEqual(len(self.storage.failures), 1)
+        name, filename, error = self.storage.failures[0]
+        self.assertEqual((name, filename, str(error)), ('storage-1', 'backup', 'disk full'))
+
+    def test_destination_timing_out(self):
+        self.storage.TEE_TIMEOUT = 0.2
+        write_stream = self.storages[0].write_stream
+        def stalled_write_stream(chunks, name):
+            def stalled():
+                for number, data in enumerate(chunks):
+                    if number == 2:
+                        time.sleep(1)
+                    yield data
+            write_stream(stalled(), name)
+        self.storages[0].write_stream = stalled_write_stream
+        started = time.time()
+        self.storage.write_stream(self.chunks(), 'backup')
+        # The others were not held up for the whole stall of each chunk
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual([self.stored(storage) for storage in self.storages], [None, self.data, self.data])
+        self.assertEqual([failure[0] for failure in self.storage.failures], ['storage-0'])
+        self.assertTrue('did not keep up' in str(self.storage.failures[0][2]))
+        self.assertFalse(os.listdir(self.directories[0]))
+
+    def test_every_destination_failing(self):
+        def write_stream(chunks, name):
+            raise StorageError("offline")
+        for storage in self.storages:
+            storage.write_stream = write_stream
+        started = time.time()
+        self.assertRaises(StorageError, self.storage.write_stream, self.chunks(), 'backup')
+        # Destinations that stopped reading do not hold the tee for TEE_TIMEOUT
+        self.assertTrue(time.time() - started < 5)
+
+    def test_read_falls_back(self):
+        self.storage.write_stream(self.chunks(), 'backup')
+        filepath = os.path.join(self.storages[0].backup_dir(), 'backup')
+        os.remove(filepath)
+        def read_stream(filepath, offset=0):
+            raise IOError("unreachable")
+            yield
+        self.storages[1].read_stream = read_stream
+        self.assertEqual(''.join(self.storage.read_stream(filepath)), self.data)
+        self.assertEqual(''.join(self.storage.read_stream(filepath, 1000)), self.data[1000:])
+        self.assertEqual(self.storage.read_file(filepath).read(), self.data)
+        for storage in self.storages[1:]:
+            os.remove(os.path.join(storage.backup_dir(), 'backup'))
+        self.assertRaises(StorageError, list, self.storage.read_stream(filepath))
+
+
+class ResumeBackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoints = checkpoint.CHECKPOINT_DIRECTORY
+        checkpoint.CHECKPOINT_DIRECTORY = os.path.join(self.directory, 'checkpoints')
+        os.mkdir(os.path.join(self.directory, 'backups'))
+        self.storage = filesystem(os.path.join(self.directory, 'backups'))
+        self.command = dbbackup.Command()
+        self.command.storage, self.command.catalog = self.storage, None
+        self.command.servername, self.command.compression, self.command.deduplicate = 'server', None, False
+        self.database = dict(settings.DATABASES['default'], NAME='resumed')
+        self.dbcommands = DBCommands(self.database)
+        self.dump = ''.join('INSERT INTO t VALUES (%s);\n' % i for i in xrange(100000))
+        self.dumps = 0
+        self.dbcommands.stream_backup_commands = self.stream_backup_commands
+
+    def tearDown(self):
+        checkpoint.CHECKPOINT_DIRECTORY = self.checkpoints
+        shutil.rmtree(self.directory)
+
+    def stream_backup_commands(self):
+        self.dumps += 1
+        return utils.iter_chunks(StringIO(self.dump), 10000)
+
+    def test_interrupted_backup_resumes(self):
+        def interrupted(filehandle, name, journal):
+            # The transfer stops halfway through
+            with self.storage.partial_file(name, 0) as writer:
+                writer.write(filehandle.read(len(self.dump) // 2))
+                writer.flush()
+                raise IOError("Connection lost")
+        self.storage.write_file_resumable = interrupted
+        self.assertRaises(IOError, self.command.resume_new_backup, self.database, self.dbcommands)
+        journal = checkpoint.Journal('dbbackup', self.storage.name, 'resumed', 'server', '', 'False')
+        self.assertTrue(os.path.exists(journal.path))
+        self.assertEqual(os.path.getsize(journal.staging), len(self.dump))
+        self.assertFalse(self.storage.list_directory())
+        # The rerun uploads from the journal, without dumping again
+        del self.storage.write_file_resumable
+        partial_file, offsets = self.storage.partial_file, []
+        def recorded_partial_file(name, offset=None):
+            offsets.append(offset)
+            return partial_file(name, offset)
+        self.storage.partial_file = recorded_partial_file
+        self.command.resume_new_backup(self.database, self.dbcommands)
+        self.assertEqual(self.dumps, 1)
+        self.assertEqual(offsets, [len(self.dump) // 2])
+        backups = self.storage.list_directory()
+        self.assertEqual(len(backups), 1)
+        self.assertEqual(open(backups[0], 'rb').read(), self.dump)
+        self.assertEqual(os.path.basename(backups[0]), journal.state['filename'])
+        self.assertFalse(os.path.exists(journal.path))
+        self.assertFalse(os.path.exists(journal.staging))
+        # A later backup starts over with a new dump
+        self.command.resume_new_backup(self.database, self.dbcommands)
+        self.assertEqual(self.dumps, 2)
+
+
+@unittest.skipUnless('django.contrib.auth' in settings.INSTALLED_APPS, "django.contrib.auth is not installed")
+class SerializerTest(TransactionTestCase):
+    """ Dump and load the tables of django.contrib.auth. """
+    tables = ['auth_group', 'auth_user', 'auth_user_groups']
+
+    def setUp(self):
+        from django.contrib.auth.models import Group, User
+        self.Group, self.User = Group, User
+        groups = [Group.objects.create(name='group-%s' % i) for i in range(3)]
+        for i in range(30):
+            user = User.objects.create(username='user-%s' % i, last_login=datetime(2013, 3, 15, 9, i))
+            user.groups = groups[:i % 4]
+        # Gaps in the primary keys
+        User.objects.filter(username__in=['user-3', 'user-10', 'user-11']).delete()
+
+    def snapshot(self):
+        return (list(self.Group.objects.order_by('pk').values_list()),
+                list(self.User.objects.order_by('pk').values_list()),
+                list(self.User.groups.through.objects.order_by('pk').values_list()))
+
+    def test_pk_range_paging(self):
+        records = list(serializer.dump_model('default', self.User, batch_size=7))
+        stream = StringIO(serializer.MAGIC + ''.join(records))
+        pages = [payload for kind, payload in serializer.iter_records(stream) if kind == serializer.ROWS]
+        self.assertEqual([len(page) for page in pages], [7, 7, 7, 6])
+        usernames = [row[1] for page in pages for row in page]
+        self.assertEqual(usernames, list(self.User.objects.order_by('pk').values_list('username', flat=True)))
+
+    def test_round_trip(self):
+        before = self.snapshot()
+        backup = ''.join(serializer.dump('default', self.tables, chunk_size=1000))
+        self.User.objects.filter(username='user-5').update(username='renamed')
+        self.User.objects.filter(username='user-20').delete()
+        self.User.objects.create(username='added')
+        self.Group.objects.create(name='added')
+        serializer.load('default', utils.iter_chunks(StringIO(backup), 333), self.tables, batch_size=7)
+        self.assertEqual(self.snapshot(), before)
+        # The sequences continue after the loaded rows
+        last = max(row[0] for row in before[1])
+        self.assertTrue(self.User.objects.create(username='new').pk > last)
+
+    def test_constraints_checked(self):
+        before = self.snapshot()
+        backup = ''.join(serializer.dump('default', ['auth_user_groups']))
+        # The backup of auth_user_groups now references a missing group
+        self.Group.objects.filter(name='group-0').delete()
+        after = self.snapshot()
+        self.assertNotEqual(after, before)
+        self.assertRaises(IntegrityError, serializer.load, 'default', StringIO(backup), ['auth_user_groups'])
+        # The failed load was rolled back
+        self.assertEqual(self.snapshot(), after)
+
+    def test_missing_tables(self):
+        backup = ''.join(serializer.dump('default', ['auth_group']))
+        self.assertRaises(CommandError, serializer.load, 'default', StringIO(backup), ['auth_group', 'auth_user'])
+        self.assertRaises(CommandError, serializer.load, 'default', StringIO('not a backup'))
+        self.assertRaises(CommandError, serializer.load, 'default', StringIO(backup[:-5]))
@@ -0,0 +1,130 @@
+"""
+Token-bucket rate limits for the dump and the storage transfers, lifted or
+raised inside an off-peak window, and the priority of the dump commands.
+"""
+import threading, time
+from datetime import datetime
+from distutils.spawn import find_executable
+from django.conf import settings
+
+DUMP_RATE_LIMIT = getattr(settings, 'DBBACKUP_DUMP_RATE_LIMIT', None)
+UPLOAD_RATE_LIMIT = getattr(settings, 'DBBACKUP_UPLOAD_RATE_LIMIT', None)
+DOWNLOAD_RATE_LIMIT = getattr(settings, 'DBBACKUP_DOWNLOAD_RATE_LIMIT', None)
+OFF_PEAK_HOURS = getattr(settings, 'DBBACKUP_OFF_PEAK_HOURS', None)
+OFF_PEAK_RATE_FACTOR = getattr(settings, 'DBBACKUP_OFF_PEAK_RATE_FACTOR', None)
+NICE = getattr(settings, 'DBBACKUP_NICE', None)
+IONICE = getattr(settings, 'DBBACKUP_IONICE', None)
+BURST_SECONDS = 1.0
+
+IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+
+##################################
+#  Off-Peak Window
+##################################
+
+def parse_time(value):
+    """ Return the minutes since midnight of 'HH:MM'. """
+    hours, minutes = str(value).split(':')
+    return int(hours) * 60 + int(minutes)
+
+def off_peak(now=None):
+    """ Return True if now falls inside DBBACKUP_OFF_PEAK_HOURS, a
+        ('HH:MM', 'HH:MM') window which may wrap around midnight.
+    """
+    if not OFF_PEAK_HOURS:
+        return False
+    now = now or datetime.now()
+    start, end = map(parse_time, OFF_PEAK_HOURS)
+    minute = now.hour * 60 + now.minute
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+def effective_rate(rate):
+    """ Return the limit in force now for a configured rate: unchanged
+        during peak hours, multiplied by DBBACKUP_OFF_PEAK_RATE_FACTOR (or
+        lifted without one) off-peak. None means unlimited.
+    """
+    if not rate:
+        return None
+    if off_peak():
+        return rate * OFF_PEAK_RATE_FACTOR if OFF_PEAK_RATE_FACTOR else None
+    return rate
+
+def storage_rate(rate, name):
+    """ Return the rate for the storage called name from a setting that is
+        either a rate for every storage or a dict of rates by storage name.
+    """
+    if isinstance(rate, dict):
+        return rate.get(name)
+    return rate
+
+
+##################################
+#  Token Bucket
+##################################
+
+class TokenBucket(object):
+    """ Limit the bytes per second consumed by any number of threads. Up to
+        BURST_SECONDS worth of bytes may pass at once; beyond that consume()
+        sleeps until the bucket refilled. The limit is looked up on every
+        call, so a long transfer speeds up when the off-peak window opens.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.updated = time.time()
+
+    def limited(self):
+        return effective_rate(self.rate) is not None
+
+    def consume(self, size):
+        """ Take size bytes from the bucket, sleeping to respect the rate. """
+        rate = effective_rate(self.rate)
+        if rate is None:
+            return
+        with self.lock:
+            now = time.time()
+            burst = rate * BURST_SECONDS
+            if self.tokens is None:
+                self.tokens = burst
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            # Go into debt for large sizes, the next callers pay it back
+            self.tokens -= size
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+def throttled_chunks(chunks, bucket):
+    """ Yield chunks no faster than bucket allows. """
+    for data in chunks:
+        bucket.consume(len(data))
+        yield data
+
+# Shared by every database dumped at the same time
+DUMP = TokenBucket(DUMP_RATE_LIMIT)
+
+
+##################################
+#  Process Priority
+##################################
+
+def priority_command(command):
+    """ Prefix command with nice following DBBACKUP_NICE and with ionice
+        following DBBACKUP_IONICE: a class name ('idle', 'best-effort' or
+        'realtime') or a (class, level) pair. Either is left out where it
+        is not installed.
+    """
+    prefix = []
+    if NICE and find_executable('nice'):
+        prefix += ['nice', '-n', str(NICE)]
+    if IONICE and find_executable('ionice'):
+        ioclass, level = (IONICE, None) if isinstance(IONICE, basestring) else IONICE
+        prefix += ['ionice', '-c', IONICE_CLASSES.get(ioclass, str(ioclass))]
+        if level is not None:
+            prefix += ['-n', str(level)]
+    return prefix + command
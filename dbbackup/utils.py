@@ -1,7 +1,9 @@
 """
 Util functions for dropbox application.
 """
-import sys
+import hashlib, sys, tempfile, threading, time
+from collections import deque
+from Queue import Queue, Empty, Full
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.db import connection
@@ -37,28 +39,194 @@ def handle_size(filehandle):
     return bytes_to_str(filehandle.tell())
 
 
+###################################
+#  Chunk Streaming Helpers
+###################################
+
+def iter_chunks(filehandle, chunk_size):
+    """ Yield the contents of filehandle in chunks of chunk_size bytes. """
+    while True:
+        data = filehandle.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+def regroup_chunks(chunks, chunk_size):
+    """ Regroup an iterable of chunks into chunks of exactly chunk_size
+        bytes (except the last one). At least one chunk is always yielded.
+    """
+    pending, pending_size, emitted = [], 0, False
+    for data in chunks:
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size < chunk_size:
+            continue
+        # Joined once and sliced at offsets, so a large chunk is not copied
+        # again for every chunk cut from it
+        data, offset = ''.join(pending), 0
+        while pending_size - offset >= chunk_size:
+            yield data[offset:offset + chunk_size]
+            emitted = True
+            offset += chunk_size
+        pending, pending_size = [data[offset:]], pending_size - offset
+    if pending_size or not emitted:
+        yield ''.join(pending)
+
+def spool_chunks(chunks, name, max_size=10*1024*1024):
+    """ Write an iterable of chunks to a named SpooledTemporaryFile. """
+    filehandle = tempfile.SpooledTemporaryFile(max_size=max_size)
+    filehandle.name = name
+    for data in chunks:
+        filehandle.write(data)
+    filehandle.seek(0)
+    return filehandle
+
+def buffered_chunks(chunks, buffer_size, chunk_size):
+    """ Read ahead from chunks on a background thread so the producer (ie: the
+        dump process) and the consumer (ie: the upload) overlap. At most
+        buffer_size bytes are held in memory at any time.
+    """
+    queue = Queue(max(1, buffer_size // chunk_size))
+    stopped = threading.Event()
+    done = object()
+    def producer():
+        try:
+            for data in chunks:
+                while not stopped.is_set():
+                    try:
+                        queue.put(data, timeout=0.1)
+                        break
+                    except Full:
+                        pass
+                if stopped.is_set():
+                    break
+            result = done
+        except:
+            result = sys.exc_info()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        while not stopped.is_set():
+            try:
+                queue.put(result, timeout=0.1)
+                break
+            except Full:
+                pass
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            data = queue.get()
+            if data is done:
+                break
+            if isinstance(data, tuple):
+                raise data[0], data[1], data[2]
+            yield data
+    finally:
+        stopped.set()
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+        thread.join()
+
+def retry_call(func, args=(), retries=3, exceptions=(Exception,), delay=1):
+    """ Call func(*args), retrying up to retries times with an exponential
+        backoff when one of exceptions is raised.
+    """
+    for attempt in xrange(retries + 1):
+        try:
+            return func(*args)
+        except exceptions:
+            if attempt == retries:
+                raise
+            time.sleep(delay * 2 ** attempt)
+
+
+class ChunkDigest(object):
+    """ Iterate over chunks while computing their total size and sha256. """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def __iter__(self):
+        for data in self.chunks:
+            self.size += len(data)
+            self.sha256.update(data)
+            yield data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class ChunkReader(object):
+    """ Minimal read-only file object over an iterable of chunks. The chunks
+        read ahead are kept as they are, with the offset read in the first
+        one, so a read only copies the bytes it returns.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = deque()
+        self.pending_size = 0
+        self.offset = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.pending_size < size:
+            data = next(self.chunks, None)
+            if data is None:
+                break
+            if data:
+                self.pending.append(data)
+                self.pending_size += len(data)
+        if size < 0 or size > self.pending_size:
+            size = self.pending_size
+        parts, remaining = [], size
+        while remaining:
+            data = self.pending[0]
+            end = self.offset + remaining
+            if end < len(data):
+                parts.append(data[self.offset:end])
+                self.offset = end
+                break
+            parts.append(data[self.offset:])
+            remaining -= len(data) - self.offset
+            self.pending.popleft()
+            self.offset = 0
+        self.pending_size -= size
+        return ''.join(parts)
+
+
 ###################################
 #  Email Exception Decorator
 ###################################
 
+def email_exception(module):
+    """ Email the exception currently being handled to the SERVER_EMAIL. """
+    if getattr(settings, 'DBBACKUP_SEND_EMAIL', True):
+        excType, excValue, traceback = sys.exc_info()
+        reporter = ExceptionReporter(FAKE_HTTP_REQUEST, excType, excValue, traceback.tb_next)
+        subject = "Cron: Uncaught exception running %s" % module
+        body = reporter.get_traceback_html()
+        msgFrom = settings.SERVER_EMAIL
+        msgTo = [admin[1] for admin in settings.ADMINS]
+        message = EmailMessage(subject, body, msgFrom, msgTo)
+        message.content_subtype = 'html'
+        message.send(fail_silently=True)
+
 def email_uncaught_exception(func):
     """ Email uncaught exceptions to the SERVER_EMAIL. """
     module = func.__module__
     @wraps(func)
     def wrapper(*args, **kwargs):
         try:
-            func(*args, **kwargs)
+            return func(*args, **kwargs)
         except:
-            if getattr(settings, 'DBBACKUP_SEND_EMAIL', True):
-                excType, excValue, traceback = sys.exc_info()
-                reporter = ExceptionReporter(FAKE_HTTP_REQUEST, excType, excValue, traceback.tb_next)
-                subject = "Cron: Uncaught exception running %s" % module
-                body = reporter.get_traceback_html()
-                msgFrom = settings.SERVER_EMAIL
-                msgTo = [admin[1] for admin in settings.ADMINS]
-                message = EmailMessage(subject, body, msgFrom, msgTo)
-                message.content_subtype = 'html'
-                message.send(fail_silently=True)
+            email_exception(module)
             raise
         finally:
             connection.close()
@@ -0,0 +1,97 @@
+"""
+Check backups against the size and sha256 recorded in the catalog when
+they were written.
+"""
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from . import dedup, utils
+from .storage.base import StorageError
+
+WORKERS = getattr(settings, 'DBBACKUP_VERIFY_WORKERS', 4)
+
+OK, FAILED, SKIPPED = 'OK', 'FAILED', 'SKIPPED'
+
+
+class ChecksumError(StorageError):
+    pass
+
+
+def check_digest(digest, size, checksum, filepath):
+    """ Raise ChecksumError if a ChunkDigest does not match size and checksum. """
+    if size is not None and digest.size != size:
+        raise ChecksumError("%s is %s bytes, expected %s" % (filepath, digest.size, size))
+    if digest.hexdigest() != checksum:
+        raise ChecksumError("Checksum mismatch for %s: sha256 %s, expected %s" % (
+            filepath, digest.hexdigest(), checksum))
+
+def verified_chunks(chunks, size, checksum, filepath):
+    """ Yield chunks while hashing them, raising ChecksumError after the
+        last chunk if they do not match size and checksum.
+    """
+    digest = utils.ChunkDigest(chunks)
+    for data in digest:
+        yield data
+    check_digest(digest, size, checksum, filepath)
+
+def backup_chunks(storage, filepath):
+    """ Yield the data the checksum of a backup was computed over: the
+        stored file, or the dump reassembled from a manifest.
+    """
+    if dedup.is_manifest(filepath):
+        return dedup.read_backup(storage, filepath)
+    return storage.read_stream(filepath)
+
+
+##################################
+#  Verifying Stored Backups
+##################################
+
+def verify_backup(storage, entry, quick=False, chunks=None):
+    """ Check a catalog entry against storage. The full check reads and
+        hashes the backup; the quick check only compares the stored size
+        (and for deduplicated backups, that every chunk is stored; chunks
+        is the set of stored chunk names). Returns (status, message).
+    """
+    filepath, size, checksum = entry[3], entry[4], entry[6]
+    try:
+        if quick and dedup.is_manifest(filepath):
+            manifest = dedup.read_manifest(storage, filepath)
+            missing = [digest for digest, length in manifest['chunks']
+                if dedup.chunk_name(digest, manifest['codec']) not in chunks]
+            if missing:
+                return FAILED, "%s of %s chunks missing" % (len(missing), len(manifest['chunks']))
+            if size is not None and manifest['size'] != size:
+                return FAILED, "manifest size %s, expected %s" % (manifest['size'], size)
+        elif quick:
+            if size is None:
+                return SKIPPED, "no size recorded"
+            stored = storage.file_size(filepath)
+            if stored != size:
+                return FAILED, "stored size %s, expected %s" % (stored, size)
+        elif not checksum:
+            return SKIPPED, "no checksum recorded"
+        else:
+            for data in verified_chunks(backup_chunks(storage, filepath), size, checksum, filepath):
+                pass
+    except (StorageError, EnvironmentError, ValueError), err:
+        return FAILED, str(err)
+    return OK, utils.bytes_to_str(size) if size is not None else ''
+
+def verify_backups(storage, entries, quick=False, workers=WORKERS):
+    """ Verify catalog entries against storage, up to workers at a time.
+        Returns a list of (entry, status, message).
+    """
+    entries = list(entries)
+    chunks = None
+    if quick and any(dedup.is_manifest(entry[3]) for entry in entries):
+        chunks = dedup.stored_chunks(storage.list_directory())
+    def verify(entry):
+        return (entry,) + verify_backup(storage, entry, quick, chunks)
+    if not entries:
+        return []
+    pool = ThreadPool(min(workers, len(entries)))
+    try:
+        return pool.map(verify, entries, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -26,7 +26,7 @@ setup(name='django-dbbackup',
     long_description=read('README.txt'),
     author='Michael Shepanski',
     author_email='mjs7231@gmail.com',
-    install_requires=['simples3==1.0', 'dropbox>=1.3'],
+    install_requires=['simples3==1.0', 'dropbox>=1.6'],
     license='BSD',
     url='http://bitbucket.org/mjs7231/django-dbbackup',
     keywords = ['django','dropbox','database','backup','amazon','s3'],